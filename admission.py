@@ -0,0 +1,94 @@
+import threading
+from collections import Counter
+
+DEFAULT_MAX_TRANSFERS = 64  # transfers running at once, past this more streams only share the same link
+DEFAULT_MAX_PER_CLIENT = 8  # transfers one source IP may run at once
+DEFAULT_MAX_QUEUED = 64  # requests waiting for a slot, past this new requests are rejected at once
+DEFAULT_QUEUE_TIMEOUT = 5.0  # seconds a request waits for a slot before it is rejected
+
+
+class TransferRejected(Exception):
+    """A request the admission policy turned down, the message is the reason sent back to the client"""
+
+
+class AdmissionController:
+    """Admission policy of one server process: caps on running transfers (globally and per source IP), on the
+    requests waiting for a slot, and on the size, duration and rate a single request may ask for.
+
+    Every request is first counted as pending with enter(), which bounds the worker pool, then waits for a
+    transfer slot with acquire() (or polls try_acquire() on an event loop) and gives it back with release().
+    With worker processes every worker applies the limits on its own."""
+
+    def __init__(self, max_transfers=DEFAULT_MAX_TRANSFERS, max_per_client=DEFAULT_MAX_PER_CLIENT,
+                 max_queued=DEFAULT_MAX_QUEUED, queue_timeout=DEFAULT_QUEUE_TIMEOUT, max_file_size=None,
+                 max_duration=None, max_rate=None):
+        self.max_transfers = max_transfers
+        self.max_per_client = max_per_client
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.max_file_size = max_file_size  # None: no limit
+        self.max_duration = max_duration
+        self.max_rate = max_rate  # bits/second every UDP transfer is held to, unpaced requests included
+
+        self.slots = threading.Condition()
+        self.active = 0
+        self.active_per_client = Counter()
+        self.pending = 0  # admitted to the pool: running or waiting for a slot
+
+    @property
+    def capacity(self):
+        """Requests the server holds at once, the size of its worker pool"""
+        return self.max_transfers + self.max_queued
+
+    def enter(self):
+        """Counts a new request as pending, False when the pool and its queue are full"""
+        with self.slots:
+            if self.pending >= self.capacity:
+                return False
+            self.pending += 1
+            return True
+
+    def leave(self):
+        with self.slots:
+            self.pending -= 1
+
+    def check(self, file_size, duration=None):
+        """Raises TransferRejected for a request beyond the size or duration limits"""
+        if self.max_file_size is not None and file_size > self.max_file_size:
+            raise TransferRejected(f"file size {file_size} exceeds the limit of {self.max_file_size} bytes")
+        if self.max_duration is not None and duration is not None and duration > self.max_duration:
+            raise TransferRejected(f"transfer time {duration} exceeds the limit of {self.max_duration} seconds")
+
+    def limit_rate(self, rate):
+        """The rate a UDP transfer asking for rate (0 = unpaced) is sent at"""
+        if self.max_rate is None:
+            return rate
+        return min(rate, self.max_rate) if rate else self.max_rate
+
+    def has_slot(self, client):
+        return self.active < self.max_transfers and self.active_per_client[client] < self.max_per_client
+
+    def try_acquire(self, client):
+        """Takes a transfer slot for client if one is free right now"""
+        with self.slots:
+            if not self.has_slot(client):
+                return False
+            self.active += 1
+            self.active_per_client[client] += 1
+            return True
+
+    def acquire(self, client):
+        """Waits up to the queue timeout for a transfer slot, raises TransferRejected when none freed up"""
+        with self.slots:
+            if not self.slots.wait_for(lambda: self.has_slot(client), self.queue_timeout):
+                raise TransferRejected(f"no transfer slot within {self.queue_timeout} seconds")
+            self.active += 1
+            self.active_per_client[client] += 1
+
+    def release(self, client):
+        with self.slots:
+            self.active -= 1
+            self.active_per_client[client] -= 1
+            if not self.active_per_client[client]:
+                del self.active_per_client[client]
+            self.slots.notify_all()
@@ -0,0 +1,448 @@
+import asyncio
+import socket
+import time
+from contextlib import asynccontextmanager
+
+from admission import TransferRejected
+from profiling import FLUSH_INTERVAL
+from packets import (
+    PAYLOAD_MESSAGE_TYPES,
+    REQUEST_MESSAGE_TYPE,
+    TCP_PORT,
+    TCP_REJECTION_PREFIX,
+    TCP_STATUS_OK,
+    TIMESTAMPED_PAYLOAD_MESSAGE_TYPE,
+    UDP_LISTENER_PORT,
+)
+from reliable import FEEDBACK_INTERVAL, NACK_MESSAGE_TYPE
+from server import (
+    PATTERN_BUFFER_SIZE,
+    REQUEST_READ_TIMEOUT,
+    SEND_MODE_SENDFILE,
+    SpeedTestServer,
+    message_kind,
+    parse_tcp_request,
+    transfer_limits,
+)
+from session import SESSION_COMMAND, SESSION_IDLE_TIMEOUT
+from tracker import TransferTimer
+from upload import DIRECTION_UPLOAD, UPLOAD_BUFFER_SIZE, UPLOAD_IDLE_TIMEOUT, UPLOAD_REQUEST_MESSAGE_TYPE, throughput_figures
+
+# How many UDP segments a transfer sends before yielding to the other transfers on the loop
+UDP_SEGMENTS_PER_TURN = 64
+# Timers on the loop fire a millisecond or more late, a deeper bucket lets the transfer catch up after them
+ASYNC_PACING_BURST_PACKETS = 64
+# The loop can't block on the admission controller's condition, queued requests poll for a slot instead
+ADMISSION_POLL_INTERVAL = 0.01
+
+
+class UdpListenerProtocol(asyncio.DatagramProtocol):
+    """Receives UDP requests and tracks write-readiness of the shared UDP socket."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message_type = message_kind(data)
+        if message_type in PAYLOAD_MESSAGE_TYPES:
+            receiver = self.server.upload_receivers.get(addr)
+            if receiver:
+                receiver.record(data, message_type == TIMESTAMPED_PAYLOAD_MESSAGE_TYPE, time.perf_counter_ns())
+        elif message_type == REQUEST_MESSAGE_TYPE:
+            if self.server.admission.enter():
+                self.server.spawn(self.server.handle_udp_connection(self, addr, data))
+            else:
+                self.server.reject_udp(addr, "server busy")
+        elif message_type == UPLOAD_REQUEST_MESSAGE_TYPE:
+            if self.server.admission.enter():
+                self.server.spawn(self.server.handle_udp_upload(addr, data))
+            else:
+                self.server.reject_udp(addr, "server busy")
+        elif message_type == NACK_MESSAGE_TYPE:
+            feedback = self.server.feedback_queues.get(addr)
+            if feedback:
+                feedback.put_nowait(data)
+        else:
+            self.server.stats.add("malformed_packets")
+
+    def error_received(self, exc):
+        # ICMP errors of clients that went away show up here, like on the threaded listener's recvfrom
+        self.server.stats.add("receive_errors")
+        if not isinstance(exc, ConnectionRefusedError):
+            print(f"Error receiving UDP data: {exc}")
+
+    def pause_writing(self):
+        # the transport buffer is above its high-water mark, transfers wait until the kernel drains it
+        self.server.stats.add("send_eagain")
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+
+class AsyncSpeedTestServer(SpeedTestServer):
+    """Single-threaded server backend that multiplexes every TCP stream and UDP transfer on one asyncio loop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tasks = set()
+        self.udp_protocol = None
+
+    def spawn(self, coroutine):
+        """Schedules a transfer on the loop and keeps a reference to it until it is done"""
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def broadcast_offers(self):
+        """Sends UDP offer messages every offer interval from the event loop, solicits are answered by a reader
+        callback as they come."""
+        self.broadcast_socket = self.announcer.open()
+        self.broadcast_socket.setblocking(False)
+        print(f"Server started, {self.announcer.describe()}")
+        asyncio.get_running_loop().add_reader(self.broadcast_socket, self.answer_solicits)
+
+        while True:
+            self.announcer.announce(self.offer_message())
+            await asyncio.sleep(self.announcer.interval)
+
+    def answer_solicits(self):
+        """Answers every solicit waiting on the discovery socket with an offer"""
+        while True:
+            try:
+                data, addr = self.broadcast_socket.recvfrom(64)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. an ICMP error of an earlier unicast offer
+            if self.announcer.is_solicit(data):
+                self.announcer.answer(self.offer_message(), addr)
+
+    async def handle_tcp_connection(self, reader, writer):
+        """Reads the requested size and streams the shared pattern, drain() applies the socket backpressure. A
+        keepalive request leaves the connection open for the next request, a SESSION line makes it the control
+        connection of a session. Between requests the connection doesn't count as pending, it enters the
+        admission controller again with every request."""
+        if not self.admission.enter():
+            self.reject_tcp_writer(writer, "server busy")
+            writer.close()
+            return
+        admitted = True
+        duration = None
+        session = None
+        try:
+            data = await asyncio.wait_for(reader.readline(), REQUEST_READ_TIMEOUT)
+            while data:
+                if not admitted:
+                    admitted = self.admission.enter()
+                    if not admitted:
+                        self.reject_tcp_writer(writer, "server busy")
+                        break
+                if session is None and data.startswith(SESSION_COMMAND.encode()):
+                    session = self.open_session()
+                    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    writer.write(session.opened())
+                elif session is not None:
+                    writer.write(session.handle(data.decode(errors="replace")))
+                    await writer.drain()
+                    if session.closed:
+                        break
+                else:
+                    try:
+                        request = parse_tcp_request(data.decode())
+                    except (ValueError, IndexError):
+                        self.stats.add("malformed_packets")
+                        raise
+                    file_size, duration = request["size"], request["time"]
+                    profile = self.tcp_profile_of(request)
+                    pattern = self.pattern_of(request["payload"])
+                    self.admission.check(file_size, duration)
+                    async with self.async_transfer_slot(writer.get_extra_info("peername")[0], "tcp"):
+                        self.stats.add("tcp_connections")
+                        # the transport does the writes, a zerocopy profile only gets its buffer sizes here
+                        self.apply_tcp_profile(writer.get_extra_info("socket"), profile)
+                        if request["direction"] == DIRECTION_UPLOAD:
+                            figures = await self.receive_upload(reader, file_size, duration)
+                            writer.write(self.upload_result_line(figures))
+                            await writer.drain()
+                        else:
+                            if request["status"]:
+                                writer.write(TCP_STATUS_OK)
+                            # a stripe starts offset bytes into the transfer, see send_pattern()
+                            offset = request["offset"] % PATTERN_BUFFER_SIZE
+                            if duration is not None:
+                                await self.stream_pattern(writer, file_size, duration, offset, pattern)
+                            elif self.send_mode == SEND_MODE_SENDFILE:
+                                await self.sendfile_pattern(writer, file_size, offset, pattern)
+                            else:
+                                await self.sendall_pattern(writer, file_size, offset, pattern)
+                    if not request["keepalive"] or duration is not None:
+                        break
+                self.admission.leave()
+                admitted = False
+                data = await self.next_request(reader)
+                if data and session is None:
+                    self.stats.add("reused_connections")
+        except TransferRejected as e:
+            self.reject_tcp_writer(writer, e)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # closing the connection is how a client ends a time=inf transfer
+            if duration is None:
+                self.stats.add("send_errors")
+                print(f"Error handling TCP connection: {e}")
+        except Exception as e:
+            if isinstance(e, OSError):
+                self.stats.add("send_errors")
+            print(f"Error handling TCP connection: {e}")
+        finally:
+            writer.close()
+            if admitted:
+                self.admission.leave()
+
+    @staticmethod
+    async def next_request(reader):
+        """The next line of a connection idle between requests, b"" when the client closed it or left it idle for
+        SESSION_IDLE_TIMEOUT seconds"""
+        try:
+            return await asyncio.wait_for(reader.readline(), SESSION_IDLE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionResetError):
+            return b""
+
+    @asynccontextmanager
+    async def async_transfer_slot(self, client, protocol):
+        """transfer_slot() for the loop: polls for a slot up to the queue timeout, raises TransferRejected"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.admission.queue_timeout
+        while not self.admission.try_acquire(client):
+            if loop.time() >= deadline:
+                raise TransferRejected(f"no transfer slot within {self.admission.queue_timeout} seconds")
+            await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        self.stats.add("active_transfers")
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats.observe(f"{protocol}_transfer_seconds", time.perf_counter() - start_time)
+            self.stats.add("active_transfers", -1)
+            self.admission.release(client)
+
+    def reject_tcp_writer(self, writer, reason):
+        """reject_tcp() on a stream, the reason is flushed by the transport when the writer closes"""
+        self.stats.add("rejected")
+        writer.write(TCP_REJECTION_PREFIX + f"{reason}\n".encode())
+
+    def send_udp_message(self, message, client_address, repeats=1):
+        """send_udp_message() through the transport, which owns the non-blocking listener socket"""
+        for _ in range(repeats):
+            self.udp_protocol.transport.sendto(message, client_address)
+
+    async def receive_upload(self, reader, file_size, duration):
+        """receive_upload() from a stream, the reader's buffer is bounded by its limit and every read hands out
+        at most UPLOAD_BUFFER_SIZE bytes, so memory stays constant however long the upload runs"""
+        limit, deadline = transfer_limits(file_size, duration)
+        give_up = deadline + REQUEST_READ_TIMEOUT if deadline is not None else None
+        self.stats.add("tcp_uploads")
+        timer = TransferTimer(time.perf_counter_ns())
+        stats = self.stats.shard()
+        received = 0
+        while received < limit:
+            chunk = await asyncio.wait_for(reader.read(min(UPLOAD_BUFFER_SIZE, limit - received)),
+                                           REQUEST_READ_TIMEOUT)
+            if not chunk:
+                break
+            arrival_ns = time.perf_counter_ns()
+            timer.record(arrival_ns)
+            received += len(chunk)
+            stats["tcp_bytes_received"] += len(chunk)
+            if give_up is not None and arrival_ns / 1e9 >= give_up:
+                break
+        return throughput_figures(received, timer.summary())
+
+    async def sendall_pattern(self, writer, file_size, offset, pattern):
+        """Writes memoryview slices of the pattern and waits for the transport to drain between them"""
+        remaining = file_size
+        while remaining > 0:
+            chunk = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            writer.write(pattern.view[offset:offset + chunk])
+            await writer.drain()
+            self.record_tcp_send(chunk)
+            remaining -= chunk
+            offset = (offset + chunk) % PATTERN_BUFFER_SIZE
+
+    async def sendfile_pattern(self, writer, file_size, offset, pattern):
+        """Sends the pattern file with the loop's sendfile, wrapping around the pattern file"""
+        loop = asyncio.get_running_loop()
+        remaining = file_size
+        while remaining > 0:
+            count = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            sent = await loop.sendfile(writer.transport, pattern.file, offset, count)
+            if sent == 0:
+                raise ConnectionError("sendfile made no progress, connection closed by peer")
+            self.record_tcp_send(sent)
+            remaining -= sent
+            offset = (offset + sent) % PATTERN_BUFFER_SIZE
+
+    async def stream_pattern(self, writer, file_size, duration, offset, pattern):
+        """Streams the pattern until the deadline (or file_size bytes, when given), the wait for the transport
+        to drain is cut at the deadline and whatever is still queued then is dropped with the connection"""
+        remaining, deadline = transfer_limits(file_size, duration)
+        while remaining > 0:
+            chunk = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            writer.write(pattern.view[offset:offset + chunk])
+            timeout = None if deadline == float("inf") else deadline - time.perf_counter()
+            try:
+                await asyncio.wait_for(writer.drain(), timeout)
+            except asyncio.TimeoutError:
+                writer.transport.abort()
+                return
+            self.record_tcp_send(chunk)
+            remaining -= chunk
+            offset = (offset + chunk) % PATTERN_BUFFER_SIZE
+            if time.perf_counter() >= deadline:
+                return
+
+    async def handle_udp_connection(self, protocol, client_address, request_data):
+        """Sends the requested segments, pausing whenever the UDP transport is not writable. The caller counted
+        the request with admission.enter()."""
+        try:
+            request = self.admit_udp_request(request_data)
+            async with self.async_transfer_slot(client_address[0], "udp"):
+                transfer = self.create_udp_transfer(client_address, request, ASYNC_PACING_BURST_PACKETS)
+                self.stats.add("udp_transfers")
+                stats = self.stats.shard()  # every task on the loop shares the loop thread's shard
+                payload_size = transfer.payload_size
+                stages = self.profiler.stages if self.profiler else None
+
+                sent_since_yield = 0
+                async for first_segment, count in self.transfer_batches(transfer, client_address):
+                    if not protocol.can_write.is_set():
+                        await protocol.can_write.wait()
+                    if transfer.pacer:
+                        while wait := transfer.pacer.try_consume(count * transfer.builder.datagram_size):
+                            await asyncio.sleep(wait)
+                    if stages:
+                        start_ns = time.perf_counter_ns()
+                        datagrams = transfer.builder.build(first_segment, count)
+                        built_ns = time.perf_counter_ns()
+                        self.send_datagrams(protocol, transfer.sender, datagrams)
+                        stages.add("pack", built_ns - start_ns, count)
+                        stages.add("send", time.perf_counter_ns() - built_ns, count)
+                    else:
+                        self.send_datagrams(protocol, transfer.sender, transfer.builder.build(first_segment, count))
+                    stats["udp_packets"] += count
+                    stats["udp_bytes_sent"] += count * payload_size
+                    sent_since_yield += count
+                    if sent_since_yield >= UDP_SEGMENTS_PER_TURN:
+                        sent_since_yield = 0
+                        await asyncio.sleep(0)  # let the other transfers on the loop make progress
+                if transfer.reliable:
+                    self.stats.add("udp_retransmits", transfer.reliable.retransmitted)
+        except TransferRejected as e:
+            self.reject_udp(client_address, e)
+        except Exception as e:
+            if isinstance(e, OSError):
+                self.stats.add("send_errors")
+            print(f"Error handling UDP connection: {e}")
+        finally:
+            self.admission.leave()
+
+    async def handle_udp_upload(self, client_address, request_data):
+        """handle_udp_upload() on the loop, the listener protocol feeds the receiver and the task polls it. The
+        caller counted the request with admission.enter()."""
+        try:
+            request = self.admit_udp_request(request_data)
+            async with self.async_transfer_slot(client_address[0], "udp"):
+                receiver = self.start_udp_upload(client_address, request)
+                try:
+                    while not receiver.done.is_set() and not receiver.idle(UPLOAD_IDLE_TIMEOUT):
+                        await asyncio.sleep(UPLOAD_IDLE_TIMEOUT / 10)
+                finally:
+                    self.finish_udp_upload(client_address, receiver)
+        except TransferRejected as e:
+            self.reject_udp(client_address, e)
+        except Exception as e:
+            print(f"Error handling UDP upload: {e}")
+        finally:
+            self.admission.leave()
+
+    async def transfer_batches(self, transfer, client_address):
+        """Yields the batches of a transfer, a reliable one applies the client's feedback between batches and
+        waits for it while its window is full"""
+        if not transfer.reliable:
+            for batch in transfer.batches():
+                yield batch
+            return
+        feedback = asyncio.Queue()
+        self.feedback_queues[client_address] = feedback
+        reliable = transfer.reliable
+        try:
+            # a newer reliable transfer to the same address (a pooled socket's next round) takes its feedback over
+            while not reliable.finished and self.feedback_queues.get(client_address) is feedback:
+                while not feedback.empty():
+                    reliable.on_feedback(feedback.get_nowait())
+                batch = reliable.next_batch(transfer.batch_size)
+                if batch is None:
+                    try:
+                        reliable.on_feedback(await asyncio.wait_for(feedback.get(), FEEDBACK_INTERVAL))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                yield batch
+        finally:
+            if self.feedback_queues.get(client_address) is feedback:
+                del self.feedback_queues[client_address]
+
+    @staticmethod
+    def send_datagrams(protocol, sender, datagrams):
+        """Sends a batch with one GSO sendmsg on the raw socket while the transport has nothing queued,
+        otherwise (or when the socket is full) through the transport, which buffers and pauses the writers"""
+        if sender.use_gso and len(datagrams) > 1 and not protocol.transport.get_write_buffer_size():
+            try:
+                sender.send(datagrams)
+                return
+            except BlockingIOError:
+                pass  # counted by pause_writing() if the transport's buffer fills up too
+        for datagram in datagrams:
+            protocol.transport.sendto(datagram, sender.address)
+
+    async def serve(self):
+        """Opens the listeners and runs every part of the server as tasks of the running loop."""
+        loop = asyncio.get_running_loop()
+        if self.broadcast:
+            self.spawn(self.broadcast_offers())
+
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_socket.bind(("", UDP_LISTENER_PORT))
+        self.udp_listener_socket = udp_socket
+        _, self.udp_protocol = await loop.create_datagram_endpoint(lambda: UdpListenerProtocol(self), sock=udp_socket)
+
+        tcp_server = await asyncio.start_server(
+            self.handle_tcp_connection, port=TCP_PORT, backlog=socket.SOMAXCONN, reuse_port=self.reuse_port or None
+        )
+        self.server_tcp_socket = tcp_server.sockets[0]
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    def runtime_gauges(self):
+        gauges = super().runtime_gauges()
+        gauges["tasks"] = len(self.tasks)
+        return gauges
+
+    def run(self):
+        """Runs the event loop until the server is stopped, under cProfile when profiling in that mode."""
+        if self.profiler:
+            self.profiler.start(FLUSH_INTERVAL)
+        try:
+            (self.profiler.wrap(asyncio.run) if self.profiler else asyncio.run)(self.serve())
+        finally:
+            self.stop_profiler()
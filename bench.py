@@ -0,0 +1,195 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from client import SpeedTestClient
+from packets import TCP_PORT, UDP_LISTENER_PORT
+from server import BACKENDS, BACKEND_THREADED
+
+LOCALHOST = "127.0.0.1"
+SERVER_START_TIMEOUT = 10
+METRICS_PORT = 9190  # the server's /stats, where it reports its own CPU time
+# metric -> 1 when higher is better, -1 when lower is better
+COMPARED_METRICS = {
+    "tcp_gbps": 1,
+    "udp_gbps": 1,
+    "udp_packets_per_second": 1,
+    "udp_loss_percentage": -1,
+    "client_cpu": -1,
+    "server_cpu": -1,
+}
+# metric -> smallest absolute change that counts as a regression, below it a small configuration's change in
+# percent is measurement noise
+NOISE_FLOORS = {
+    "client_cpu": 0.01,
+    "server_cpu": 0.01,
+}
+CONFIG_FIELDS = ("backend", "file_size", "tcp_connections", "udp_connections", "buffer_size")
+
+
+def start_server(backend, udp_rate):
+    """Starts server.py on loopback and waits until its TCP listener accepts connections"""
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+         "--backend", backend, "--udp-rate", str(udp_rate), "--broadcast-address", LOCALHOST,
+         "--metrics-port", str(METRICS_PORT)],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            with socket.create_connection((LOCALHOST, TCP_PORT), timeout=1) as probe:
+                probe.sendall(b"0\n")  # an empty transfer
+                probe.recv(1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start listening in time")
+
+
+def server_cpu_seconds():
+    """User + system CPU seconds of the server as it measures them with time.process_time(), /proc/<pid>/stat
+    only counts whole clock ticks (10 ms), which small configurations use a few of"""
+    with urllib.request.urlopen(f"http://{LOCALHOST}:{METRICS_PORT}/stats") as response:
+        return json.load(response)["cpu_seconds"]
+
+
+def peak_rss(pid):
+    """Peak resident set size of a process in bytes, from VmHWM"""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def reset_peak_rss(pid):
+    """Restarts the VmHWM high water mark so it covers a single configuration (Linux 4.0+)"""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def run_config(server, backend, file_size, tcp_connections, udp_connections, buffer_size, udp_rate):
+    """Runs one round against the server and returns its record"""
+    client = SpeedTestClient(udp_rate=udp_rate, tcp_buffer_size=buffer_size)
+    client.server_address = (LOCALHOST, UDP_LISTENER_PORT, TCP_PORT)
+
+    reset_peak_rss(server.pid)
+    server_cpu = server_cpu_seconds()
+    client_cpu = time.process_time()
+    start_time = time.perf_counter()
+    results = client.run_round(file_size, tcp_connections, udp_connections)
+    elapsed = time.perf_counter() - start_time
+    client_cpu = time.process_time() - client_cpu
+    server_cpu = server_cpu_seconds() - server_cpu
+
+    tcp = [result for result in results if result["protocol"] == "tcp"]
+    udp = [result for result in results if result["protocol"] == "udp"]
+    return {
+        "backend": backend,
+        "file_size": file_size,
+        "tcp_connections": tcp_connections,
+        "udp_connections": udp_connections,
+        "buffer_size": buffer_size,
+        "udp_rate": udp_rate,
+        "failed_transfers": tcp_connections + udp_connections - len(results),
+        "elapsed": elapsed,
+        "tcp_gbps": sum(result["bits_per_second"] or 0 for result in tcp) / 1e9 if tcp else None,
+        "udp_gbps": sum(result["bits_per_second"] or 0 for result in udp) / 1e9 if udp else None,
+        "udp_packets_per_second": sum(result["packets_per_second"] for result in udp) if udp else None,
+        "udp_loss_percentage": (
+            sum(100 - result["received_percentage"] for result in udp) / len(udp) if udp else None
+        ),
+        "client_cpu": client_cpu,
+        "server_cpu": server_cpu,
+        "client_peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # never reset, whole run
+        "server_peak_rss": peak_rss(server.pid),
+    }
+
+
+def config_key(record):
+    return tuple(record[field] for field in CONFIG_FIELDS)
+
+
+def compare(records, baseline, tolerance):
+    """Prints the change of every metric against the baseline and returns the regressions, a metric regresses
+    when it got worse by more than tolerance (a fraction of the baseline value) and by at least its noise floor"""
+    baseline_records = {config_key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        previous = baseline_records.get(config_key(record))
+        if previous is None:
+            continue
+        for metric, direction in COMPARED_METRICS.items():
+            before, after = previous.get(metric), record.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = change * direction < -tolerance and abs(after - before) >= NOISE_FLOORS.get(metric, 0)
+            color = "\033[91m" if regressed else "\033[0;32m"
+            print(color + f"{config_key(record)} {metric}: {before:.4g} -> {after:.4g} ({change * 100:+.1f}%)" + "\033[0m")
+            if regressed:
+                regressions.append((config_key(record), metric, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the speed test server and client")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=[BACKEND_THREADED])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10 * 1024 ** 2, 100 * 1024 ** 2],
+                        help="bytes per transfer")
+    parser.add_argument("--tcp", type=int, nargs="+", default=[1, 4], help="TCP connection counts")
+    parser.add_argument("--udp", type=int, nargs="+", default=[0, 1], help="UDP connection counts")
+    parser.add_argument("--buffer-sizes", type=int, nargs="+", default=[256 * 1024],
+                        help="client TCP receive buffer sizes")
+    parser.add_argument("--udp-rate", type=int, default=1_000_000_000,
+                        help="bits/second asked for every UDP transfer, unpaced loopback UDP mostly measures loss")
+    parser.add_argument("--output", default="bench.json", help="JSON file the records are written to")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction a metric may get worse than the baseline before it counts as a regression")
+    args = parser.parse_args()
+
+    records = []
+    for backend in args.backends:
+        server = start_server(backend, args.udp_rate)
+        try:
+            for file_size, tcp_connections, udp_connections, buffer_size in itertools.product(
+                    args.sizes, args.tcp, args.udp, args.buffer_sizes):
+                if not tcp_connections and not udp_connections:
+                    continue
+                record = run_config(server, backend, file_size, tcp_connections, udp_connections, buffer_size,
+                                    args.udp_rate)
+                records.append(record)
+                print("\033[1;34m" + json.dumps(record) + "\033[0m")
+        finally:
+            server.terminate()
+            server.wait()
+
+    with open(args.output, "w") as output:
+        json.dump(records, output, indent=2)
+    print("\033[95m" + f"{len(records)} records written to {args.output}" + "\033[0m")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(records, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("\033[91m" + f"{len(regressions)} regressions against {args.baseline}" + "\033[0m")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
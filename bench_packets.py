@@ -0,0 +1,66 @@
+import argparse
+import socket
+import struct
+import time
+
+from packets import MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, PacketBuilder
+from server import DEFAULT_UDP_PAYLOAD_SIZE
+
+
+def build_concatenated(total_segments, payload_size, batch_size, send):
+    """The hot loop of handle_udp_connection before PacketBuilder: pack the header and concatenate a new
+    payload for every packet of every batch"""
+    for first_segment in range(0, total_segments, batch_size):
+        datagrams = [
+            struct.pack(
+                '!IBQQ', MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, total_segments, segment
+            ) + b'a' * payload_size
+            for segment in range(first_segment, min(first_segment + batch_size, total_segments))
+        ]
+        for datagram in datagrams:
+            send(datagram)
+
+
+def build_in_place(total_segments, payload_size, batch_size, send):
+    """The same loop with PacketBuilder patching the segment numbers of one reusable buffer"""
+    builder = PacketBuilder(MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, total_segments, payload_size, batch_size)
+    for first_segment in range(0, total_segments, batch_size):
+        for datagram in builder.build(first_segment, min(batch_size, total_segments - first_segment)):
+            send(datagram)
+
+
+def measure(loop, packets, payload_size, batch_size, send):
+    """Runs one loop and returns its packets/second"""
+    start_time = time.perf_counter()
+    loop(packets, payload_size, batch_size, send)
+    return packets / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packets/second of the UDP segment loop before and after PacketBuilder")
+    parser.add_argument("--packets", type=int, default=1_000_000)
+    parser.add_argument("--payload-size", type=int, default=DEFAULT_UDP_PAYLOAD_SIZE)
+    parser.add_argument("--batch-size", type=int, default=64, help="datagrams per batch, 64 is the GSO batch")
+    parser.add_argument("--send", action="store_true", help="also sendto() every packet to a local sink socket")
+    args = parser.parse_args()
+
+    if args.send:
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = sink.getsockname()
+
+        def send(datagram):
+            sender.sendto(datagram, address)
+    else:
+        def send(datagram):
+            pass
+
+    before = measure(build_concatenated, args.packets, args.payload_size, args.batch_size, send)
+    after = measure(build_in_place, args.packets, args.payload_size, args.batch_size, send)
+    print(f"struct.pack + concatenation: {before:.0f} packets/second")
+    print(f"PacketBuilder in place:      {after:.0f} packets/second ({after / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import multiprocessing
+import socket
+import time
+
+from server import SpeedTestServer
+
+
+def serve(listener, connections):
+    """Sender process, streams every request with the server's real TCP path so the GIL isn't shared with
+    the receiver being measured"""
+    server = SpeedTestServer()
+    for _ in range(connections):
+        client_socket, _ = listener.accept()
+        server.handle_tcp_connection(client_socket)
+
+
+def receive_allocating(tcp_socket, buffer_size):
+    """The old client loop: recv() allocates a new bytes object for every chunk"""
+    total_bytes = 0
+    while True:
+        data = tcp_socket.recv(buffer_size)
+        if not data:
+            return total_bytes
+        total_bytes += len(data)
+
+
+def receive_into(tcp_socket, buffer_size):
+    """The current client loop: recv_into() fills one preallocated buffer"""
+    buffer = memoryview(bytearray(buffer_size))
+    total_bytes = 0
+    while True:
+        received = tcp_socket.recv_into(buffer)
+        if not received:
+            return total_bytes
+        total_bytes += received
+
+
+def measure(address, receive, buffer_size, file_size):
+    """Runs one transfer and returns its Gbit/s and the receiving thread's CPU seconds per gigabit"""
+    with socket.create_connection(address) as tcp_socket:
+        tcp_socket.sendall(f"{file_size}\n".encode())
+        start_time, start_cpu = time.perf_counter(), time.thread_time()
+        total_bytes = receive(tcp_socket, buffer_size)
+        elapsed, cpu = time.perf_counter() - start_time, time.thread_time() - start_cpu
+    gigabits = total_bytes * 8 / 1e9
+    return gigabits / elapsed, cpu / gigabits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and CPU per gigabit of the client TCP receive loops")
+    parser.add_argument("--size", type=int, default=2 * 1024 ** 3, help="bytes per transfer")
+    parser.add_argument("--buffer-sizes", type=int, nargs="+", default=[4096, 65536, 262144, 1048576])
+    args = parser.parse_args()
+
+    loops = [("recv", receive_allocating), ("recv_into", receive_into)]
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    sender = multiprocessing.Process(target=serve, args=(listener, len(loops) * len(args.buffer_sizes)), daemon=True)
+    sender.start()
+
+    print(f"{'loop':<10} {'buffer':>9} {'Gbit/s':>8} {'CPU s/Gbit':>11}")
+    for buffer_size in args.buffer_sizes:
+        for name, receive in loops:
+            speed, cpu_per_gigabit = measure(listener.getsockname(), receive, buffer_size, args.size)
+            print(f"{name:<10} {buffer_size:>9} {speed:>8.2f} {cpu_per_gigabit:>11.4f}")
+    sender.join()
+
+
+if __name__ == "__main__":
+    main()
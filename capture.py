@@ -0,0 +1,169 @@
+import argparse
+import json
+import struct
+import sys
+from array import array
+
+NPY_MAGIC = b"\x93NUMPY"
+DEFAULT_INTERVAL = 0.1  # seconds per throughput bucket
+# inter-arrival histogram bin edges in microseconds, the first bin holds the datagrams of one GRO batch
+INTERARRIVAL_EDGES_US = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000, 1000000, float("inf"))
+COMPARED_FIELDS = ("received_percentage", "duplicates", "loss_runs", "longest_loss_run", "out_of_order",
+                   "max_reorder_depth", "mean_interarrival_us", "mean_bits_per_second")
+
+
+def write_npy(path, values):
+    """Writes an array('Q') as a version 1.0 .npy file, so capturing doesn't need NumPy"""
+    descr = ("<" if sys.byteorder == "little" else ">") + "u8"
+    header = repr({"descr": descr, "fortran_order": False, "shape": (len(values),)})
+    # padded with spaces and ended with a newline so the data starts 64-byte aligned, as the format asks
+    header += " " * (-(len(NPY_MAGIC) + 4 + len(header) + 1) % 64) + "\n"
+    with open(path, "wb") as npy_file:
+        npy_file.write(NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+        values.tofile(npy_file)
+
+
+class ArrivalLog:
+    """(segment, arrival_ns) of every datagram of one UDP transfer in two array('Q') buffers, 16 bytes per
+    datagram instead of two boxed ints. Appending grows the buffers geometrically, so recording is a couple of
+    C-level appends per datagram and the buffers are handed to NumPy without a copy."""
+
+    def __init__(self):
+        self.segments = array("Q")
+        self.arrivals = array("Q")
+
+    def record(self, segment, arrival_ns):
+        self.segments.append(segment)
+        self.arrivals.append(arrival_ns)
+
+    def save(self, prefix, **metadata):
+        """Writes <prefix>.segments.npy, <prefix>.arrivals.npy and the transfer's metadata as <prefix>.json"""
+        write_npy(prefix + ".segments.npy", self.segments)
+        write_npy(prefix + ".arrivals.npy", self.arrivals)
+        with open(prefix + ".json", "w") as metadata_file:
+            json.dump(dict(metadata, datagrams=len(self.segments)), metadata_file, indent=2)
+
+
+def require_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SystemExit("analyzing captures needs NumPy (pip install numpy), capturing works without it")
+    return numpy
+
+
+def load_capture(prefix):
+    """The segments, arrival times and metadata of a capture, prefix may also be its .segments.npy path"""
+    np = require_numpy()
+    prefix = prefix.removesuffix(".segments.npy")
+    with open(prefix + ".json") as metadata_file:
+        metadata = json.load(metadata_file)
+    return np.load(prefix + ".segments.npy"), np.load(prefix + ".arrivals.npy"), metadata
+
+
+def analyze(segments, arrivals, total_segments=None, payload_size=0, interval=DEFAULT_INTERVAL):
+    """Loss runs, reordering, inter-arrival histogram and per-interval throughput of a capture in bulk.
+    Returns the summary figures and the arrays behind them. Reordering follows ReceiveTracker: a segment is out
+    of order when its first copy arrives after a higher numbered segment, its depth is the distance."""
+    np = require_numpy()
+    segments = np.asarray(segments, dtype=np.int64)
+    arrivals = np.asarray(arrivals, dtype=np.int64)
+    if total_segments is None:
+        total_segments = int(segments.max()) + 1 if len(segments) else 0
+    valid = segments < total_segments
+    segments, arrivals = segments[valid], arrivals[valid]
+
+    received = np.zeros(total_segments, dtype=bool)
+    received[segments] = True
+    unique = int(np.count_nonzero(received))
+
+    # +1 where a run of missing segments starts, -1 one past its end
+    edges = np.diff(np.concatenate(([0], (~received).astype(np.int8), [0])))
+    loss_starts = np.flatnonzero(edges == 1)
+    loss_lengths = np.flatnonzero(edges == -1) - loss_starts
+
+    _, first_index = np.unique(segments, return_index=True)
+    firsts = segments[np.sort(first_index)]  # first copy of every segment, in arrival order
+    highest_before = np.concatenate(([-1], np.maximum.accumulate(firsts)[:-1]))
+    depths = highest_before - firsts
+    reorder_depths = depths[depths > 0]
+
+    gaps_us = np.diff(arrivals) / 1000
+    interarrival_histogram, _ = np.histogram(gaps_us, bins=INTERARRIVAL_EDGES_US)
+
+    interval_ns = int(interval * 1e9)
+    interval_packets = (np.bincount((arrivals - arrivals[0]) // interval_ns) if len(arrivals)
+                        else np.zeros(0, dtype=np.int64))
+    interval_bits_per_second = interval_packets * payload_size * 8 / interval
+
+    summary = {
+        "total_segments": total_segments,
+        "datagrams": len(segments),
+        "invalid": int(np.count_nonzero(~valid)),
+        "unique": unique,
+        "received_percentage": unique / total_segments * 100 if total_segments else 0,
+        "duplicates": len(segments) - unique,
+        "loss_runs": len(loss_lengths),
+        "longest_loss_run": int(loss_lengths.max()) if len(loss_lengths) else 0,
+        "out_of_order": len(reorder_depths),
+        "max_reorder_depth": int(reorder_depths.max()) if len(reorder_depths) else 0,
+        "mean_interarrival_us": float(gaps_us.mean()) if len(gaps_us) else None,
+        "interval": interval,
+        "mean_bits_per_second": float(interval_bits_per_second.mean()) if len(interval_bits_per_second) else None,
+    }
+    arrays = {
+        "loss_starts": loss_starts,
+        "loss_lengths": loss_lengths,
+        "reorder_depths": reorder_depths,
+        "interarrival_histogram": interarrival_histogram,
+        "interval_packets": interval_packets,
+        "interval_bits_per_second": interval_bits_per_second,
+    }
+    return summary, arrays
+
+
+def save_analysis(prefix, summary, arrays):
+    """Writes <prefix>.analysis.json and one <prefix>.analysis.<name>.npy per array"""
+    np = require_numpy()
+    for name, values in arrays.items():
+        np.save(f"{prefix}.analysis.{name}.npy", values)
+    with open(prefix + ".analysis.json", "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+
+def compare(summary, baseline):
+    """Prints every compared figure next to the baseline's"""
+    for field in COMPARED_FIELDS:
+        before, after = baseline.get(field), summary.get(field)
+        if before is None or after is None:
+            continue
+        change = f" ({(after - before) / before * 100:+.1f}%)" if before else ""
+        print("\033[1;34m" + f"  {field}: {before:.6g} -> {after:.6g}{change}" + "\033[0m")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized analysis of UDP arrival captures (client --capture)")
+    parser.add_argument("captures", nargs="+", help="capture prefixes, or their .segments.npy files")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds per throughput bucket")
+    parser.add_argument("--baseline", default=None,
+                        help="capture prefix of an earlier analysis (its .analysis.json) to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline.removesuffix(".segments.npy") + ".analysis.json") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    for capture in args.captures:
+        prefix = capture.removesuffix(".segments.npy")
+        segments, arrivals, metadata = load_capture(prefix)
+        summary, arrays = analyze(segments, arrivals, metadata.get("total_segments"),
+                                  metadata.get("payload_size", 0), args.interval)
+        save_analysis(prefix, summary, arrays)
+        print("\033[0;32m" + f"{prefix}: " + json.dumps(summary) + "\033[0m")
+        if baseline:
+            compare(summary, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,133 +1,1070 @@
+import argparse
+import itertools
+import json
 import socket
 import struct
 import threading
 import time
+import zlib
+from contextlib import contextmanager
+
+from capture import ArrivalLog
+from discovery import DEFAULT_TTL, DiscoveryService
+from packets import (
+    DIRECTION_KEY,
+    FLAG_TIMESTAMPS,
+    KEEPALIVE_KEY,
+    MAGIC_COOKIE,
+    OFFER_MESSAGE_TYPE,
+    OFFSET_KEY,
+    PAYLOAD_HEADER,
+    PAYLOAD_KEY,
+    PAYLOAD_MESSAGE_TYPE,
+    PROFILE_KEY,
+    REJECT_MESSAGE_TYPE,
+    REQUEST_DURATION_FORMAT,
+    REQUEST_MESSAGE_TYPE,
+    REQUEST_OPTIONS_FORMAT,
+    REQUEST_PAYLOAD_FORMAT,
+    STATUS_KEY,
+    TCP_PORT,
+    TCP_REJECTION_PREFIX,
+    TCP_STATUS_OK,
+    TIMESTAMPED_PAYLOAD_HEADER,
+    TIMESTAMPED_PAYLOAD_MESSAGE_TYPE,
+    TIME_KEY,
+    UDP_BROADCAST_PORT,
+    UDP_LISTENER_PORT,
+    PacketBuilder,
+)
+from pacing import TokenBucket
+from payloads import (
+    DEFAULT_SEED,
+    PAYLOAD_CONSTANT,
+    PAYLOAD_FILE,
+    PAYLOAD_IDS,
+    PAYLOAD_KINDS,
+    PAYLOAD_RANDOM,
+    StreamVerifier,
+    load_pattern,
+)
+from plan import load_plan, make_round
+from profiling import DEFAULT_PROFILE_OUTPUT, DEFAULT_SAMPLE_INTERVAL, PROFILE_MODES, Profiler
+from reliable import DONE_REPEATS, FEEDBACK_INTERVAL, FLAG_RELIABLE, IDLE_TIMEOUT, ReliableReceiver
+from reporter import IntervalCounter, IntervalReporter
+from session import POOL_MODES, ClientSession, drain_datagrams, tcp_usable
+from tcp_tuning import PROFILES, apply_profile, socket_settings
+from tracker import ReceiveTracker, SteadyStateWindow, TransferTimer
+from udp_batch import MAX_DATAGRAM_SIZE, BatchReceiver, BatchSender
+from upload import (
+    DIRECTION_BIDIRECTIONAL,
+    DIRECTION_DOWNLOAD,
+    DIRECTION_UPLOAD,
+    DIRECTIONS,
+    TCP_RESULT_PREFIX,
+    UPLOAD_IDLE_TIMEOUT,
+    UPLOAD_READY,
+    UPLOAD_READY_MESSAGE_TYPE,
+    UPLOAD_REQUEST_MESSAGE_TYPE,
+    UPLOAD_RESULT_MESSAGE_TYPE,
+    parse_result,
+)
 
 # Client Configuration
-MAGIC_COOKIE = 0xabcddcba
-OFFER_MESSAGE_TYPE = 0x2
-REQUEST_MESSAGE_TYPE = 0x3
-PAYLOAD_MESSAGE_TYPE = 0x4
-UDP_BROADCAST_PORT = 13117
+PAYLOAD_HEADER_SIZES = {PAYLOAD_MESSAGE_TYPE: PAYLOAD_HEADER.size,
+                        TIMESTAMPED_PAYLOAD_MESSAGE_TYPE: TIMESTAMPED_PAYLOAD_HEADER.size}
+REJECT_PREFIX = struct.pack('!IB', MAGIC_COOKIE, REJECT_MESSAGE_TYPE)
+MAX_STATUS_LINE = 1024
+# a request may wait in the server's admission queue (5 seconds by default) before its first segment comes
+FIRST_SEGMENT_TIMEOUT = 6
 BUFFER_SIZE = 4096
+TCP_BUFFER_SIZE = 256 * 1024  # default size of the buffer every TCP connection receives into
+UDP_IO_BATCH = "batch"  # UDP GRO, many datagrams per receive where Linux supports it
+UDP_IO_SINGLE = "single"  # one datagram per receive
+UDP_IO_MODES = (UDP_IO_BATCH, UDP_IO_SINGLE)
+PACING_BURST_PACKETS = 8  # how many datagrams a paced upload may send back to back
+# a size-bounded upload's result comes at once, one that lost segments after the server's idle timeout
+UPLOAD_RESULT_TIMEOUT = UPLOAD_IDLE_TIMEOUT + 2
+STOP_BY_SERVER = "server"  # time-bounded TCP transfers end at the server's deadline
+STOP_BY_CLIENT = "client"  # the server streams until the client closes the connection at its own deadline
+STOP_MODES = (STOP_BY_SERVER, STOP_BY_CLIENT)
+DEFAULT_OMIT_FRACTION = 0.1  # warm-up share of a time-bounded transfer left out of its steady-state speed
+SELECT_LEAST_LOADED = "least-loaded"  # every round tests the discovered server running the fewest transfers
+SELECT_ALL = "all"  # every round fans out to all the discovered servers in parallel
+SELECT_MODES = (SELECT_LEAST_LOADED, SELECT_ALL)
+
+
+def stripe_ranges(file_size, stripes):
+    """(offset, length) of every stripe of a file_size byte transfer split over at most stripes connections,
+    the first file_size % stripes stripes are one byte longer"""
+    stripes = max(1, min(stripes, file_size))
+    length, longer = divmod(file_size, stripes)
+    ranges = []
+    offset = 0
+    for stripe in range(stripes):
+        stripe_length = length + (stripe < longer)
+        ranges.append((offset, stripe_length))
+        offset += stripe_length
+    return ranges
+
+
+def format_speed(total_bytes, seconds):
+    """bits/second of a transfer as printed in the reports"""
+    if not seconds:
+        return "too fast to calculate"
+    return f"{total_bytes * 8 / seconds:.2f} bits/second"
+
 
 class SpeedTestClient:
-    def __init__(self):
-        self.udp_socket = None
+    def __init__(self, udp_rate=0, udp_payload_size=0, udp_io=UDP_IO_BATCH, timestamps=True,
+                 report_interval=None, report_file=None, tcp_buffer_size=TCP_BUFFER_SIZE, receive_buffer=None,
+                 stop_by=STOP_BY_SERVER, omit=None, reliable=False, select=SELECT_LEAST_LOADED,
+                 discovery_ttl=DEFAULT_TTL, profiler=None, capture=None, tcp_profile=None,
+                 direction=DIRECTION_DOWNLOAD, stripes=1, payload=None, payload_seed=DEFAULT_SEED, payload_file=None,
+                 verify=False, multicast_group=None, solicit_targets=(), session=None):
         self.server_address = None
 
+        # Offers are collected in the background for the whole run, unless a fixed server_address is set
+        self.discovery = None
+        self.discovery_ttl = discovery_ttl
+        self.multicast_group = multicast_group  # group the servers also send their offers to, None: not joined
+        # where solicits go so servers answer at once: () every local subnet's broadcast, None don't solicit
+        self.solicit_targets = solicit_targets
+        self.select = select
+        # Download (the server sends), upload (the client sends) or both at once over separate connections
+        self.direction = direction
+        # Connections every size-bounded TCP download is split over as byte ranges, 1 leaves them whole
+        self.stripes = stripes
+        # Pool mode of the persistent sessions (see session.py), None runs every round without one
+        self.session_mode = session
+        self.sessions = {}  # server IP -> its open ClientSession
+
+        # UDP pacing asked from the server, 0 leaves the choice to the server
+        self.udp_rate = udp_rate
+        self.udp_payload_size = udp_payload_size
+        self.udp_io = udp_io
+        self.timestamps = timestamps
+
+        # Payload the downloads ask for (None: the server's) and the uploads send, see payloads.py. Verifying
+        # checks a CRC32 per UDP segment and per TCP chunk, it names the payload so both ends use the same one
+        self.payload = payload or (PAYLOAD_CONSTANT if verify else None)
+        self.payload_seed = payload_seed if self.payload == PAYLOAD_RANDOM else DEFAULT_SEED
+        self.pattern = load_pattern(self.payload or PAYLOAD_CONSTANT, self.payload_seed,
+                                    payload_file if self.payload == PAYLOAD_FILE else None)
+        self.verify = verify
+        # NACK the lost segments so the server retransmits them, for size-bounded transfers
+        self.reliable = reliable
+
+        # Interval reports of every round, off when no interval is given
+        self.report_interval = report_interval
+        self.report_file = report_file
+
+        # Receive path tuning: the user space buffer of a TCP connection and the kernel SO_RCVBUF (None keeps the default)
+        self.tcp_buffer_size = tcp_buffer_size
+        self.receive_buffer = receive_buffer
+        # TCP tuning profile both ends apply to every connection, see tcp_tuning.py, None leaves it to the server
+        self.tcp_profile = tcp_profile
+
+        # Time-bounded transfers: who ends them and the warm-up seconds left out of the steady-state speed
+        # (None leaves out DEFAULT_OMIT_FRACTION of the duration)
+        self.stop_by = stop_by
+        self.omit = omit
+
+        # --profile: stage timings of the receive loops and sampled stacks or cProfile stats, None when off
+        self.profiler = profiler
+
+        # Path prefix of the (segment, arrival_ns) logs of every UDP transfer, see capture.py, None when off
+        self.capture = capture
+        self.capture_numbers = itertools.count(1)
+
     def listen_for_offers(self):
-        """Listens for server offer messages via UDP broadcast."""
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.udp_socket.bind(("", UDP_BROADCAST_PORT))
-        print("\033[95m" +"Client started, listening for offer requests..." + "\033[0m")
+        """Picks the least loaded server that sent offers via UDP broadcast. The first call starts the background
+        discovery and solicits offers until one comes, later calls return at once while a server is known."""
+        if self.discovery is None:
+            self.discovery = DiscoveryService(
+                MAGIC_COOKIE, OFFER_MESSAGE_TYPE, UDP_BROADCAST_PORT, self.discovery_ttl, self.multicast_group,
+                None if self.solicit_targets is None else list(self.solicit_targets),
+            )
+            self.discovery.start()
+            print("\033[95m" +"Client started, listening for offer requests..." + "\033[0m")
 
         while True:
-            data, addr = self.udp_socket.recvfrom(BUFFER_SIZE)
-            cookie, message_type = struct.unpack('!IB', data[:5])
-            if cookie == MAGIC_COOKIE and message_type == OFFER_MESSAGE_TYPE:
-                udp_port, tcp_port = struct.unpack('!HH', data[5:9])
-                self.server_address = (addr[0], udp_port, tcp_port)
-                print("\033[95m" + f"Received offer from {addr[0]}"+ "\033[0m")
+            self.discovery.discover(1)
+            server = self.discovery.registry.least_loaded()
+            if server:  # None when the only server expired in between
+                self.server_address = server.address
                 return
 
-    def send_udp_request(self, file_size, index):
-        """Sends a UDP request to the server and measures the speed."""
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.settimeout(1)  # Independent socket per thread
+    def select_servers(self):
+        """Addresses the next round tests: the fixed server_address, or by the select mode from the servers
+        discovered so far, or the servers of the open sessions"""
+        if self.discovery is None and self.server_address is not None:
+            return [self.server_address]
+        if self.sessions:
+            return [session.server_address for session in self.sessions.values()]  # no discovery while they last
+        self.listen_for_offers()
+        if self.select == SELECT_ALL:
+            return [server.address for server in self.discovery.registry.servers()] or [self.server_address]
+        return [self.server_address]
 
-        udp_port = self.server_address[1]
-        server_udp_address = (self.server_address[0], udp_port)
+    def steady_state_window(self, duration):
+        """Window for the steady-state speed of a transfer, nothing is omitted from size-bounded transfers
+        unless an explicit omit is configured"""
+        if self.omit is not None:
+            return SteadyStateWindow(self.omit)
+        return SteadyStateWindow(duration * DEFAULT_OMIT_FRACTION if duration else 0)
 
-        request_packet = struct.pack('!IBQ', MAGIC_COOKIE, REQUEST_MESSAGE_TYPE, file_size)
-        udp_socket.sendto(request_packet, (server_udp_address))
+    @contextmanager
+    def data_socket(self, server_address, key, open_socket, *args):
+        """The (socket, extra) of a transfer: the idle one the session with the server kept for key, or a new one
+        from open_socket(*args). The transfer calls keep() once it ended cleanly to hand it back to the pool, otherwise
+        it is closed when the block exits."""
+        session = self.sessions.get(server_address[0])
+        entry = None
+        if session:
+            entry = session.pool.take(key, tcp_usable if key[0] == "tcp" else drain_datagrams)
+        if entry is None:
+            entry = open_socket(*args)
+        kept = []
+        try:
+            yield entry, lambda: kept.append(True)
+        finally:
+            if kept and session:
+                session.pool.put(key, entry)
+            else:
+                entry[0].close()
 
-        start_time = time.time()
-        total_bytes = 0
-        received_segments = []
-        total_segments = None  # To be updated when the first packet is received
+    def keepalive(self, server_address, duration):
+        """Whether a TCP transfer asks the server to keep its connection for the next round's, only size-bounded
+        transfers of a warm session do"""
+        session = self.sessions.get(server_address[0])
+        return session is not None and session.pool.warm and duration is None
 
-        while True:
-            try:
-                data, _ = udp_socket.recvfrom(BUFFER_SIZE)
-
-                if len(data) > 20:
-                    cookie, message_type, total_segments_in_packet, segment_number = struct.unpack('!IBQQ', data[:21])
-                    if cookie == MAGIC_COOKIE and message_type == PAYLOAD_MESSAGE_TYPE:
-                        if total_segments is None:
-                            total_segments = total_segments_in_packet  # Set total segments from the first packet
-                        total_bytes += len(data) - 21
-                        received_segments.append(segment_number)
-                        # print(f"Received segment {segment_number + 1}/{total_segments_in_packet}")
-            except socket.timeout:
-                break
+    def open_tcp_socket(self, server_address, receive_buffer=True):
+        """A TCP connection to the server with the tuning profile (and the receive buffer) applied before
+        connecting, and the profile settings the platform refused"""
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # before connecting so the window scale is negotiated for the buffers, --receive-buffer wins
+            errors = apply_profile(tcp_socket, self.tcp_profile)["errors"] if self.tcp_profile else []
+            if receive_buffer:
+                self.set_receive_buffer(tcp_socket)
+            tcp_socket.connect((server_address[0], server_address[2]))
+        except BaseException:
+            tcp_socket.close()
+            raise
+        return tcp_socket, errors
 
-        elapsed_time = time.time() - start_time
-        udp_socket.close()
+    def open_udp_socket(self, receiver=True):
+        """A UDP socket with the receive buffer applied and the batch receiver reading it, uploads only send"""
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if not receiver:
+            return udp_socket, None
+        self.set_receive_buffer(udp_socket)
+        # receives into preallocated slots, sized for any datagram since the server may send jumbo payloads
+        return udp_socket, BatchReceiver(udp_socket, use_gro=self.udp_io == UDP_IO_BATCH)
 
-        received_percentage = (len(received_segments) / total_segments * 100) if total_segments else 0
-        speed = (total_bytes * 8 / elapsed_time) if elapsed_time > 0 else "too fast"
+    def send_udp_request(self, file_size, index, counter=None, duration=None, server_address=None):
+        """Sends a UDP request to the server (server_address by default), measures the speed and returns the
+        results of the transfer. With a duration the server streams for that many seconds, file_size 0 then
+        means no size bound."""
+        server_address = server_address or self.server_address
+        counter = counter or IntervalCounter(f"udp#{index}")
+        reliable = self.reliable and not duration
+        # Independent socket per thread (or the one this connection had last round), see data_socket()
+        key = ("udp", DIRECTION_DOWNLOAD, index)
+        with self.data_socket(server_address, key, self.open_udp_socket) as (connection, keep):
+            udp_socket, receiver = connection
+            # a reliable transfer wakes up to send its feedback
+            udp_socket.settimeout(FEEDBACK_INTERVAL if reliable else 1)
+            udp_port = server_address[1]
+            server_udp_address = (server_address[0], udp_port)
+
+            flags = (FLAG_TIMESTAMPS if self.timestamps else 0) | (FLAG_RELIABLE if reliable else 0)
+            request_packet = self.udp_request_packet(REQUEST_MESSAGE_TYPE, file_size, duration, flags)
+            steady_state = self.steady_state_window(duration)
+            timer = TransferTimer(time.perf_counter_ns())
+            udp_socket.sendto(request_packet, (server_udp_address))
+
+            tracker = None  # Created when the first packet tells the total number of segments
+            feedback = None  # NACK state of a reliable transfer, created with the tracker
+            payload_size = 0
+            last_arrival = time.perf_counter()
+            stages = self.profiler.stages if self.profiler else None
+            receive_ns = 0
+            arrival_log = ArrivalLog() if self.capture else None
+            capture = arrival_log.record if arrival_log else None
+            verify = self.verify
+            checksums = None  # CRC32 of every payload window, looked up once the payload size is known
+            corrupt_segments = 0
+
+            while True:
+                try:
+                    if stages:
+                        receive_ns = time.perf_counter_ns()
+                    datagrams = receiver.receive()
+                    arrival_ns = time.perf_counter_ns()  # a GRO batch arrived at once
+                    batch_bytes = counter.bytes
+                    for data in datagrams:
+                        if tracker is None and data[:5] == REJECT_PREFIX:
+                            reason = bytes(data[5:]).decode(errors="replace")
+                            raise ConnectionRefusedError(f"rejected by the server: {reason}")
+                        if len(data) > 20:
+                            cookie, message_type, total_segments_in_packet, segment_number = struct.unpack_from('!IBQQ', data)
+                            if cookie == MAGIC_COOKIE and message_type in PAYLOAD_HEADER_SIZES:
+                                if tracker is None:
+                                    # Sized from the first packet, time-bounded transfers announce 0 segments
+                                    tracker = ReceiveTracker(total_segments_in_packet or None)
+                                    record = tracker.record
+                                    if reliable and tracker.bounded:
+                                        feedback = ReliableReceiver(MAGIC_COOKIE, tracker)
+                                        record = feedback.record
+                                header_size = PAYLOAD_HEADER_SIZES[message_type]
+                                payload_size = len(data) - header_size
+                                counter.bytes += payload_size
+                                counter.packets += 1
+                                record(segment_number)
+                                if verify:
+                                    if checksums is None:
+                                        checksums = self.pattern.windows(payload_size)[1]
+                                    if zlib.crc32(data[header_size:]) != checksums[segment_number % len(checksums)]:
+                                        corrupt_segments += 1
+                                if capture:
+                                    capture(segment_number, arrival_ns)
+                                if message_type == TIMESTAMPED_PAYLOAD_MESSAGE_TYPE:
+                                    timer.record(arrival_ns, struct.unpack_from('!Q', data, 21)[0])
+                                else:
+                                    timer.record(arrival_ns)
+                                # print(f"Received segment {segment_number + 1}/{total_segments_in_packet}")
+                    steady_state.record(arrival_ns, counter.bytes - batch_bytes)
+                    if stages:
+                        # recv includes the wait for the datagrams, parse is the header parsing and accounting
+                        stages.add("recv", arrival_ns - receive_ns, len(datagrams))
+                        stages.add("parse", time.perf_counter_ns() - arrival_ns, len(datagrams))
+                    last_arrival = arrival_ns / 1e9
+                    if feedback:
+                        if feedback.complete:
+                            for _ in range(DONE_REPEATS):
+                                udp_socket.sendto(feedback.feedback(), server_udp_address)
+                            break
+                        if feedback.feedback_due():
+                            udp_socket.sendto(feedback.feedback(), server_udp_address)
+                    elif tracker is not None and tracker.bounded and tracker.unique >= tracker.total_segments:
+                        break  # every segment is in, waiting for the idle timeout would only add late duplicates
+                except socket.timeout:
+                    idle = time.perf_counter() - last_arrival
+                    if tracker is None and idle < FIRST_SEGMENT_TIMEOUT:
+                        continue  # the request may still be queued behind the server's other transfers
+                    if not reliable or idle > IDLE_TIMEOUT:
+                        break
+                    if feedback:
+                        udp_socket.sendto(feedback.feedback(), server_udp_address)
+            keep()
+
+        summary = tracker.summary() if tracker else ReceiveTracker(0).summary()
+        if arrival_log:
+            capture_path = f"{self.capture}.{next(self.capture_numbers):04d}.udp{index}"
+            arrival_log.save(capture_path, server=server_address[0], file_size=file_size, duration=duration,
+                             payload_size=payload_size, request_ns=timer.request_ns,
+                             total_segments=tracker.total_segments if tracker and tracker.bounded else None)
+            print("\033[95m" + f"UDP transfer #{index} arrivals captured to {capture_path}.*, analyze them with "
+                  f"python capture.py {capture_path}" + "\033[0m")
+        timing = timer.summary()
+        # the idle timeout that ended the loop is not part of the transfer, speeds use the first to last packet window
+        elapsed_time = timing["elapsed"] or 0
+        window = timing["window"]
+        packet_rate = (summary["received"] / window) if window else 0
+        time_to_first_byte = f"{timing['time_to_first_byte'] * 1000:.3f} ms" if timing["time_to_first_byte"] is not None else "-"
+        jitter = f"{timing['jitter'] * 1000:.3f} ms" if timing["jitter"] is not None else "-"
+        steady_speed = steady_state.bits_per_second()
+        # useful bytes over the whole transfer, duplicates and retransmissions of the same segment count once
+        goodput = (min(file_size or float("inf"), summary["unique"] * payload_size) * 8 / elapsed_time
+                   if elapsed_time else None)
 
         print("\033[0;32m" + f"UDP transfer #{index} finished, total time: {elapsed_time:.2f} seconds, "
-              f"speed: {speed:.2f} bits/second, percentage received: {received_percentage:.2f}%" + "\033[0m")
+              f"speed: {format_speed(counter.bytes, window)}, {packet_rate:.0f} packets/second, "
+              f"percentage received: {summary['received_percentage']:.2f}%" + "\033[0m")
+        print("\033[0;32m" + f"UDP transfer #{index} time to first byte: {time_to_first_byte}, "
+              f"jitter: {jitter}, steady-state speed: "
+              f"{f'{steady_speed:.2f} bits/second' if steady_speed is not None else '-'}" + "\033[0m")
+        print("\033[0;32m" + f"UDP transfer #{index} duplicates: {summary['duplicates']}, "
+              f"out of order: {summary['out_of_order']} (max distance {summary['max_reorder_distance']}), "
+              f"loss bursts: {summary['loss_bursts']} (longest {summary['longest_loss_burst']})" + "\033[0m")
+        verification = {}
+        if verify:
+            verification = {"verified_segments": counter.packets, "corrupt_segments": corrupt_segments}
+            print("\033[0;32m" + f"UDP transfer #{index} {self.payload} payload verified: {counter.packets} "
+                  f"segments, corrupt: {corrupt_segments}" + "\033[0m")
+        reliability = feedback.summary() if feedback else {}
+        if reliable:
+            print("\033[0;32m" + f"UDP transfer #{index} {'completed' if reliability.get('complete') else 'incomplete'} "
+                  f"in {elapsed_time:.2f} seconds, goodput: "
+                  f"{f'{goodput:.2f} bits/second' if goodput is not None else '-'}, retransmission overhead: "
+                  f"{reliability.get('retransmission_overhead', 0):.2f}%, NACKed segments: "
+                  f"{reliability.get('nacked_segments', 0)} (recovered {reliability.get('recovered', 0)})" + "\033[0m")
 
-    def send_tcp_request(self, file_size, index):
-        """Sends a TCP request to the server and measures the speed."""
-        tcp_port = self.server_address[2]
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-            tcp_socket.connect((self.server_address[0], tcp_port))
-            tcp_socket.sendall(f"{file_size}\n".encode())
+        return dict(
+            protocol="udp", direction=DIRECTION_DOWNLOAD, index=index, bytes=counter.bytes, elapsed=elapsed_time,
+            bits_per_second=counter.bytes * 8 / window if window else None, packets_per_second=packet_rate,
+            steady_bits_per_second=steady_speed, duration=duration, reliable=reliable,
+            goodput_bits_per_second=goodput, completion_time=elapsed_time,
+            payload=self.payload, **summary, **reliability, **verification,
+            **{key: value for key, value in timing.items() if key != "elapsed"},
+        )
 
-            start_time = time.time()
-            total_bytes = 0
+    def udp_request_packet(self, message_type, file_size, duration, flags):
+        """A download or upload request, with the options tail only when something asks for more than the
+        server's defaults"""
+        request_packet = struct.pack('!IBQ', MAGIC_COOKIE, message_type, file_size)
+        if self.udp_rate or self.udp_payload_size or flags or duration or self.payload:
+            request_packet += struct.pack(REQUEST_OPTIONS_FORMAT, self.udp_rate, self.udp_payload_size, flags)
+        if duration or self.payload:
+            request_packet += struct.pack(REQUEST_DURATION_FORMAT, max(1, round(duration * 1000)) if duration else 0)
+        if self.payload:
+            request_packet += struct.pack(REQUEST_PAYLOAD_FORMAT, PAYLOAD_IDS[self.payload], self.payload_seed)
+        return request_packet
 
-            while True:
-                data = tcp_socket.recv(BUFFER_SIZE)
-                if not data:
+    def send_udp_upload(self, file_size, index, counter=None, duration=None, server_address=None):
+        """Uploads file_size bytes (or for duration seconds, file_size 0 then means no size bound) as UDP
+        segments to the server and returns the results, with the server's own figures of what arrived. The
+        server answers the request with the rate and payload size to send with."""
+        server_address = server_address or self.server_address
+        counter = counter or IntervalCounter(f"udp#{index} up")
+        server_udp_address = (server_address[0], server_address[1])
+        flags = FLAG_TIMESTAMPS if self.timestamps else 0
+        message_type = TIMESTAMPED_PAYLOAD_MESSAGE_TYPE if self.timestamps else PAYLOAD_MESSAGE_TYPE
+        stages = self.profiler.stages if self.profiler else None
+
+        key = ("udp", DIRECTION_UPLOAD, index)
+        with self.data_socket(server_address, key, self.open_udp_socket, False) as (connection, keep):
+            udp_socket = connection[0]
+            # the request may wait in the server's admission queue before it is ready
+            udp_socket.settimeout(FIRST_SEGMENT_TIMEOUT)
+            request_ns = time.perf_counter_ns()
+            udp_socket.sendto(self.udp_request_packet(UPLOAD_REQUEST_MESSAGE_TYPE, file_size, duration, flags),
+                              server_udp_address)
+            ready = self.receive_upload_message(udp_socket, UPLOAD_READY_MESSAGE_TYPE)
+            _, _, rate, payload_size = UPLOAD_READY.unpack_from(ready)
+
+            datagram_size = PAYLOAD_HEADER_SIZES[message_type] + payload_size
+            sender = BatchSender(udp_socket, server_udp_address, datagram_size, use_gso=self.udp_io == UDP_IO_BATCH)
+            pacer = TokenBucket(rate, datagram_size * PACING_BURST_PACKETS) if rate else None
+            batch_size = min(sender.batch_size, PACING_BURST_PACKETS) if pacer else sender.batch_size
+            # a time-bounded upload of size 0 announces 0 segments, like the server's downloads
+            total_segments = ((file_size + payload_size - 1) // payload_size
+                              if duration is None or file_size else None)
+            payloads = None if self.pattern.constant else self.pattern.windows(payload_size)[0]
+            builder = PacketBuilder(MAGIC_COOKIE, message_type, total_segments or 0, payload_size, batch_size,
+                                    timestamped=self.timestamps, payloads=payloads)
+            start_ns = time.perf_counter_ns()
+            stop_ns = start_ns + int(duration * 1e9) if duration else None
+            segment = 0
+            while total_segments is None or segment < total_segments:
+                if stop_ns is not None and time.perf_counter_ns() >= stop_ns:
                     break
-                total_bytes += len(data)
+                count = batch_size if total_segments is None else min(batch_size, total_segments - segment)
+                if pacer:
+                    pacer.consume(count * datagram_size)
+                if stages:
+                    send_ns = time.perf_counter_ns()
+                    sender.send(builder.build(segment, count))
+                    stages.add("udp_send", time.perf_counter_ns() - send_ns, count)
+                else:
+                    sender.send(builder.build(segment, count))
+                segment += count
+                counter.bytes += count * payload_size
+                counter.packets += count
+            end_ns = time.perf_counter_ns()
+
+            udp_socket.settimeout(UPLOAD_RESULT_TIMEOUT)
+            server_result = parse_result(self.receive_upload_message(udp_socket, UPLOAD_RESULT_MESSAGE_TYPE))
+            keep()
+
+        elapsed_time = (end_ns - start_ns) / 1e9
+        packet_rate = counter.packets / elapsed_time if elapsed_time else 0
+        server_speed = server_result["bits_per_second"]
+        print("\033[0;32m" + f"UDP upload #{index} finished, total time: {elapsed_time:.2f} seconds, "
+              f"speed: {format_speed(counter.bytes, elapsed_time)}, {packet_rate:.0f} packets/second, "
+              f"time to ready: {(start_ns - request_ns) / 1e6:.3f} ms" + "\033[0m")
+        print("\033[0;32m" + f"UDP upload #{index} server measured: "
+              f"{f'{server_speed:.2f} bits/second' if server_speed is not None else '-'}, "
+              f"percentage received: {server_result['received_percentage']:.2f}%, "
+              f"out of order: {server_result['out_of_order']}, loss bursts: {server_result['loss_bursts']} "
+              f"(longest {server_result['longest_loss_burst']})" + "\033[0m")
+        return dict(
+            protocol="udp", direction=DIRECTION_UPLOAD, index=index, bytes=counter.bytes, elapsed=elapsed_time,
+            bits_per_second=counter.bytes * 8 / elapsed_time if elapsed_time else None,
+            packets_per_second=packet_rate, duration=duration, rate=rate, payload_size=payload_size,
+            server_result=server_result,
+        )
 
-            elapsed_time = time.time() - start_time
-            if not elapsed_time:
-                print("\033[0;32m" + f"TCP transfer #{index} finished, total time: {elapsed_time:.2f} seconds, speed: too fast to calculate" + "\033[0m")
+    @staticmethod
+    def receive_upload_message(udp_socket, message_type):
+        """Waits for the server's message of message_type about an upload, skipping the repeats of earlier
+        ones. Raises ConnectionRefusedError when the upload was turned down, socket.timeout when nothing came."""
+        while True:
+            data = udp_socket.recv(MAX_DATAGRAM_SIZE)
+            if data[:5] == REJECT_PREFIX:
+                raise ConnectionRefusedError(f"rejected by the server: {data[5:].decode(errors='replace')}")
+            if len(data) >= 5 and struct.unpack_from('!IB', data) == (MAGIC_COOKIE, message_type):
+                return data
+
+    def set_receive_buffer(self, sock):
+        """Applies the configured SO_RCVBUF, the kernel may clamp it to net.core.rmem_max"""
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def send_tcp_request(self, file_size, index, counter=None, duration=None, server_address=None, offset=0):
+        """Sends a TCP request to the server (server_address by default), measures the speed and returns the
+        results of the transfer. With a duration the transfer streams for that many seconds, file_size 0 then
+        means no size bound. An offset asks for the file_size bytes from that far into the transfer, one stripe
+        of a striped transfer."""
+        server_address = server_address or self.server_address
+        counter = counter or IntervalCounter(f"tcp#{index}")
+        # Preallocated per connection, recv_into fills it in place instead of allocating a bytes object per chunk
+        buffer = memoryview(bytearray(self.tcp_buffer_size))
+        keepalive = self.keepalive(server_address, duration)
+        key = ("tcp", DIRECTION_DOWNLOAD, index)
+        with self.data_socket(server_address, key, self.open_tcp_socket, server_address) as (connection, keep):
+            tcp_socket, errors = connection
+            settings = dict(socket_settings(tcp_socket), errors=errors)
+            steady_state = self.steady_state_window(duration)
+            timer = TransferTimer(time.perf_counter_ns())
+            if duration is None:
+                request = f"{file_size}"
+            elif self.stop_by == STOP_BY_CLIENT:
+                request = f"{file_size} {TIME_KEY}=inf"
             else:
-                print("\033[0;32m" + f"TCP transfer #{index} finished, total time: {elapsed_time:.2f} seconds, speed: {total_bytes * 8 / elapsed_time:.2f} bits/second" + "\033[0m")
+                request = f"{file_size} {TIME_KEY}={duration}"
+            if self.tcp_profile:
+                request += f" {PROFILE_KEY}={self.tcp_profile}"
+            if offset:
+                request += f" {OFFSET_KEY}={offset}"
+            if self.payload:
+                request += f" {PAYLOAD_KEY}={self.payload}:{self.payload_seed}"
+            if keepalive:
+                request += f" {KEEPALIVE_KEY}=1"
+            tcp_socket.sendall(f"{request} {STATUS_KEY}=1\n".encode())
+            self.read_status(tcp_socket)
+            verifier = StreamVerifier(self.pattern, offset) if self.verify else None
+            # the client's own deadline when it ends the transfer by closing the connection
+            stop_ns = (timer.request_ns + int(duration * 1e9)
+                       if duration is not None and self.stop_by == STOP_BY_CLIENT else None)
+            stages = self.profiler.stages if self.profiler else None
+            receive_ns = 0
+
+            while True:
+                if stages:
+                    receive_ns = time.perf_counter_ns()
+                received = tcp_socket.recv_into(buffer)
+                if not received:
+                    break
+                arrival_ns = time.perf_counter_ns()
+                if stages:
+                    stages.add("tcp_recv", arrival_ns - receive_ns)
+                if verifier:
+                    verifier.update(buffer[:received])
+                    if stages:
+                        stages.add("tcp_verify", time.perf_counter_ns() - arrival_ns)
+                timer.record(arrival_ns)
+                steady_state.record(arrival_ns, received)
+                counter.bytes += received
+                counter.packets += 1
+                if stop_ns is not None and arrival_ns >= stop_ns:
+                    break
+                if keepalive and counter.bytes >= file_size:
+                    keep()  # the server reads the next request instead of closing, the connection goes back
+                    break
+
+            timing = timer.summary()
+            elapsed_time = timing["elapsed"] or 0
+            time_to_first_byte = f"{timing['time_to_first_byte'] * 1000:.3f} ms" if timing["time_to_first_byte"] is not None else "-"
+            steady_speed = steady_state.bits_per_second()
+            print("\033[0;32m" + f"TCP transfer #{index} finished, total time: {elapsed_time:.2f} seconds, "
+                  f"speed: {format_speed(counter.bytes, elapsed_time)}, time to first byte: {time_to_first_byte}, "
+                  f"steady-state speed: {f'{steady_speed:.2f} bits/second' if steady_speed is not None else '-'}, "
+                  f"profile: {self.tcp_profile or 'server default'} ({settings['congestion'] or '-'})" + "\033[0m")
+            verification = verifier.summary() if verifier else {}
+            if verifier:
+                print("\033[0;32m" + f"TCP transfer #{index} {self.payload} payload verified: "
+                      f"{verification['verified_chunks']} chunks, corrupt: {verification['corrupt_chunks']}"
+                      + "\033[0m")
+
+        return dict(
+            protocol="tcp", direction=DIRECTION_DOWNLOAD, index=index, bytes=counter.bytes, elapsed=elapsed_time,
+            bits_per_second=counter.bytes * 8 / elapsed_time if elapsed_time else None,
+            time_to_first_byte=timing["time_to_first_byte"], steady_bits_per_second=steady_speed, duration=duration,
+            tcp_profile=self.tcp_profile, tcp_settings=settings, payload=self.payload, **verification,
+        )
+
+    def send_striped_tcp_request(self, file_size, index, counters=None, duration=None, server_address=None):
+        """Downloads one logical transfer of file_size bytes as byte ranges over parallel connections, one per
+        stripe, and returns its results: the goodput of the whole transfer up to the completion of its last
+        stripe, the skew between the first and the last stripe to complete and every stripe's own figures.
+        counters holds an interval counter per stripe, a striped transfer is always size-bounded. The transfer
+        fails when any of its stripes does."""
+        ranges = stripe_ranges(file_size, self.stripes)
+        stripe_results = [None] * len(ranges)
+        finished_ns = [None] * len(ranges)
+        errors = []
+
+        def run_stripe(stripe, offset, length):
+            counter = counters[stripe] if counters else None
+            try:
+                stripe_results[stripe] = self.send_tcp_request(length, f"{index}.{stripe + 1}", counter, None,
+                                                               server_address, offset)
+                finished_ns[stripe] = time.perf_counter_ns()
+            except Exception as e:
+                errors.append(e)
+
+        start_ns = time.perf_counter_ns()
+        threads = [threading.Thread(target=run_stripe, args=(stripe, offset, length))
+                   for stripe, (offset, length) in enumerate(ranges)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        completion_time = (max(finished_ns) - start_ns) / 1e9
+        skew = (max(finished_ns) - min(finished_ns)) / 1e9
+        total_bytes = sum(result["bytes"] for result in stripe_results)
+        speeds = [result["bits_per_second"] for result in stripe_results if result["bits_per_second"]]
+        print("\033[0;32m" + f"TCP striped transfer #{index} finished over {len(ranges)} streams, time until the last "
+              f"stripe completed: {completion_time:.2f} seconds, goodput: {format_speed(total_bytes, completion_time)}, "
+              f"stripe skew: {skew * 1000:.3f} ms, stripe speeds: "
+              f"{min(speeds, default=0):.2f}-{max(speeds, default=0):.2f} bits/second" + "\033[0m")
+        return dict(
+            protocol="tcp", direction=DIRECTION_DOWNLOAD, index=index, bytes=total_bytes, elapsed=completion_time,
+            bits_per_second=total_bytes * 8 / completion_time if completion_time else None,
+            goodput_bits_per_second=total_bytes * 8 / completion_time if completion_time else None,
+            completion_time=completion_time, duration=None, stripes=len(ranges), stripe_skew=skew,
+            tcp_profile=self.tcp_profile, payload=self.payload,
+            **({"verified_chunks": sum(result["verified_chunks"] for result in stripe_results),
+                "corrupt_chunks": sum(result["corrupt_chunks"] for result in stripe_results)} if self.verify else {}),
+            stripe_results=[dict(result, offset=offset, completion_time=(finished - start_ns) / 1e9)
+                            for result, (offset, _), finished in zip(stripe_results, ranges, finished_ns)],
+        )
+
+    def send_tcp_upload(self, file_size, index, counter=None, duration=None, server_address=None):
+        """Uploads file_size bytes (or for duration seconds, file_size 0 then means no size bound) over TCP and
+        returns the results, with the server's own figures of the transfer. The client always ends a
+        time-bounded upload, by shutting its side of the connection down at the deadline."""
+        server_address = server_address or self.server_address
+        counter = counter or IntervalCounter(f"tcp#{index} up")
+        # the sends are slices of the payload's pattern, at most the receive buffer's size each
+        pattern = self.pattern
+        position = 0  # offset of the next send in the pattern
+        limit = file_size if duration is None or file_size else float("inf")
+        stages = self.profiler.stages if self.profiler else None
+        keepalive = self.keepalive(server_address, duration)
+        key = ("tcp", DIRECTION_UPLOAD, index)
+        with self.data_socket(server_address, key, self.open_tcp_socket, server_address, False) as (connection, keep):
+            tcp_socket, errors = connection
+            settings = dict(socket_settings(tcp_socket), errors=errors)
+            request = f"{file_size}" if duration is None else f"{file_size} {TIME_KEY}={duration}"
+            if self.tcp_profile:
+                request += f" {PROFILE_KEY}={self.tcp_profile}"
+            if keepalive:
+                request += f" {KEEPALIVE_KEY}=1"
+            start_ns = time.perf_counter_ns()
+            stop_ns = start_ns + int(duration * 1e9) if duration is not None else None
+            try:
+                tcp_socket.sendall(f"{request} {DIRECTION_KEY}={DIRECTION_UPLOAD}\n".encode())
+                while counter.bytes < limit:
+                    if stop_ns is not None and time.perf_counter_ns() >= stop_ns:
+                        break
+                    chunk = min(self.tcp_buffer_size, pattern.size - position, limit - counter.bytes)
+                    if stages:
+                        send_ns = time.perf_counter_ns()
+                        tcp_socket.sendall(pattern.view[position:position + chunk])
+                        stages.add("tcp_send", time.perf_counter_ns() - send_ns)
+                    else:
+                        tcp_socket.sendall(pattern.view[position:position + chunk])
+                    position = (position + chunk) % pattern.size
+                    counter.bytes += chunk
+                    counter.packets += 1
+                end_ns = time.perf_counter_ns()
+                if not keepalive:
+                    tcp_socket.shutdown(socket.SHUT_WR)
+            except (BrokenPipeError, ConnectionResetError):
+                # a turned down upload is closed while the client still sends, its reason may still be readable
+                try:
+                    reply = self.read_line(tcp_socket)
+                except OSError:
+                    reply = ""
+                if reply.startswith(TCP_REJECTION_PREFIX.decode()):
+                    raise ConnectionRefusedError(f"rejected by the server: {reply[len(TCP_REJECTION_PREFIX):]}")
+                raise
+            reply = self.read_line(tcp_socket)
+            if keepalive and reply.startswith(TCP_RESULT_PREFIX):
+                keep()
+        if reply.startswith(TCP_REJECTION_PREFIX.decode()):
+            raise ConnectionRefusedError(f"rejected by the server: {reply[len(TCP_REJECTION_PREFIX):]}")
+        if not reply.startswith(TCP_RESULT_PREFIX):
+            raise ConnectionError(f"no upload result from the server: {reply!r}")
+        server_result = json.loads(reply[len(TCP_RESULT_PREFIX):])
+
+        elapsed_time = (end_ns - start_ns) / 1e9
+        server_speed = server_result["bits_per_second"]
+        print("\033[0;32m" + f"TCP upload #{index} finished, total time: {elapsed_time:.2f} seconds, "
+              f"speed: {format_speed(counter.bytes, elapsed_time)}, server measured: "
+              f"{f'{server_speed:.2f} bits/second' if server_speed is not None else '-'} for "
+              f"{server_result['bytes']} bytes, profile: {self.tcp_profile or 'server default'} "
+              f"({settings['congestion'] or '-'})" + "\033[0m")
+        return dict(
+            protocol="tcp", direction=DIRECTION_UPLOAD, index=index, bytes=counter.bytes, elapsed=elapsed_time,
+            bits_per_second=counter.bytes * 8 / elapsed_time if elapsed_time else None, duration=duration,
+            tcp_profile=self.tcp_profile, tcp_settings=settings, server_result=server_result,
+        )
+
+    @staticmethod
+    def read_line(tcp_socket):
+        """One reply line of the server, without its newline"""
+        line = b""
+        while not line.endswith(b"\n"):
+            data = tcp_socket.recv(BUFFER_SIZE)
+            if not data:
+                break
+            line += data
+        return line.decode(errors="replace").strip()
+
+    @staticmethod
+    def read_status(tcp_socket):
+        """Reads the status line the server answers a download request with before the payload, exactly that
+        line so the payload stays in the socket. Raises ConnectionRefusedError when the server turned the request
+        down, it closes the connection after its line. Servers from before status lines ignore "status=1" and
+        send the payload right away: first bytes that start neither status line are left in the socket as payload
+        (from such a server a payload that starts with one of them is misread, as it always was)."""
+        peeked = tcp_socket.recv(len(TCP_STATUS_OK), socket.MSG_PEEK | socket.MSG_WAITALL)
+        if not peeked:
+            raise ConnectionError("connection closed before the status line")
+        if peeked == TCP_STATUS_OK:
+            tcp_socket.recv(len(TCP_STATUS_OK))
+            return
+        if not TCP_REJECTION_PREFIX.startswith(peeked):
+            return  # the payload of an older server
+        if not tcp_socket.recv(len(TCP_REJECTION_PREFIX), socket.MSG_PEEK | socket.MSG_WAITALL).startswith(
+                TCP_REJECTION_PREFIX):
+            return
+        line = b""
+        while not line.endswith(b"\n"):
+            if len(line) > MAX_STATUS_LINE:
+                raise ConnectionError(f"status line longer than {MAX_STATUS_LINE} bytes")
+            peeked = tcp_socket.recv(MAX_STATUS_LINE, socket.MSG_PEEK)
+            if not peeked:
+                break
+            end = peeked.find(b"\n")
+            line += tcp_socket.recv(end + 1 if end >= 0 else len(peeked))
+        reason = line[len(TCP_REJECTION_PREFIX):].decode(errors="replace").strip()
+        raise ConnectionRefusedError(f"rejected by the server: {reason}")
 
     def start(self):
-        """Starts the client application."""
+        """Starts the interactive client application, asking for the parameters of every round."""
+        while True:
+            # Asking for the parameters
+            file_size = int(input("\033[33m" + "Enter file size (bytes): "+ "\033[0m"))
+            tcp_connections = int(input("\033[33m" + "Enter number of TCP connections: "+ "\033[0m"))
+            udp_connections = int(input("\033[33m" + "Enter number of UDP connections: " + "\033[0m"))
 
-        # Asking for thhe parameters
-        file_size = int(input("\033[33m" + "Enter file size (bytes): "+ "\033[0m"))
-        tcp_connections = int(input("\033[33m" + "Enter number of TCP connections: "+ "\033[0m"))
-        udp_connections = int(input("\033[33m" + "Enter number of UDP connections: " + "\033[0m"))
+            # Start listening for offers
+            self.listen_for_offers()
 
-        # Start listening for offers
-        self.listen_for_offers()
+            self.run_round(file_size, tcp_connections, udp_connections)
+
+            print("\033[1;34m"  + "All transfers complete, listening to offer requests..." + "\033[0m")
+
+    def run_plan(self, rounds):
+        """Runs the rounds of a test plan one after the other and yields a record per executed round, so long
+        unattended runs can stream their results. Every round tests the servers chosen by select_servers()."""
+        for round_number, test_round in enumerate(rounds, 1):
+            deadline = time.monotonic() + test_round["duration"] if test_round["duration"] is not None else None
+            iteration = 0
+            while iteration < test_round["repeat"] or (deadline is not None and time.monotonic() < deadline):
+                iteration += 1
+                servers = self.select_servers()
+                started = time.time()
+                start_time = time.perf_counter()
+                results = self.run_round(test_round["size"], test_round["tcp"], test_round["udp"], test_round["time"],
+                                         servers)
+                yield {
+                    "round": round_number,
+                    "iteration": iteration,
+                    "started": started,
+                    "elapsed": time.perf_counter() - start_time,
+                    "size": test_round["size"],
+                    "tcp": test_round["tcp"],
+                    "udp": test_round["udp"],
+                    "time": test_round["time"],
+                    "servers": [server[0] for server in servers],
+                    "direction": self.direction,
+                    "failed_transfers": ((test_round["tcp"] + test_round["udp"]) * self.transfers_per_connection
+                                         * len(servers) - len(results)),
+                    "sessions": {host: session.pool.summary() for host, session in self.sessions.items()},
+                    "results": results,
+                }
+
+    @property
+    def transfers_per_connection(self):
+        """A bidirectional connection is a download and an upload over connections of their own"""
+        return 2 if self.direction == DIRECTION_BIDIRECTIONAL else 1
 
-        # Open threads list to add all the udp and tcp connection asked
+    def run_round(self, file_size, tcp_connections, udp_connections, duration=None, servers=None):
+        """Runs the TCP and UDP transfers of one round in parallel against every server address in servers (the
+        current server by default) and returns the results of every transfer, TCP ones first. A duration makes
+        every transfer time-bounded, the direction decides whether they are downloads, uploads or both. With
+        sessions the round is negotiated with every server first, a server that turns it down is left out."""
+        servers = servers or [self.server_address]
+        if self.session_mode:
+            servers = self.begin_session_round(servers, file_size, tcp_connections, udp_connections, duration)
+
+        # Samples every connection of the round while the transfers run
+        reporter = None
+        if self.report_interval:
+            reporter = IntervalReporter(self.report_interval, self.report_file)
+            reporter.start()
+
+        # Open threads list to add all the udp and tcp connection asked, every thread stores its results in its own slot
         threads = []
+        connections = (tcp_connections + udp_connections) * self.transfers_per_connection
+        results = [None] * (connections * len(servers))
 
-        # Start TCP threads
-        for i in range(1, tcp_connections + 1):
-            thread = threading.Thread(target=self.send_tcp_request, args=(file_size, i))
-            threads.append(thread)
-            thread.start()
+        def run_transfer(send_request, slot, index, counter, server_address):
+            if self.profiler:
+                send_request = self.profiler.wrap(send_request)
+            try:
+                result = send_request(file_size, index, counter, duration, server_address)
+                result["server"] = server_address[0]
+                results[slot] = result
+            except Exception as e:
+                print("\033[91m" + f"Transfer #{index} to {server_address[0]} failed: {e}" + "\033[0m")
 
-        # Start UDP threads
-        for i in range(1, udp_connections + 1):
-            thread = threading.Thread(target=self.send_udp_request, args=(file_size, i))
+        def start_transfer(send_request, slot, index, name, server_address):
+            # counters are named after the server too when the round fans out
+            name = f"{server_address[0]} {name}" if len(servers) > 1 else name
+            if not reporter:
+                counter = None
+            elif send_request == self.send_striped_tcp_request:
+                # a counter per stripe, every counter is only written by its own connection's thread
+                counter = [reporter.register(f"{name}.{stripe}") for stripe in range(1, self.stripes + 1)]
+            else:
+                counter = reporter.register(name)
+            thread = threading.Thread(target=run_transfer, args=(send_request, slot, index, counter, server_address))
             threads.append(thread)
             thread.start()
 
+        # striping splits size-bounded downloads, time-bounded ones have no byte ranges to split
+        striped = self.stripes > 1 and duration is None
+        send_tcp_download = self.send_striped_tcp_request if striped else self.send_tcp_request
+        transfers = (("tcp", tcp_connections, send_tcp_download, self.send_tcp_upload),
+                     ("udp", udp_connections, self.send_udp_request, self.send_udp_upload))
+        for server_number, server_address in enumerate(servers):
+            slot = server_number * connections
+            # Start the TCP threads, then the UDP ones
+            for protocol, count, send_download, send_upload in transfers:
+                for i in range(1, count + 1):
+                    if self.direction != DIRECTION_UPLOAD:
+                        start_transfer(send_download, slot, i, f"{protocol}#{i}", server_address)
+                        slot += 1
+                    if self.direction != DIRECTION_DOWNLOAD:
+                        start_transfer(send_upload, slot, i, f"{protocol}#{i} up", server_address)
+                        slot += 1
+
         for thread in threads:
             thread.join()
 
-        print("\033[1;34m"  + "All transfers complete, listening to offer requests..." + "\033[0m")
-        
-        # Start all over again
-        self.start()
+        if reporter:
+            reporter.stop()
+
+        # TCP results first, in server order
+        results = [result for result in results if result is not None]
+        if self.session_mode:
+            self.end_session_round(servers, results, connections)
+        return sorted(results, key=lambda result: result["protocol"] != "tcp")
+
+    def begin_session_round(self, servers, file_size, tcp_connections, udp_connections, duration):
+        """Opens the sessions the servers don't have yet and negotiates the round on them, returns the servers
+        that accepted it. A server whose control connection failed is left out, its session is reopened when
+        a later round selects it again."""
+        accepted = []
+        for server_address in servers:
+            host = server_address[0]
+            while True:
+                reopened = host not in self.sessions
+                try:
+                    session = self.sessions.get(host)
+                    if session is None:
+                        session = ClientSession(server_address, self.session_mode)
+                        info = session.open()
+                        self.sessions[host] = session
+                        print("\033[95m" + f"Session #{info['session']} opened with {host}, "
+                              f"{self.session_mode} connections" + "\033[0m")
+                    session.begin_round(file_size, tcp_connections, udp_connections, duration, self.direction)
+                    accepted.append(server_address)
+                except ConnectionRefusedError as e:
+                    print("\033[91m" + f"Round not started on {host}: {e}" + "\033[0m")
+                except (OSError, ValueError) as e:
+                    self.close_session(host)
+                    if not reopened:
+                        continue  # e.g. the server restarted since the last round, once more with a new session
+                    print("\033[91m" + f"Session with {host} failed: {e}" + "\033[0m")
+                break
+        return accepted
+
+    def end_session_round(self, servers, results, connections):
+        """Tells every server of the round how many of its transfers completed"""
+        for server_address in servers:
+            host = server_address[0]
+            session = self.sessions.get(host)
+            if session is None:
+                continue
+            completed = sum(result["server"] == host for result in results)
+            try:
+                session.end_round(completed, connections - completed)
+            except (OSError, ValueError) as e:
+                print("\033[91m" + f"Session with {host} failed: {e}" + "\033[0m")
+                self.close_session(host)
+
+    def close_session(self, host):
+        session = self.sessions.pop(host, None)
+        if session is not None:
+            session.close()
+            return session.pool.summary()
+        return None
+
+    def close_sessions(self):
+        """Ends every open session, with the number of data connections they opened and reused"""
+        for host in list(self.sessions):
+            summary = self.close_session(host)
+            print("\033[95m" + f"Session with {host} closed, data connections opened: {summary['opened']}, "
+                  f"reused: {summary['reused']}" + "\033[0m")
 
 if __name__ == "__main__":
-    client = SpeedTestClient()
-    client.start()
+    parser = argparse.ArgumentParser(description="Speed test client")
+    parser.add_argument("--udp-rate", type=int, default=0,
+                        help="target bits/second for every UDP transfer, like iperf -b (0 uses the server default)")
+    parser.add_argument("--udp-payload-size", type=int, default=0,
+                        help="UDP payload bytes per datagram, up to the MTU or jumbo size (0 uses the server default)")
+    parser.add_argument("--udp-io", choices=UDP_IO_MODES, default=UDP_IO_BATCH,
+                        help="receive many UDP datagrams per syscall (falls back when unsupported) or one at a time")
+    parser.add_argument("--timestamps", action=argparse.BooleanOptionalAction, default=True,
+                        help="ask for timestamped UDP segments to measure jitter")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="print the throughput of every connection each INTERVAL seconds, e.g. 0.1 or 1")
+    parser.add_argument("--report-file", default=None,
+                        help="also stream the interval rows to this .csv or JSON lines (.jsonl) file")
+    parser.add_argument("--tcp-buffer-size", type=int, default=TCP_BUFFER_SIZE,
+                        help="bytes of the preallocated buffer every TCP connection receives into")
+    parser.add_argument("--receive-buffer", type=int, default=None,
+                        help="SO_RCVBUF bytes for the TCP and UDP sockets (default: leave it to the kernel)")
+    parser.add_argument("--direction", choices=DIRECTIONS, default=DIRECTION_DOWNLOAD,
+                        help="measure downloads, uploads (the server reports what it received) or both at once "
+                             "over separate connections; uploads are never --reliable")
+    parser.add_argument("--payload", choices=PAYLOAD_KINDS, default=None,
+                        help="payload the downloads ask for and the uploads send (default: the server's for "
+                             "downloads, constant for uploads)")
+    parser.add_argument("--payload-seed", type=int, default=DEFAULT_SEED, help="seed of the random payload")
+    parser.add_argument("--payload-file", default=None,
+                        help="local copy of the server's payload file, to verify or upload the file payload")
+    parser.add_argument("--verify", action="store_true",
+                        help="check a CRC32 of every UDP segment and TCP chunk of the downloads against the payload")
+    parser.add_argument("--stripes", type=int, default=1,
+                        help="split every size-bounded TCP download into this many byte ranges fetched over "
+                             "parallel connections and report it as one transfer")
+    parser.add_argument("--tcp-profile", choices=PROFILES, default=None,
+                        help="TCP tuning profile (nodelay, buffers, congestion control, zerocopy) both ends apply "
+                             "to every connection (default: the server's)")
+    # Unattended runs: a single round from the arguments or a test plan file, without any prompt
+    parser.add_argument("--size", type=int, default=None, help="bytes per transfer, runs without prompting")
+    parser.add_argument("--tcp", type=int, default=1, help="TCP connections of the --size round")
+    parser.add_argument("--udp", type=int, default=1, help="UDP connections of the --size round")
+    parser.add_argument("--repeat", type=int, default=1, help="times the --size round runs")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="keep repeating the --size round until this many seconds have passed")
+    parser.add_argument("--reliable", action="store_true",
+                        help="NACK lost UDP segments so the server retransmits them, reports goodput and overhead")
+    parser.add_argument("--time", type=float, default=None,
+                        help="stream every transfer for this many seconds instead of a fixed size, runs without prompting")
+    parser.add_argument("--stop-by", choices=STOP_MODES, default=STOP_BY_SERVER,
+                        help="end time-bounded TCP transfers at the server's deadline or by closing the connection")
+    parser.add_argument("--omit", type=float, default=None,
+                        help="warm-up seconds left out of the steady-state speed (default: 10%% of --time)")
+    parser.add_argument("--plan", default=None,
+                        help="JSON (or YAML, with PyYAML) test plan: a list of rounds with size, tcp, udp, repeat, "
+                             "duration and time")
+    parser.add_argument("--server", default=None,
+                        help="server host to test against instead of waiting for an offer broadcast")
+    parser.add_argument("--results", default=None, help="append one JSON line per round to this file")
+    parser.add_argument("--select", choices=SELECT_MODES, default=SELECT_LEAST_LOADED,
+                        help="test the least loaded discovered server every round, or fan out to all of them")
+    parser.add_argument("--discovery-ttl", type=float, default=DEFAULT_TTL,
+                        help="seconds a discovered server is kept without a fresh offer")
+    parser.add_argument("--session", choices=POOL_MODES, default=None,
+                        help="run the rounds in a persistent session per server: one control connection negotiates "
+                             "them, warm reuses the data connections across rounds, cold opens them fresh")
+    parser.add_argument("--multicast-group", default=None,
+                        help="multicast group the servers send their offers to, joined and solicited as well")
+    parser.add_argument("--solicit", action=argparse.BooleanOptionalAction, default=True,
+                        help="ask the servers for an offer at once instead of waiting for their next one")
+    parser.add_argument("--solicit-address", action="append", default=[],
+                        help="address solicits are sent to, repeatable, e.g. a server host (default: the broadcast "
+                             "address of every local subnet and the multicast group)")
+    parser.add_argument("--capture", default=None,
+                        help="record the segment number and arrival time of every UDP datagram to "
+                             "<CAPTURE>.<n>.udp<index>.*.npy for capture.py")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="time the stages of the receive loops and sample the stacks of every thread, or run "
+                             "the transfers under cProfile")
+    parser.add_argument("--profile-output", default=DEFAULT_PROFILE_OUTPUT,
+                        help="collapsed stacks for flame graph tools, with .pstats and .stages.json next to it")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                        help="seconds between stack samples")
+    args = parser.parse_args()
+    if args.stripes < 1:
+        parser.error("--stripes must be at least 1")
+    if args.payload == PAYLOAD_FILE and args.payload_file is None:
+        parser.error("--payload file needs a local --payload-file copy")
+
+    profiler = Profiler(args.profile, args.profile_output, args.profile_interval) if args.profile else None
+    client = SpeedTestClient(udp_rate=args.udp_rate, udp_payload_size=args.udp_payload_size, udp_io=args.udp_io,
+                             timestamps=args.timestamps, report_interval=args.interval, report_file=args.report_file,
+                             tcp_buffer_size=args.tcp_buffer_size, receive_buffer=args.receive_buffer,
+                             stop_by=args.stop_by, omit=args.omit, reliable=args.reliable, select=args.select,
+                             discovery_ttl=args.discovery_ttl, profiler=profiler, capture=args.capture,
+                             tcp_profile=args.tcp_profile, direction=args.direction, stripes=args.stripes,
+                             payload=args.payload, payload_seed=args.payload_seed, payload_file=args.payload_file,
+                             verify=args.verify, multicast_group=args.multicast_group,
+                             solicit_targets=args.solicit_address if args.solicit else None, session=args.session)
+    if args.server:
+        client.server_address = (args.server, UDP_LISTENER_PORT, TCP_PORT)
+
+    if profiler:
+        profiler.start()
+    try:
+        if args.plan is None and args.size is None and args.time is None:
+            client.start()
+        else:
+            try:
+                rounds = load_plan(args.plan) if args.plan else [
+                    make_round(args.size or 0, args.tcp, args.udp, args.repeat, args.duration, args.time)]
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+
+            results_file = open(args.results, "a") if args.results else None
+            failed = False
+            try:
+                for record in client.run_plan(rounds):
+                    failed = failed or record["failed_transfers"] > 0
+                    if results_file:
+                        results_file.write(json.dumps(record) + "\n")
+                        results_file.flush()
+            finally:
+                if results_file:
+                    results_file.close()
+            raise SystemExit(1 if failed else 0)
+    finally:
+        client.close_sessions()
+        if profiler:
+            profiler.stop()
+            profiler.report()
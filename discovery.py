@@ -0,0 +1,344 @@
+import socket
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not Unix, local_interfaces() falls back to the address of the default route
+    fcntl = None
+
+OFFER_FORMAT = '!IBHH'  # magic cookie, message type, UDP port, TCP port
+OFFER_LOAD_FORMAT = '!H'  # optional tail: transfers the server is running
+SOLICIT_FORMAT = '!IB'  # magic cookie, message type: a client asks every server that hears it for an offer now
+SOLICIT_MESSAGE_TYPE = 0xB
+DISCOVERY_PORT = 13118  # servers send their offers from this port and answer the solicits sent to it
+DEFAULT_TTL = 5.0  # offers come every second, a server that missed this many seconds of them is forgotten
+DEFAULT_OFFER_INTERVAL = 1.0
+DEFAULT_MULTICAST_TTL = 1  # hops a multicast offer or solicit may take, 1 keeps it on the local network
+LIMITED_BROADCAST = "255.255.255.255"
+INTERFACE_REFRESH_INTERVAL = 30  # seconds between re-enumerations of the interfaces, for addresses that change
+SOLICIT_RETRY = 0.1  # seconds before a solicit nobody answered is sent again, doubled up to the offer interval
+
+# Linux ioctls of the interface addresses, and the flags of SIOCGIFFLAGS
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891B
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+
+class Interface:
+    """An IPv4 interface that is up, broadcast is None for interfaces without one (loopback, point-to-point)"""
+
+    __slots__ = ("name", "address", "broadcast")
+
+    def __init__(self, name, address, broadcast):
+        self.name = name
+        self.address = address
+        self.broadcast = broadcast
+
+
+def interface_ioctl(sock, request, name):
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name.encode()[:15]))
+
+
+def local_interfaces():
+    """The IPv4 interfaces that are up, from the kernel on Linux. Elsewhere it is the interface of the default
+    route, whose broadcast address is taken as the limited broadcast."""
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        if fcntl is not None and hasattr(socket, "if_nameindex"):
+            for _, name in socket.if_nameindex():
+                try:
+                    flags = struct.unpack_from('H', interface_ioctl(sock, SIOCGIFFLAGS, name), 16)[0]
+                    if not flags & IFF_UP:
+                        continue
+                    address = socket.inet_ntoa(interface_ioctl(sock, SIOCGIFADDR, name)[20:24])
+                except OSError:
+                    continue  # no IPv4 address
+                broadcast = None
+                if flags & IFF_BROADCAST and not flags & IFF_LOOPBACK:
+                    try:
+                        broadcast = socket.inet_ntoa(interface_ioctl(sock, SIOCGIFBRDADDR, name)[20:24])
+                    except OSError:
+                        netmask = interface_ioctl(sock, SIOCGIFNETMASK, name)[20:24]
+                        broadcast = socket.inet_ntoa(bytes(a | ~m & 0xFF for a, m in
+                                                           zip(socket.inet_aton(address), netmask)))
+                interfaces.append(Interface(name, address, broadcast))
+            if interfaces:
+                return interfaces
+        try:
+            sock.connect(("192.0.2.1", 9))  # no datagram is sent, connecting only picks the route's source address
+            interfaces.append(Interface("default", sock.getsockname()[0], LIMITED_BROADCAST))
+        except OSError:
+            pass  # no route at all
+    return interfaces
+
+
+def broadcast_addresses(interfaces=None):
+    """The broadcast address of every local subnet, the limited broadcast when no interface has one"""
+    addresses = sorted({interface.broadcast for interface in interfaces or local_interfaces() if interface.broadcast})
+    return addresses or [LIMITED_BROADCAST]
+
+
+def join_multicast_group(sock, group):
+    """Joins group on the interface of the default route, so the socket receives what is sent to it"""
+    membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+
+class ServerEntry:
+    """One server as last announced by its offers"""
+
+    __slots__ = ("host", "udp_port", "tcp_port", "load", "last_seen")
+
+    def __init__(self, host, udp_port, tcp_port, load, last_seen):
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.load = load  # None for servers whose offers don't carry it
+        self.last_seen = last_seen
+
+    @property
+    def address(self):
+        """(host, UDP port, TCP port), the form of SpeedTestClient.server_address"""
+        return self.host, self.udp_port, self.tcp_port
+
+
+class ServerRegistry:
+    """Servers keyed by IP, an entry expires when no offer refreshed it within ttl seconds"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = threading.Condition()
+
+    def update(self, host, udp_port, tcp_port, load=None):
+        """Records an offer, returns True when the server wasn't known (or had expired)"""
+        now = time.monotonic()
+        with self.changed:
+            previous = self.entries.get(host)
+            self.entries[host] = ServerEntry(host, udp_port, tcp_port, load, now)
+            self.changed.notify_all()
+        return previous is None or now - previous.last_seen > self.ttl
+
+    def servers(self):
+        """The live servers sorted by IP, so the fan-out order is stable between rounds"""
+        now = time.monotonic()
+        with self.changed:
+            for host in [host for host, entry in self.entries.items() if now - entry.last_seen > self.ttl]:
+                del self.entries[host]
+            return sorted(self.entries.values(), key=lambda entry: entry.host)
+
+    def least_loaded(self):
+        """The live server running the fewest transfers, servers that don't report a load come last"""
+        return min(self.servers(), key=lambda entry: (entry.load is None, entry.load or 0), default=None)
+
+    def wait(self, count=1, timeout=None):
+        """Blocks until at least count servers are live, returns them (fewer when the timeout passed first)"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.changed:
+            while True:
+                servers = self.servers()
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if len(servers) >= count or (remaining is not None and remaining <= 0):
+                    return servers
+                # wakes up at least every ttl so expired entries are dropped while waiting
+                self.changed.wait(min(remaining, self.ttl) if remaining is not None else self.ttl)
+
+
+class OfferAnnouncer:
+    """Server side of discovery: sends the offers to the broadcast address of every local subnet (or the given
+    broadcast addresses), a multicast group and unicast hosts, and answers solicits right away. It owns one
+    socket bound to DISCOVERY_PORT, the threaded server drives it from a thread and the async one from its loop.
+    The subnets are re-enumerated every INTERFACE_REFRESH_INTERVAL seconds."""
+
+    def __init__(self, magic_cookie, port, broadcast=True, broadcast_addresses=None, multicast_group=None,
+                 multicast_ttl=DEFAULT_MULTICAST_TTL, unicast=(), interval=DEFAULT_OFFER_INTERVAL):
+        self.magic_cookie = magic_cookie
+        self.port = port  # where the clients listen for offers
+        self.broadcast = broadcast
+        self.broadcast_addresses = list(broadcast_addresses or [])  # empty: every local subnet
+        self.multicast_group = multicast_group
+        self.multicast_ttl = multicast_ttl
+        self.unicast = list(unicast)
+        self.interval = interval
+        self.interfaces = []
+        self.target_list = []
+        self.refreshed = None
+        self.failed_targets = set()  # targets whose send failed, reported once
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", DISCOVERY_PORT))
+        if self.multicast_group:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            join_multicast_group(self.sock, self.multicast_group)
+        self.refresh()
+        return self.sock
+
+    def refresh(self):
+        """Enumerates the interfaces again and rebuilds the list of offer targets"""
+        self.interfaces = local_interfaces()
+        targets = []
+        if self.broadcast:
+            targets += self.broadcast_addresses or broadcast_addresses(self.interfaces)
+        if self.multicast_group:
+            targets.append(self.multicast_group)
+        targets += self.unicast
+        self.target_list = [(target, self.port) for target in dict.fromkeys(targets)]
+        self.refreshed = time.monotonic()
+
+    def targets(self):
+        if time.monotonic() - self.refreshed > INTERFACE_REFRESH_INTERVAL:
+            self.refresh()
+        return self.target_list
+
+    def describe(self):
+        """The addresses the server is reachable on and where its offers go, for the startup message"""
+        addresses = ", ".join(f"{interface.address} ({interface.name})" for interface in self.interfaces) or "-"
+        targets = ", ".join(target for target, _ in self.target_list) or "nowhere, solicits only"
+        return f"listening on IP address {addresses}, offers to {targets}"
+
+    def announce(self, offer):
+        """Sends an offer to every target, a target that fails (e.g. a subnet that went away) is reported once
+        and doesn't keep the others from getting theirs"""
+        for target in self.targets():
+            try:
+                self.sock.sendto(offer, target)
+                self.failed_targets.discard(target)
+            except OSError as e:
+                if target not in self.failed_targets:
+                    self.failed_targets.add(target)
+                    print(f"Error sending offer to {target[0]}: {e}")
+
+    def is_solicit(self, data):
+        return (len(data) >= struct.calcsize(SOLICIT_FORMAT)
+                and struct.unpack_from(SOLICIT_FORMAT, data) == (self.magic_cookie, SOLICIT_MESSAGE_TYPE))
+
+    def answer(self, offer, addr):
+        """Sends an offer straight back to a client that solicited one"""
+        try:
+            self.sock.sendto(offer, addr)
+        except OSError as e:
+            print(f"Error answering solicit from {addr[0]}: {e}")
+
+    def serve(self, offer_message):
+        """The blocking loop of the threaded server: offers every interval and answers solicits in between,
+        offer_message() builds an offer with the current load"""
+        next_offer = time.monotonic()
+        while True:
+            timeout = next_offer - time.monotonic()
+            if timeout <= 0:
+                self.announce(offer_message())
+                next_offer += self.interval
+                if next_offer < time.monotonic():  # the loop stalled, don't send a burst of offers to catch up
+                    next_offer = time.monotonic() + self.interval
+                continue
+            self.sock.settimeout(timeout)
+            try:
+                data, addr = self.sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue  # e.g. an ICMP error of an earlier unicast offer
+            if self.is_solicit(data):
+                self.answer(offer_message(), addr)
+
+
+class DiscoveryService:
+    """Listens for offers on the broadcast port in a background thread for as long as the client runs, so rounds
+    pick from the registry instead of binding the port and waiting for a fresh broadcast every time. Solicits
+    sent to the solicit targets make the servers answer at once instead of at their next periodic offer."""
+
+    def __init__(self, magic_cookie, offer_message_type, port, ttl=DEFAULT_TTL, multicast_group=None,
+                 solicit_targets=None):
+        self.magic_cookie = magic_cookie
+        self.offer_message_type = offer_message_type
+        self.port = port
+        self.registry = ServerRegistry(ttl)
+        self.multicast_group = multicast_group  # also receives the offers sent to this group
+        self.solicit_targets = solicit_targets  # None: don't solicit, [] the broadcast address of every subnet
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread:
+            return
+        self.stopped.clear()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(("", self.port))
+        if self.multicast_group:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, DEFAULT_MULTICAST_TTL)
+            join_multicast_group(self.sock, self.multicast_group)
+        if self.solicit_targets is not None and not self.solicit_targets:
+            self.solicit_targets = broadcast_addresses() + ([self.multicast_group] if self.multicast_group else [])
+        self.sock.settimeout(1)  # to notice stop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def solicit(self):
+        """Asks the servers for an offer, they answer to the port this service listens on"""
+        solicit = struct.pack(SOLICIT_FORMAT, self.magic_cookie, SOLICIT_MESSAGE_TYPE)
+        for target in self.solicit_targets or []:
+            try:
+                self.sock.sendto(solicit, (target, DISCOVERY_PORT))
+            except OSError:
+                pass  # an unreachable target, the others and the periodic offers still count
+
+    def discover(self, count=1, max_retry=DEFAULT_OFFER_INTERVAL):
+        """Blocks until count servers are live and returns them, soliciting offers while there are fewer.
+        A server that answers its solicit is known one round trip after the call instead of at its next offer."""
+        retry = SOLICIT_RETRY
+        while True:
+            if len(self.registry.servers()) >= count:
+                return self.registry.servers()
+            if self.solicit_targets is None:
+                return self.registry.wait(count)
+            self.solicit()
+            servers = self.registry.wait(count, retry)
+            if len(servers) >= count:
+                return servers
+            retry = min(retry * 2, max_retry)
+
+    def run(self):
+        offer_size = struct.calcsize(OFFER_FORMAT)
+        load_size = struct.calcsize(OFFER_LOAD_FORMAT)
+        while not self.stopped.is_set():
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                # e.g. ENETUNREACH while an interface goes down or the ICMP error of a solicit, none of them may end
+                # the thread that keeps the registry fresh
+                if not self.stopped.is_set():
+                    print("\033[91m" + f"Error receiving offers: {e}" + "\033[0m")
+                    self.stopped.wait(SOLICIT_RETRY)
+                continue
+            if len(data) < offer_size:
+                continue
+            cookie, message_type, udp_port, tcp_port = struct.unpack_from(OFFER_FORMAT, data)
+            if cookie != self.magic_cookie or message_type != self.offer_message_type:
+                continue
+            load = (struct.unpack_from(OFFER_LOAD_FORMAT, data, offer_size)[0]
+                    if len(data) >= offer_size + load_size else None)
+            if self.registry.update(addr[0], udp_port, tcp_port, load):
+                print("\033[95m" + f"Received offer from {addr[0]}" + "\033[0m")
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.sock.close()
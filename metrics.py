@@ -0,0 +1,122 @@
+import json
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = "speedtest_"
+# upper bounds in seconds of the transfer duration histograms, from loopback bursts to long time-bounded runs
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricStore:
+    """Counters, gauges and histograms of one process, recorded without a lock.
+
+    Every thread writes its own shard (a dict of ints, a histogram being a list of bucket counts followed by
+    the sum of the observed values) and snapshot() adds the shards up, so a hot loop can hold on to its
+    thread's shard() and bump a field with a plain dict update. Subclasses name their fields in COUNTERS,
+    GAUGES and HISTOGRAMS (name -> bucket upper bounds)."""
+
+    COUNTERS = ()
+    GAUGES = ()
+    HISTOGRAMS = {}
+
+    def __init__(self):
+        self.lock = threading.Lock()  # only guards the list of shards
+        self.shards = []
+        self.local = threading.local()
+
+    def shard(self):
+        """The calling thread's fields, created on its first use"""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = dict.fromkeys(self.COUNTERS + self.GAUGES, 0)
+            for name, buckets in self.HISTOGRAMS.items():
+                shard[name] = [0] * (len(buckets) + 2)  # the buckets, +Inf and the sum
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def add(self, name, amount=1):
+        self.shard()[name] += amount
+
+    def observe(self, name, value):
+        counts = self.shard()[name]
+        counts[bisect_left(self.HISTOGRAMS[name], value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        """The totals of every thread as a flat dict, it pickles so worker processes can send it"""
+        with self.lock:
+            shards = list(self.shards)
+        return merge_snapshots(shards, self.COUNTERS + self.GAUGES, self.HISTOGRAMS)
+
+
+def merge_snapshots(snapshots, fields, histograms):
+    """Adds up snapshots (or shards) field by field, histograms bucket by bucket"""
+    totals = dict.fromkeys(fields, 0)
+    for name, buckets in histograms.items():
+        totals[name] = [0] * (len(buckets) + 2)
+    for snapshot in snapshots:
+        for name, value in list(snapshot.items()):
+            if isinstance(value, list):
+                totals[name] = [total + count for total, count in zip(totals[name], value)]
+            else:
+                totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def render_prometheus(snapshot, gauges, histograms, descriptions):
+    """Prometheus text exposition of a snapshot, fields not in gauges or histograms are counters"""
+    lines = []
+    for name, value in snapshot.items():
+        metric = METRIC_PREFIX + name
+        if name in histograms:
+            kind = "histogram"
+        elif name in gauges:
+            kind = "gauge"
+        else:
+            kind = "counter"
+            metric += "_total"
+        if name in descriptions:
+            lines.append(f"# HELP {metric} {descriptions[name]}")
+        lines.append(f"# TYPE {metric} {kind}")
+        if kind != "histogram":
+            lines.append(f"{metric} {value}")
+            continue
+        cumulative = 0
+        for bound, count in zip(histograms[name] + ("+Inf",), value):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum {value[-1]}")
+        lines.append(f"{metric}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(address, port, collect, render):
+    """Serves GET /metrics (render(collect())) and GET /stats (collect() as JSON) from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = render(collect()).encode(), PROMETHEUS_CONTENT_TYPE
+            elif self.path == "/stats":
+                body, content_type = json.dumps(collect()).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes every few seconds would drown the server's own output
+
+    http_server = ThreadingHTTPServer((address, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
@@ -0,0 +1,38 @@
+import time
+
+# time.sleep() can overshoot by tens of microseconds, waits shorter than this are spun instead
+SPIN_THRESHOLD = 0.0002  # seconds
+
+
+class TokenBucket:
+    """Paces a sender to a target bitrate. Tokens are bytes, refilled continuously from a nanosecond clock,
+    and the bucket holds at most burst_bytes so an idle sender can't build up a long burst."""
+
+    def __init__(self, rate_bps, burst_bytes):
+        self.rate = rate_bps / 8 / 1e9  # bytes per nanosecond
+        self.capacity = burst_bytes
+        self.tokens = burst_bytes
+        self.last_refill = time.perf_counter_ns()
+
+    def refill(self):
+        now = time.perf_counter_ns()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_consume(self, nbytes):
+        """Takes nbytes tokens if they are available and returns 0, otherwise returns the seconds to wait"""
+        self.refill()
+        if self.tokens >= nbytes:
+            self.tokens -= nbytes
+            return 0
+        return (nbytes - self.tokens) / self.rate / 1e9
+
+    def consume(self, nbytes):
+        """Blocks until nbytes tokens are available and takes them, sleeping for the long part of the wait
+        and spinning for the last fraction of a millisecond"""
+        while True:
+            wait = self.try_consume(nbytes)
+            if not wait:
+                return
+            if wait > SPIN_THRESHOLD:
+                time.sleep(wait - SPIN_THRESHOLD)
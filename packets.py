@@ -0,0 +1,101 @@
+import struct
+import time
+
+# Wire protocol shared by the client and the server
+MAGIC_COOKIE = 0xabcddcba
+OFFER_MESSAGE_TYPE = 0x2
+REQUEST_MESSAGE_TYPE = 0x3
+PAYLOAD_MESSAGE_TYPE = 0x4
+TIMESTAMPED_PAYLOAD_MESSAGE_TYPE = 0x5  # payload whose header carries the send time, asked for with FLAG_TIMESTAMPS
+# 0x6 is the NACK feedback of reliable transfers, see reliable.py
+REJECT_MESSAGE_TYPE = 0x7  # '!IB' followed by the utf-8 reason a UDP request was turned down
+# 0x8-0xA are the request, ready and result messages of uploads, see upload.py
+PAYLOAD_MESSAGE_TYPES = (PAYLOAD_MESSAGE_TYPE, TIMESTAMPED_PAYLOAD_MESSAGE_TYPE)
+UDP_BROADCAST_PORT = 13117
+UDP_LISTENER_PORT = 60000
+TCP_PORT = 12345
+
+# UDP requests, '!IBQ' (magic cookie, message type, file size) followed by optional fields
+# optional request tail: target bits/second (0 = unpaced), payload size (0 = server default), flags
+REQUEST_OPTIONS_FORMAT = '!QHB'
+# optional field after the options: stream for this many milliseconds instead of (or on top of) a size bound
+REQUEST_DURATION_FORMAT = '!I'
+# optional field after the duration: payload kind (an index of payloads.PAYLOAD_KINDS) and PRNG seed
+REQUEST_PAYLOAD_FORMAT = '!BQ'
+FLAG_TIMESTAMPS = 0x1  # send TIMESTAMPED_PAYLOAD_MESSAGE_TYPE segments
+# FLAG_RELIABLE (0x2, see reliable.py): retransmit the segments the client NACKs
+
+# TCP requests, a "<size>[ key=value]..." line, see server.parse_tcp_request
+TIME_KEY = "time"
+PROFILE_KEY = "profile"
+DIRECTION_KEY = "direction"
+OFFSET_KEY = "offset"
+PAYLOAD_KEY = "payload"
+# "keepalive=1" on a size-bounded TCP request: the server reads the next request from the connection once
+# the transfer is done instead of closing it. Time-bounded transfers have no end the client could read up to,
+# they always close their connection.
+KEEPALIVE_KEY = "keepalive"
+STATUS_KEY = "status"
+TCP_REJECTION_PREFIX = b"ERROR "  # a turned down TCP request gets "ERROR <reason>\n" instead of the payload
+# a download request with "status=1" gets this line once it has its transfer slot and before the payload, so a
+# payload that happens to start with the rejection prefix can't pass for one
+TCP_STATUS_OK = b"OK\n"
+
+# '!IBQQ' segment header: magic cookie, message type, total segments, segment number
+PAYLOAD_HEADER = struct.Struct('!IBQQ')
+# '!IBQQQ' header of timestamped segments, the segment number is followed by the perf_counter_ns send time
+TIMESTAMPED_PAYLOAD_HEADER = struct.Struct('!IBQQQ')
+SEGMENT_NUMBER = struct.Struct('!Q')
+SEGMENT_NUMBER_AND_TIMESTAMP = struct.Struct('!QQ')
+SEGMENT_NUMBER_OFFSET = 13  # the segment number follows the cookie, message type and total segments
+
+
+class PacketBuilder:
+    """Builds the datagrams of one UDP transfer inside a single reusable buffer.
+
+    The buffer holds batch_size datagrams back to back. Headers and payload are written once, after that
+    building a batch only patches the segment numbers (and send timestamps) in place, so the hot loop
+    neither allocates nor copies. The returned memoryviews are reused by the next build() call.
+
+    With payloads (the windows of a non-constant pattern, see payloads.py) segment n carries payloads[n %
+    len(payloads)], which build() copies in as well: one memcpy per datagram, nothing computed per byte.
+    """
+
+    def __init__(self, magic_cookie, message_type, total_segments, payload_size, batch_size, fill=b'a',
+                 timestamped=False, payloads=None):
+        self.timestamped = timestamped
+        self.payloads = payloads
+        header = TIMESTAMPED_PAYLOAD_HEADER if timestamped else PAYLOAD_HEADER
+        self.header_size = header.size
+        self.datagram_size = header.size + payload_size
+        self.buffer = bytearray(self.datagram_size * batch_size)
+        view = memoryview(self.buffer)
+        self.datagrams = [view[i * self.datagram_size:(i + 1) * self.datagram_size] for i in range(batch_size)]
+
+        payload = fill * payload_size
+        for datagram in self.datagrams:
+            # the timestamp of a timestamped header stays zero until build() stamps it
+            PAYLOAD_HEADER.pack_into(datagram, 0, magic_cookie, message_type, total_segments, 0)
+            datagram[header.size:] = payload
+
+        # offsets of the segment number fields inside the buffer
+        self.number_offsets = [i * self.datagram_size + SEGMENT_NUMBER_OFFSET for i in range(batch_size)]
+
+    def build(self, first_segment, count):
+        """Numbers count datagrams starting at first_segment (stamping them with the current time for
+        timestamped transfers) and returns them"""
+        buffer = self.buffer
+        if self.timestamped:
+            pack_into = SEGMENT_NUMBER_AND_TIMESTAMP.pack_into
+            now = time.perf_counter_ns()  # the whole batch leaves in the same send call
+            for i in range(count):
+                pack_into(buffer, self.number_offsets[i], first_segment + i, now)
+        else:
+            pack_into = SEGMENT_NUMBER.pack_into
+            for i in range(count):
+                pack_into(buffer, self.number_offsets[i], first_segment + i)
+        if self.payloads:
+            payloads, header_size = self.payloads, self.header_size
+            for i in range(count):
+                self.datagrams[i][header_size:] = payloads[(first_segment + i) % len(payloads)]
+        return self.datagrams[:count]
@@ -0,0 +1,127 @@
+import random
+import zlib
+from functools import lru_cache
+
+PAYLOAD_CONSTANT = "constant"  # one repeated byte, what the servers always sent
+PAYLOAD_RANDOM = "random"  # seeded PRNG bytes, incompressible for WAN optimizers and compressing middleboxes
+PAYLOAD_FILE = "file"  # a file replayed over and over, e.g. a sample of the traffic the link really carries
+PAYLOAD_KINDS = (PAYLOAD_CONSTANT, PAYLOAD_RANDOM, PAYLOAD_FILE)
+PAYLOAD_IDS = {kind: number for number, kind in enumerate(PAYLOAD_KINDS)}  # how UDP requests name the kind
+DEFAULT_SEED = 0
+CONSTANT_FILL = b'a'
+RING_SIZE = 1024 * 1024  # bytes of every pattern, the size of the server's pattern buffer
+CHECKSUM_CHUNK_SIZE = 64 * 1024  # TCP streams are verified with one CRC32 per chunk of this many bytes
+MAX_CACHED_PATTERNS = 8
+
+
+def generate(kind, seed=DEFAULT_SEED, path=None, size=RING_SIZE):
+    """size bytes of payload of a kind, the file kind repeats the start of the file at path to fill them"""
+    if kind == PAYLOAD_CONSTANT:
+        return CONSTANT_FILL * size
+    if kind == PAYLOAD_RANDOM:
+        return random.Random(seed).randbytes(size)
+    if kind == PAYLOAD_FILE:
+        if path is None:
+            raise ValueError("the file payload needs a payload file")
+        with open(path, "rb") as payload_file:
+            data = payload_file.read(size)
+        if not data:
+            raise ValueError(f"payload file {path} is empty")
+        return (data * (size // len(data) + 1))[:size]
+    raise ValueError(f"unknown payload kind {kind!r}, expected one of {', '.join(PAYLOAD_KINDS)}")
+
+
+class Pattern:
+    """A precomputed ring of payload bytes, so sending a pattern costs no CPU per byte: byte x of a TCP stream
+    is data[x % size] and UDP segment n carries window n % len(windows) of its payload size. The CRC32s the
+    receiver checks against are computed once per pattern too."""
+
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+        self.view = memoryview(data)
+        self.size = len(data)
+        self.file = None  # the sendfile copy, created by the server that needs one
+        self.window_cache = {}  # payload size -> (windows, their CRC32s)
+        self.chunk_checksums = None
+
+    @property
+    def constant(self):
+        return self.kind == PAYLOAD_CONSTANT
+
+    def windows(self, payload_size):
+        """The UDP payloads of a payload size, consecutive slices of the ring, and their CRC32s"""
+        windows = self.window_cache.get(payload_size)
+        if windows is None:
+            views = [self.view[start:start + payload_size]
+                     for start in range(0, self.size - payload_size + 1, payload_size)]
+            windows = self.window_cache[payload_size] = (views, [zlib.crc32(view) for view in views])
+        return windows
+
+    def stream_checksums(self):
+        """CRC32 of every CHECKSUM_CHUNK_SIZE chunk of the ring, chunk j of a stream is chunk j % len of them"""
+        if self.chunk_checksums is None:
+            self.chunk_checksums = [zlib.crc32(self.view[start:start + CHECKSUM_CHUNK_SIZE])
+                                    for start in range(0, self.size, CHECKSUM_CHUNK_SIZE)]
+        return self.chunk_checksums
+
+    def stream_crc(self, start, end):
+        """CRC32 of stream bytes [start, end), for the chunks that don't line up with the table"""
+        crc = 0
+        while start < end:
+            offset = start % self.size
+            count = min(end - start, self.size - offset)
+            crc = zlib.crc32(self.view[offset:offset + count], crc)
+            start += count
+        return crc
+
+
+@lru_cache(maxsize=MAX_CACHED_PATTERNS)
+def load_pattern(kind=PAYLOAD_CONSTANT, seed=DEFAULT_SEED, path=None):
+    """The pattern of a kind and seed (or file), generated on first use and then shared by every transfer"""
+    return Pattern(kind, generate(kind, seed, path))
+
+
+class StreamVerifier:
+    """Verifies a TCP stream against a pattern with one CRC32 per CHECKSUM_CHUNK_SIZE chunk, chunks are
+    aligned to the stream position so a stripe that starts at an offset checks the same chunks. zlib
+    computes the CRCs without holding the GIL, update() adds one pass over the received bytes."""
+
+    def __init__(self, pattern, offset=0):
+        self.pattern = pattern
+        self.checksums = pattern.stream_checksums()
+        self.position = offset  # stream position of the next byte
+        self.chunk_start = offset
+        self.crc = 0
+        self.chunks = 0
+        self.corrupt_chunks = 0
+
+    def update(self, data):
+        position = self.position
+        while data:
+            boundary = (position // CHECKSUM_CHUNK_SIZE + 1) * CHECKSUM_CHUNK_SIZE
+            count = min(len(data), boundary - position)
+            self.crc = zlib.crc32(data[:count], self.crc)
+            position += count
+            data = data[count:]
+            if position == boundary:
+                self.finish_chunk(position)
+        self.position = position
+
+    def finish_chunk(self, end):
+        start = self.chunk_start
+        if end - start == CHECKSUM_CHUNK_SIZE and not start % CHECKSUM_CHUNK_SIZE:
+            expected = self.checksums[start // CHECKSUM_CHUNK_SIZE % len(self.checksums)]
+        else:
+            expected = self.pattern.stream_crc(start, end)  # the partial first or last chunk
+        self.chunks += 1
+        if self.crc != expected:
+            self.corrupt_chunks += 1
+        self.chunk_start = end
+        self.crc = 0
+
+    def summary(self):
+        """Checks the last, partial, chunk and returns the verification figures"""
+        if self.position > self.chunk_start:
+            self.finish_chunk(self.position)
+        return {"verified_chunks": self.chunks, "corrupt_chunks": self.corrupt_chunks}
@@ -0,0 +1,54 @@
+import json
+
+ROUND_FIELDS = ("size", "tcp", "udp", "repeat", "duration", "time")
+
+
+class PlanError(ValueError):
+    """A test plan that can't be run"""
+
+
+def make_round(size=0, tcp=1, udp=1, repeat=1, duration=None, time=None):
+    """One round of a test plan: size bytes over tcp + udp parallel connections, run repeat times or, when a
+    duration in seconds is given, again and again until that long has passed. With a time every transfer
+    streams for that many seconds instead, a size then only adds a byte bound."""
+    test_round = {"size": int(size), "tcp": int(tcp), "udp": int(udp), "repeat": int(repeat),
+                  "duration": float(duration) if duration is not None else None,
+                  "time": float(time) if time is not None else None}
+    if test_round["time"] is not None and not test_round["time"] > 0:
+        raise PlanError(f"transfer time must be positive: {test_round}")
+    if test_round["size"] < 0 or test_round["tcp"] < 0 or test_round["udp"] < 0:
+        raise PlanError(f"negative size or connection count in {test_round}")
+    if not test_round["tcp"] and not test_round["udp"]:
+        raise PlanError(f"round without any connection: {test_round}")
+    if test_round["repeat"] < 1 and test_round["duration"] is None:
+        raise PlanError(f"round that never runs: {test_round}")
+    return test_round
+
+
+def parse_plan(data):
+    """Validates a plan, either a list of rounds or a mapping with a "rounds" list"""
+    if isinstance(data, dict):
+        data = data.get("rounds")
+    if not isinstance(data, list) or not data:
+        raise PlanError("a test plan is a non-empty list of rounds")
+    rounds = []
+    for entry in data:
+        if not isinstance(entry, dict) or ("size" not in entry and "time" not in entry):
+            raise PlanError(f"every round needs at least a size or a time: {entry}")
+        unknown = set(entry) - set(ROUND_FIELDS)
+        if unknown:
+            raise PlanError(f"unknown round fields {sorted(unknown)}, expected {ROUND_FIELDS}")
+        rounds.append(make_round(**entry))
+    return rounds
+
+
+def load_plan(path):
+    """Reads a JSON test plan, or a YAML one when PyYAML is installed"""
+    with open(path) as plan_file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise PlanError("YAML test plans need PyYAML (pip install pyyaml), or write the plan as JSON")
+            return parse_plan(yaml.safe_load(plan_file))
+        return parse_plan(json.load(plan_file))
@@ -0,0 +1,156 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_SAMPLE = "sample"  # a background thread samples the stacks of every thread, low overhead
+PROFILE_CPROFILE = "cprofile"  # deterministic cProfile of every transfer thread, exact call counts but slow
+PROFILE_MODES = (PROFILE_SAMPLE, PROFILE_CPROFILE)
+DEFAULT_SAMPLE_INTERVAL = 0.005  # seconds between stack samples, ~200 Hz
+DEFAULT_PROFILE_OUTPUT = "profile.folded"
+FLUSH_INTERVAL = 5  # seconds between rewrites of the output files of a server, which only stops when killed
+
+
+class StageTimings:
+    """Nanoseconds spent in the named stages of the transfer loops (pack, send, recv, parse...) and the number
+    of datagrams or chunks they handled.
+
+    The loops only time a stage when profiling is on, behind an `if stages:` test on a local, so a disabled
+    profiler costs one branch per batch. Updates are not locked: with several transfer threads a rare lost
+    update only blurs the totals a little."""
+
+    def __init__(self):
+        self.nanoseconds = Counter()
+        self.counts = Counter()
+
+    def add(self, stage, nanoseconds, count=1):
+        self.nanoseconds[stage] += nanoseconds
+        self.counts[stage] += count
+
+    def summary(self):
+        """stage -> total seconds, items handled and microseconds per item"""
+        return {
+            stage: {
+                "seconds": nanoseconds / 1e9,
+                "count": self.counts[stage],
+                "us_each": nanoseconds / self.counts[stage] / 1000 if self.counts[stage] else 0,
+            }
+            for stage, nanoseconds in self.nanoseconds.most_common()
+        }
+
+
+def frame_label(code):
+    """Flame graph frame name, one per function rather than per line so the graph stays readable"""
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples the Python stack of every other thread every interval seconds into collapsed stacks, the
+    'root;caller;callee count' lines flamegraph.pl, speedscope and inferno read"""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def sample(self, skip_thread):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == skip_thread:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(names.get(thread_id, "thread"))
+            self.stacks[";".join(reversed(labels))] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """--profile of the server and the client: stage timings of the hot loops plus either sampled stacks
+    (written to output as collapsed stacks) or cProfile stats of the transfer threads (output + '.pstats').
+    The stage timings go to output + '.stages.json'."""
+
+    def __init__(self, mode=PROFILE_SAMPLE, output=DEFAULT_PROFILE_OUTPUT, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.mode = mode
+        self.output = output
+        self.stages = StageTimings()
+        self.sampler = StackSampler(interval) if mode == PROFILE_SAMPLE else None
+        self.cprofile_stats = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, flush_interval=None):
+        """Starts sampling, with a flush interval the output files are also rewritten that often"""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, args=(flush_interval,), name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self, flush_interval):
+        own_id = threading.get_ident()
+        next_flush = time.monotonic() + flush_interval if flush_interval else None
+        wait = self.sampler.interval if self.sampler else flush_interval
+        while not self.stopped.wait(wait):
+            if self.sampler:
+                self.sampler.sample(own_id)
+            if next_flush is not None and time.monotonic() >= next_flush:
+                self.write()
+                next_flush += flush_interval
+
+    def stop(self):
+        """Stops sampling and writes the output files"""
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+    def wrap(self, function):
+        """function itself, or in cprofile mode a wrapper that profiles every call on the calling thread and
+        adds the stats up when it returns"""
+        if self.mode != PROFILE_CPROFILE:
+            return function
+
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.cprofile_stats is None:
+                        self.cprofile_stats = pstats.Stats(profile)
+                    else:
+                        self.cprofile_stats.add(profile)
+
+        return profiled
+
+    def write(self):
+        if self.sampler:
+            with open(self.output, "w") as output:
+                output.write(self.sampler.collapsed())
+        with self.lock:
+            if self.cprofile_stats is not None:
+                self.cprofile_stats.dump_stats(self.output + ".pstats")
+        with open(self.output + ".stages.json", "w") as output:
+            json.dump(self.stages.summary(), output, indent=2)
+
+    def report(self):
+        """Prints the stage timings and where the profile was written"""
+        for stage, timing in self.stages.summary().items():
+            print("\033[95m" + f"{stage}: {timing['seconds']:.3f} seconds for {timing['count']} items, "
+                  f"{timing['us_each']:.3f} us each" + "\033[0m")
+        if self.sampler:
+            print("\033[95m" + f"{self.sampler.samples} stack samples written to {self.output}" + "\033[0m")
+        if self.cprofile_stats is not None:
+            print("\033[95m" + f"cProfile stats written to {self.output}.pstats" + "\033[0m")
@@ -0,0 +1,190 @@
+import struct
+import time
+from collections import deque
+
+NACK_MESSAGE_TYPE = 0x6  # receiver feedback of a reliable UDP transfer, sent to the server's UDP listener
+FLAG_RELIABLE = 0x2  # request flag: retransmit the segments the client NACKs
+# '!IBQH' feedback header: magic cookie, message type, segments received through (highest + 1), range count
+FEEDBACK_HEADER = struct.Struct('!IBQH')
+NACK_RANGE = struct.Struct('!QI')  # first missing segment, number of missing segments
+# a feedback datagram fits a 1500 byte MTU without fragmentation
+MAX_NACK_RANGES = (1472 - FEEDBACK_HEADER.size) // NACK_RANGE.size
+
+# new segments the sender may have ahead of the receiver's highest segment, a larger window than the
+# receiver's socket buffer holds (~100 datagrams with the default SO_RCVBUF) only turns into retransmissions
+DEFAULT_WINDOW_SEGMENTS = 128
+FEEDBACK_INTERVAL = 0.01  # longest time between feedback datagrams of a receiver
+# a receiver also sends feedback after this many segments, the sender's window moves with the feedback
+FEEDBACK_SEGMENTS = 16
+RETRANSMIT_HOLDOFF = 0.05  # a segment is retransmitted at most once per holdoff, however often it is NACKed
+TAIL_TIMEOUT = 0.1  # seconds without progress before the unacknowledged tail of the window is sent again
+IDLE_TIMEOUT = 3  # seconds without feedback (sender) or data (receiver) before a transfer is given up
+DONE_REPEATS = 3  # completion feedback is sent this many times, any one of them ends the transfer
+
+
+def pack_feedback(magic_cookie, received_through, ranges):
+    """Feedback datagram: the receiver's progress and up to MAX_NACK_RANGES (first, length) missing ranges"""
+    ranges = ranges[:MAX_NACK_RANGES]
+    message = bytearray(FEEDBACK_HEADER.size + NACK_RANGE.size * len(ranges))
+    FEEDBACK_HEADER.pack_into(message, 0, magic_cookie, NACK_MESSAGE_TYPE, received_through, len(ranges))
+    for i, (first, length) in enumerate(ranges):
+        NACK_RANGE.pack_into(message, FEEDBACK_HEADER.size + i * NACK_RANGE.size, first, length)
+    return message
+
+
+def parse_feedback(data):
+    """Returns the segments received through and the NACK ranges of a feedback datagram"""
+    _, _, received_through, count = FEEDBACK_HEADER.unpack_from(data)
+    count = min(count, (len(data) - FEEDBACK_HEADER.size) // NACK_RANGE.size)
+    ranges = [NACK_RANGE.unpack_from(data, FEEDBACK_HEADER.size + i * NACK_RANGE.size) for i in range(count)]
+    return received_through, ranges
+
+
+class ReliableSender:
+    """Send-side state of a reliable UDP transfer, independent of how the datagrams go out.
+
+    New segments are released while fewer than window of them are ahead of the receiver's highest segment,
+    NACKed segments are retransmitted first. The caller sends whatever next_batch() returns and feeds every
+    feedback datagram to on_feedback()."""
+
+    def __init__(self, total_segments, window=DEFAULT_WINDOW_SEGMENTS):
+        self.total_segments = total_segments
+        self.window = window
+        self.next_segment = 0  # first segment never sent
+        self.received_through = 0
+        self.retransmit_queue = deque()  # (first, count) ranges waiting to be sent again
+        self.retransmit_times = {}  # segment -> perf_counter of its last retransmission, above acknowledged only
+        self.acknowledged = 0  # every segment below it is confirmed, the first NACKed segment of the feedback
+        self.retransmitted = 0
+        self.complete = False
+        self.last_feedback = self.last_progress = time.perf_counter()
+
+    @property
+    def finished(self):
+        """Done when the receiver confirmed every segment, or gave up on when its feedback stopped"""
+        return self.complete or time.perf_counter() - self.last_feedback > IDLE_TIMEOUT
+
+    def next_batch(self, batch_size):
+        """The (first segment, count) to send now, None while the window is full and nothing is NACKed"""
+        if self.retransmit_queue:
+            first, count = self.retransmit_queue.popleft()
+            if count > batch_size:
+                self.retransmit_queue.appendleft((first + batch_size, count - batch_size))
+                count = batch_size
+            self.retransmitted += count
+            return first, count
+        ahead = self.next_segment - self.received_through
+        if self.next_segment < self.total_segments and ahead < self.window:
+            first = self.next_segment
+            count = min(batch_size, self.total_segments - first, self.window - ahead)
+            self.next_segment += count
+            return first, count
+        self.check_tail()
+        return None
+
+    def on_feedback(self, data):
+        now = time.perf_counter()
+        received_through, ranges = parse_feedback(data)
+        self.last_feedback = now
+        if received_through > self.received_through:
+            self.received_through = min(received_through, self.next_segment)
+            self.last_progress = now
+        if not ranges and received_through >= self.total_segments:
+            self.complete = True
+            return
+        # the ranges start at the receiver's first missing segment, holdoffs below it are never needed again
+        acknowledged = min(ranges[0][0] if ranges else received_through, self.next_segment)
+        if acknowledged > self.acknowledged:
+            self.acknowledged = acknowledged
+            self.retransmit_times = {segment: sent for segment, sent in self.retransmit_times.items()
+                                     if segment >= acknowledged}
+        for first, length in ranges:
+            self.queue_retransmit(first, min(first + length, self.next_segment), now)
+
+    def queue_retransmit(self, start, end, now):
+        """Queues the segments of [start, end) that weren't retransmitted within the holdoff, a NACK that
+        repeats before the retransmission could have arrived doesn't send the segment twice"""
+        run_start = None
+        for segment in range(start, end):
+            if now - self.retransmit_times.get(segment, -RETRANSMIT_HOLDOFF) < RETRANSMIT_HOLDOFF:
+                if run_start is not None:
+                    self.retransmit_queue.append((run_start, segment - run_start))
+                    run_start = None
+                continue
+            self.retransmit_times[segment] = now
+            if run_start is None:
+                run_start = segment
+        if run_start is not None:
+            self.retransmit_queue.append((run_start, end - run_start))
+
+    def check_tail(self):
+        """The receiver can only NACK gaps below its highest segment, when the last segments of the window are
+        lost its progress stops and after TAIL_TIMEOUT everything it hasn't confirmed is sent again"""
+        now = time.perf_counter()
+        if self.next_segment > self.received_through and now - self.last_progress > TAIL_TIMEOUT:
+            self.queue_retransmit(self.received_through, self.next_segment, now)
+            self.last_progress = now
+
+
+class ReliableReceiver:
+    """Receive-side state of a reliable UDP transfer: records segments in the transfer's tracker and builds
+    the feedback datagrams from its missing ranges"""
+
+    def __init__(self, magic_cookie, tracker):
+        self.magic_cookie = magic_cookie
+        self.tracker = tracker
+        self.nacked = bytearray((tracker.total_segments + 7) // 8)  # segments NACKed at least once
+        self.nacked_segments = 0
+        self.recovered = 0  # NACKed segments that arrived afterwards
+        self.feedback_sent = 0
+        self.last_feedback = 0.0
+        self.feedback_received = 0  # tracker.received at the last feedback
+
+    def record(self, segment):
+        tracker = self.tracker
+        unique = tracker.unique
+        tracker.record(segment)
+        if tracker.unique != unique and self.nacked[segment >> 3] & (1 << (segment & 7)):
+            self.recovered += 1
+
+    @property
+    def complete(self):
+        return self.tracker.unique == self.tracker.total_segments
+
+    def feedback(self):
+        """Feedback datagram of the current state, the missing ranges are the gaps below the highest segment"""
+        self.last_feedback = time.perf_counter()
+        self.feedback_received = self.tracker.received
+        self.feedback_sent += 1
+        if self.complete:
+            return pack_feedback(self.magic_cookie, self.tracker.total_segments, [])
+        received_through = self.tracker.highest_segment + 1
+        ranges = []
+        # the gaps start at the low-water mark, the bytes below it are complete and never scanned again
+        for first, length in self.tracker.missing_ranges(self.tracker.first_missing(), received_through):
+            ranges.append((first, length))
+            for segment in range(first, first + length):
+                index, bit = segment >> 3, 1 << (segment & 7)
+                if not self.nacked[index] & bit:
+                    self.nacked[index] |= bit
+                    self.nacked_segments += 1
+            if len(ranges) == MAX_NACK_RANGES:
+                break
+        return pack_feedback(self.magic_cookie, received_through, ranges)
+
+    def feedback_due(self):
+        return (self.tracker.received - self.feedback_received >= FEEDBACK_SEGMENTS
+                or time.perf_counter() - self.last_feedback >= FEEDBACK_INTERVAL)
+
+    def summary(self):
+        total_segments = self.tracker.total_segments
+        return {
+            "complete": self.complete,
+            "nacked_segments": self.nacked_segments,
+            "recovered": self.recovered,
+            "feedback_sent": self.feedback_sent,
+            # extra datagrams on top of one per segment: recovered losses and duplicate retransmissions
+            "retransmission_overhead": (
+                (self.recovered + self.tracker.duplicates) / total_segments * 100 if total_segments else 0
+            ),
+        }
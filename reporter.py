@@ -0,0 +1,119 @@
+import csv
+import json
+import threading
+import time
+
+
+class IntervalCounter:
+    """Bytes and packets (datagrams, or recv calls on TCP) received on one connection. Only the connection's
+    own thread writes the counter and the reporter only reads it, so the receive loop updates it without any lock."""
+
+    __slots__ = ("name", "bytes", "packets")
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.packets = 0
+
+
+class IntervalReporter:
+    """Samples every registered counter once per interval and streams the per-connection and total
+    throughput rows to the console and, optionally, to a .csv or JSON lines (.jsonl) file."""
+
+    FIELDS = ("start", "end", "connection", "bytes", "packets", "bits_per_second")
+
+    def __init__(self, interval=1.0, output_path=None, console=True):
+        self.interval = interval
+        self.output_path = output_path
+        self.console = console
+        self.counters = []
+        self.previous = {}  # counter -> (bytes, packets) at the last sample
+        self.stopped = threading.Event()
+        self.thread = None
+        self.output_file = None
+        self.csv_writer = None
+        self.start_time = None
+        self.last_sample_time = None
+
+    def register(self, name):
+        """Creates the counter of a new connection, appending to a list is atomic so it's safe mid-run"""
+        counter = IntervalCounter(name)
+        self.counters.append(counter)
+        return counter
+
+    def start(self):
+        if self.output_path:
+            self.output_file = open(self.output_path, "a", newline="")
+            if self.output_path.endswith(".csv"):
+                self.csv_writer = csv.DictWriter(self.output_file, fieldnames=self.FIELDS)
+                if self.output_file.tell() == 0:
+                    self.csv_writer.writeheader()
+        self.start_time = self.last_sample_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling and writes the last, possibly shorter, interval"""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.sample()
+        if self.output_file:
+            self.output_file.close()
+            self.output_file = None
+
+    def run(self):
+        # deadlines are computed from the start time so the rows don't drift
+        deadline = self.start_time + self.interval
+        while not self.stopped.wait(max(0, deadline - time.perf_counter())):
+            self.sample()
+            deadline += self.interval
+
+    def sample(self):
+        """Writes one row per counter that moved and a total row for the interval since the last sample"""
+        now = time.perf_counter()
+        duration = now - self.last_sample_time
+        if duration <= 0:
+            return
+        start, end = self.last_sample_time - self.start_time, now - self.start_time
+        self.last_sample_time = now
+
+        rows = []
+        total_bytes = total_packets = 0
+        for counter in list(self.counters):
+            current = (counter.bytes, counter.packets)
+            previous = self.previous.get(counter, (0, 0))
+            self.previous[counter] = current
+            interval_bytes, interval_packets = current[0] - previous[0], current[1] - previous[1]
+            total_bytes += interval_bytes
+            total_packets += interval_packets
+            if interval_bytes or interval_packets:
+                rows.append(self.row(start, end, counter.name, interval_bytes, interval_packets, duration))
+        rows.append(self.row(start, end, "total", total_bytes, total_packets, duration))
+
+        for row in rows:
+            self.write(row)
+        if self.console:
+            connections = ", ".join(f"{row['connection']}: {row['bits_per_second']:.2f}" for row in rows[:-1])
+            print("\033[36m" + f"[{start:6.2f}-{end:6.2f} s] total: {rows[-1]['bits_per_second']:.2f} bits/second"
+                  + (f" ({connections})" if connections else "") + "\033[0m")
+
+    @staticmethod
+    def row(start, end, name, interval_bytes, interval_packets, duration):
+        return {
+            "start": round(start, 6),
+            "end": round(end, 6),
+            "connection": name,
+            "bytes": interval_bytes,
+            "packets": interval_packets,
+            "bits_per_second": interval_bytes * 8 / duration,
+        }
+
+    def write(self, row):
+        if not self.output_file:
+            return
+        if self.csv_writer:
+            self.csv_writer.writerow(row)
+        else:
+            self.output_file.write(json.dumps(row) + "\n")
+        self.output_file.flush()
@@ -1,124 +1,1163 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import select
 import socket
 import struct
+import tempfile
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from admission import (
+    DEFAULT_MAX_PER_CLIENT,
+    DEFAULT_MAX_QUEUED,
+    DEFAULT_MAX_TRANSFERS,
+    DEFAULT_QUEUE_TIMEOUT,
+    AdmissionController,
+    TransferRejected,
+)
+from discovery import DEFAULT_MULTICAST_TTL, DEFAULT_OFFER_INTERVAL, OFFER_FORMAT, OFFER_LOAD_FORMAT, OfferAnnouncer
+from metrics import DURATION_BUCKETS, MetricStore, merge_snapshots, render_prometheus, serve_metrics
+from packets import (
+    DIRECTION_KEY,
+    FLAG_TIMESTAMPS,
+    KEEPALIVE_KEY,
+    MAGIC_COOKIE,
+    OFFER_MESSAGE_TYPE,
+    OFFSET_KEY,
+    PAYLOAD_HEADER,
+    PAYLOAD_KEY,
+    PAYLOAD_MESSAGE_TYPE,
+    PAYLOAD_MESSAGE_TYPES,
+    PROFILE_KEY,
+    REJECT_MESSAGE_TYPE,
+    REQUEST_DURATION_FORMAT,
+    REQUEST_MESSAGE_TYPE,
+    REQUEST_OPTIONS_FORMAT,
+    REQUEST_PAYLOAD_FORMAT,
+    STATUS_KEY,
+    TCP_PORT,
+    TCP_REJECTION_PREFIX,
+    TCP_STATUS_OK,
+    TIMESTAMPED_PAYLOAD_HEADER,
+    TIMESTAMPED_PAYLOAD_MESSAGE_TYPE,
+    TIME_KEY,
+    UDP_BROADCAST_PORT,
+    UDP_LISTENER_PORT,
+    PacketBuilder,
+)
+from pacing import TokenBucket
+from payloads import (
+    DEFAULT_SEED,
+    PAYLOAD_CONSTANT,
+    PAYLOAD_FILE,
+    PAYLOAD_KINDS,
+    PAYLOAD_RANDOM,
+    RING_SIZE,
+    load_pattern,
+)
+from profiling import DEFAULT_PROFILE_OUTPUT, DEFAULT_SAMPLE_INTERVAL, FLUSH_INTERVAL, PROFILE_MODES, Profiler
+from reliable import FEEDBACK_HEADER, FEEDBACK_INTERVAL, FLAG_RELIABLE, NACK_MESSAGE_TYPE, ReliableSender
+from session import MAX_COMMAND_SIZE, SESSION_COMMAND, IdleConnections, ServerSession
+from tcp_tuning import (
+    PROFILE_DEFAULT,
+    PROFILES,
+    ZEROCOPY_DRAIN_BYTES,
+    apply_profile,
+    drain_zerocopy_completions,
+    send_zerocopy,
+    wait_socket,
+)
+from tracker import TransferTimer
+from udp_batch import MAX_DATAGRAM_SIZE, BatchSender
+from upload import (
+    DIRECTION_DOWNLOAD,
+    DIRECTION_UPLOAD,
+    MAX_UPLOAD_SEGMENTS,
+    RESULT_REPEATS,
+    TCP_RESULT_PREFIX,
+    UPLOAD_BUFFER_SIZE,
+    UPLOAD_READY,
+    UPLOAD_READY_MESSAGE_TYPE,
+    UPLOAD_REQUEST_MESSAGE_TYPE,
+    UploadReceiver,
+    pack_result,
+    throughput_figures,
+    upload_segments,
+)
+
+# UDP segments
+UDP_HEADER_SIZE = PAYLOAD_HEADER.size
+UDP_TIMESTAMPED_HEADER_SIZE = TIMESTAMPED_PAYLOAD_HEADER.size
+DEFAULT_UDP_PAYLOAD_SIZE = 1024
+# largest IPv4 datagram minus the largest header, jumbo frames need payloads up to ~8950
+MAX_UDP_PAYLOAD_SIZE = 65507 - UDP_TIMESTAMPED_HEADER_SIZE
+PACING_BURST_PACKETS = 8  # how many datagrams a paced sender may send back to back
+UDP_IO_BATCH = "batch"  # GSO sendmsg of many datagrams per syscall where Linux supports it
+UDP_IO_SINGLE = "single"  # one sendto per datagram
+UDP_IO_MODES = (UDP_IO_BATCH, UDP_IO_SINGLE)
+
+# TCP payload streaming
+PATTERN_BUFFER_SIZE = RING_SIZE  # every TCP transfer is served from slices of one shared pattern of this size
+SEND_MODE_SENDALL = "sendall"  # sendall() of memoryview slices
+SEND_MODE_SENDFILE = "sendfile"  # os.sendfile() from a tmpfs backed copy of the pattern
+SEND_MODES = (SEND_MODE_SENDALL, SEND_MODE_SENDFILE)
+DEADLINE_CHECK_INTERVAL = 0.05  # longest a time-bounded transfer waits on a full socket before checking its deadline
+REQUEST_READ_TIMEOUT = 5  # seconds a TCP client has to send its request line before its pool slot is freed
+
+# Server backends
+BACKEND_THREADED = "threaded"  # a pool thread per TCP connection and per UDP request
+BACKEND_ASYNC = "async"  # every transfer multiplexed on one asyncio event loop, see async_server.py
+BACKENDS = (BACKEND_THREADED, BACKEND_ASYNC)
+
+# Multi-process mode
+STATS_INTERVAL = 1  # seconds between the counter reports workers send to the parent
+
+# Observability
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"  # the metrics endpoint is local unless asked otherwise
+
+def parse_udp_request(request_data, default_rate, default_payload_size):
+    """Returns the file size, duration in seconds (None for size-bounded requests), target bitrate, payload
+    size, flags and payload (kind, seed) of a UDP request, None for the server's payload. The tail with the
+    options is optional so plain '!IBQ' requests get the server defaults"""
+    file_size = struct.unpack('!Q', request_data[5:13])[0]
+    duration, rate, payload_size, flags, payload = None, default_rate, default_payload_size, 0, None
+    options_size = struct.calcsize(REQUEST_OPTIONS_FORMAT)
+    if len(request_data) >= 13 + options_size:
+        requested_rate, requested_payload_size, flags = struct.unpack(
+            REQUEST_OPTIONS_FORMAT, request_data[13:13 + options_size]
+        )
+        rate = requested_rate or rate
+        payload_size = requested_payload_size or payload_size
+        duration_offset = 13 + options_size
+        if len(request_data) >= duration_offset + struct.calcsize(REQUEST_DURATION_FORMAT):
+            duration_ms = struct.unpack_from(REQUEST_DURATION_FORMAT, request_data, duration_offset)[0]
+            duration = duration_ms / 1000 if duration_ms else None
+            payload_offset = duration_offset + struct.calcsize(REQUEST_DURATION_FORMAT)
+            if len(request_data) >= payload_offset + struct.calcsize(REQUEST_PAYLOAD_FORMAT):
+                kind, seed = struct.unpack_from(REQUEST_PAYLOAD_FORMAT, request_data, payload_offset)
+                payload = (PAYLOAD_KINDS[kind] if kind < len(PAYLOAD_KINDS) else str(kind), seed)
+    return file_size, duration, rate, min(payload_size, MAX_UDP_PAYLOAD_SIZE), flags, payload
+
+
+def parse_tcp_request(request_data):
+    """Returns the fields of a TCP request line, "<size>[ time=<seconds>][ profile=<name>][ direction=upload]
+    [ offset=<bytes>][ payload=<kind>[:<seed>]][ keepalive=1][ status=1]", as a dict with the size, the time in
+    seconds (None for size-bounded requests), the tuning profile (None: the server's), the direction, the offset,
+    the payload (kind, seed) (None: the server's), whether the connection stays open for another request and
+    whether a download's payload is preceded by the TCP_STATUS_OK line. A
+    time makes the transfer stream until the deadline (time=inf: until the client closes), with a size of 0 it
+    is bounded by the time alone. An offset asks for the size bytes from that far into the transfer's byte
+    stream, one stripe of a transfer the client splits over several connections. keepalive only keeps
+    size-bounded transfers open. Unknown keys are ignored so clients may send options newer servers know."""
+    fields = request_data.split()
+    request = {"size": int(fields[0]), "time": None, "profile": None, "direction": DIRECTION_DOWNLOAD, "offset": 0,
+               "payload": None, "keepalive": False, "status": False}
+    for field in fields[1:]:
+        key, _, value = field.partition("=")
+        if key == TIME_KEY:
+            request["time"] = float(value)
+            if not request["time"] > 0:
+                raise ValueError(f"invalid transfer time {value!r}")
+        elif key == PROFILE_KEY:
+            request["profile"] = value
+        elif key == DIRECTION_KEY:
+            if value not in (DIRECTION_DOWNLOAD, DIRECTION_UPLOAD):
+                raise ValueError(f"invalid direction {value!r}")
+            request["direction"] = value
+        elif key == OFFSET_KEY:
+            request["offset"] = int(value)
+            if request["offset"] < 0:
+                raise ValueError(f"invalid offset {value!r}")
+        elif key == PAYLOAD_KEY:
+            kind, _, seed = value.partition(":")
+            request["payload"] = (kind, int(seed) if seed else DEFAULT_SEED)
+        elif key == KEEPALIVE_KEY:
+            request["keepalive"] = value == "1"
+        elif key == STATUS_KEY:
+            request["status"] = value == "1"
+    return request
+
+
+def transfer_limits(file_size, duration):
+    """Byte limit and perf_counter deadline of a transfer, a time-bounded transfer of size 0 has no byte limit"""
+    if duration is None:
+        return file_size, None
+    return file_size or float("inf"), time.perf_counter() + duration
+
+
+def message_kind(data):
+    """Message type of a datagram sent to the UDP listener, None when it is too short for its type or doesn't
+    carry the magic cookie"""
+    if len(data) < 5:
+        return None
+    cookie, message_type = struct.unpack_from('!IB', data)
+    if cookie != MAGIC_COOKIE:
+        return None
+    if message_type in (REQUEST_MESSAGE_TYPE, UPLOAD_REQUEST_MESSAGE_TYPE) and len(data) < 13:
+        return None  # '!IBQ', the options are optional
+    if message_type in PAYLOAD_MESSAGE_TYPES and len(data) < UDP_HEADER_SIZE:
+        return None
+    if message_type == NACK_MESSAGE_TYPE and len(data) < FEEDBACK_HEADER.size:
+        return None
+    return message_type
+
+
+def create_pacer(rate, datagram_size, burst_packets=PACING_BURST_PACKETS):
+    """Token bucket for a paced UDP transfer, None when the transfer is not paced"""
+    if not rate:
+        return None
+    return TokenBucket(rate, datagram_size * burst_packets)
+
+
+class UdpTransfer:
+    """Everything one UDP transfer needs to send its segments: a pacer, a batch sender and a packet builder
+    sized to the sender's batches"""
+
+    def __init__(self, sock, client_address, file_size, rate, payload_size, flags, use_gso,
+                 burst_packets=PACING_BURST_PACKETS, duration=None, pattern=None):
+        self.payload_size = payload_size
+        self.timestamped = bool(flags & FLAG_TIMESTAMPS)
+        header_size = UDP_TIMESTAMPED_HEADER_SIZE if self.timestamped else UDP_HEADER_SIZE
+        message_type = TIMESTAMPED_PAYLOAD_MESSAGE_TYPE if self.timestamped else PAYLOAD_MESSAGE_TYPE
+
+        # Calculate the total number of segments needed to send the file.
+        # Each segment contains payload_size bytes of payload. Adding payload_size - 1 ensures
+        # any remainder results in an additional segment (rounding up).
+        # A time-bounded transfer of size 0 has no total and announces 0 segments in its headers
+        limit, self.deadline = transfer_limits(file_size, duration)
+        self.total_segments = (file_size + payload_size - 1) // payload_size if limit == file_size else None
+        # NACK driven retransmissions need a known total, time-bounded transfers stay fire-and-forget
+        self.reliable = (ReliableSender(self.total_segments)
+                         if flags & FLAG_RELIABLE and self.total_segments is not None else None)
+
+        self.pacer = create_pacer(rate, header_size + payload_size, burst_packets)
+        self.sender = BatchSender(sock, client_address, header_size + payload_size, use_gso=use_gso)
+        # a paced transfer never sends more than the token bucket's burst at once
+        self.batch_size = min(self.sender.batch_size, burst_packets) if self.pacer else self.sender.batch_size
+        # the datagrams are built once and only their segment numbers are patched for every batch, the
+        # payloads too when the pattern isn't constant
+        payloads = pattern.windows(payload_size)[0] if pattern and not pattern.constant else None
+        self.builder = PacketBuilder(MAGIC_COOKIE, message_type, self.total_segments or 0, payload_size,
+                                     self.batch_size, timestamped=self.timestamped, payloads=payloads)
+
+    def batches(self):
+        """Yields the first segment and the number of segments of every batch, until every segment is out or
+        the deadline of a time-bounded transfer has passed"""
+        first_segment = 0
+        total_segments, deadline = self.total_segments, self.deadline
+        while total_segments is None or first_segment < total_segments:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            count = self.batch_size if total_segments is None else min(self.batch_size, total_segments - first_segment)
+            yield first_segment, count
+            first_segment += count
+
+
+def create_pattern_file(pattern):
+    """Writes the pattern to an unlinked file (in /dev/shm when available) so it can be served with os.sendfile"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    pattern_file = tempfile.TemporaryFile(dir=directory)
+    pattern_file.write(pattern)
+    pattern_file.flush()
+    return pattern_file
+
+
+class ServerStats(MetricStore):
+    """Transfer counters of one server process, every transfer thread records into its own shard"""
+
+    COUNTERS = ("tcp_connections", "udp_transfers", "tcp_bytes_sent", "tcp_sends", "udp_bytes_sent", "udp_packets",
+                "udp_retransmits", "tcp_uploads", "udp_uploads", "tcp_bytes_received", "udp_bytes_received",
+                "udp_packets_received", "rejected", "send_errors", "send_eagain", "malformed_packets",
+                "receive_errors", "sessions", "session_rounds", "reused_connections")
+    # threads, tasks, pending_requests and cpu_seconds are sampled when a snapshot is taken, see runtime_gauges()
+    GAUGES = ("active_transfers", "threads", "tasks", "pending_requests", "cpu_seconds")
+    HISTOGRAMS = {"tcp_transfer_seconds": DURATION_BUCKETS, "udp_transfer_seconds": DURATION_BUCKETS}
+    DESCRIPTIONS = {
+        "tcp_connections": "TCP transfers started",
+        "udp_transfers": "UDP transfers started",
+        "tcp_bytes_sent": "TCP payload bytes sent",
+        "tcp_sends": "send, sendall and sendfile calls of TCP transfers",
+        "udp_bytes_sent": "UDP payload bytes sent, retransmissions included",
+        "udp_packets": "UDP datagrams sent, retransmissions included",
+        "udp_retransmits": "UDP datagrams sent again after a NACK",
+        "tcp_uploads": "TCP uploads started, also counted in tcp_connections",
+        "udp_uploads": "UDP uploads started",
+        "tcp_bytes_received": "TCP payload bytes received from uploads",
+        "udp_bytes_received": "UDP payload bytes received from uploads, counted when an upload ends",
+        "udp_packets_received": "UDP datagrams received from uploads, counted when an upload ends",
+        "rejected": "requests turned down by the admission policy",
+        "send_errors": "transfers that ended with a socket error",
+        "send_eagain": "sends that found the socket buffer full",
+        "malformed_packets": "datagrams and request lines dropped as malformed",
+        "receive_errors": "errors receiving on the UDP listener",
+        "sessions": "persistent sessions opened",
+        "session_rounds": "rounds run in persistent sessions",
+        "reused_connections": "TCP requests served on a kept alive connection",
+        "active_transfers": "transfers running now",
+        "threads": "threads of the server",
+        "tasks": "tasks on the event loop of the async backend",
+        "pending_requests": "requests running or queued for a transfer slot",
+        "cpu_seconds": "user and system CPU seconds of the server processes",
+        "tcp_transfer_seconds": "duration of TCP transfers",
+        "udp_transfer_seconds": "duration of UDP transfers",
+    }
+
+    @classmethod
+    def merge(cls, snapshots):
+        """Totals of the snapshots of several processes"""
+        return merge_snapshots(snapshots, cls.COUNTERS + cls.GAUGES, cls.HISTOGRAMS)
+
+    @classmethod
+    def render(cls, snapshot):
+        return render_prometheus(snapshot, cls.GAUGES, cls.HISTOGRAMS, cls.DESCRIPTIONS)
+
+
+def format_stats(totals, previous, interval):
+    """One line of the periodic stats log, speeds are the change since the previous totals"""
+    sent = totals["tcp_bytes_sent"] + totals["udp_bytes_sent"]
+    previous_sent = previous["tcp_bytes_sent"] + previous["udp_bytes_sent"]
+    speed = (sent - previous_sent) * 8 / interval
+    received = totals["tcp_bytes_received"] + totals["udp_bytes_received"]
+    previous_received = previous["tcp_bytes_received"] + previous["udp_bytes_received"]
+    receive_speed = (received - previous_received) * 8 / interval
+    packet_rate = (totals["udp_packets"] - previous["udp_packets"]) / interval
+    return (f"TCP connections: {totals['tcp_connections']}, UDP transfers: {totals['udp_transfers']}, "
+            f"uploads: {totals['tcp_uploads'] + totals['udp_uploads']}, active: {totals['active_transfers']}, "
+            f"speed: {speed:.2f} bits/second, received: {receive_speed:.2f} bits/second, "
+            f"UDP: {packet_rate:.0f} packets/second, retransmitted: {totals['udp_retransmits']}, "
+            f"rejected: {totals['rejected']}, send errors: {totals['send_errors']}, "
+            f"malformed: {totals['malformed_packets']}")
 
-# Server Configuration
-MAGIC_COOKIE = 0xabcddcba
-OFFER_MESSAGE_TYPE = 0x2
-REQUEST_MESSAGE_TYPE = 0x3
-PAYLOAD_MESSAGE_TYPE = 0x4
-UDP_BROADCAST_PORT = 13117
-UDP_LISTENER_PORT = 60000
-TCP_PORT = 12345
 
 class SpeedTestServer:
-    def __init__(self):
+    def __init__(self, send_mode=SEND_MODE_SENDALL, udp_rate=0, udp_payload_size=DEFAULT_UDP_PAYLOAD_SIZE,
+                 udp_io=UDP_IO_BATCH, announcer=None, admission=None,
+                 metrics_port=None, metrics_address=DEFAULT_METRICS_ADDRESS, stats_interval=None, profiler=None,
+                 tcp_profile=PROFILE_DEFAULT, payload=PAYLOAD_CONSTANT, payload_seed=DEFAULT_SEED, payload_file=None):
         """initializes the sockets variables and condition"""
         self.broadcast_socket = None 
         self.udp_listener_socket = None
         self.server_tcp_socket = None
 
+        # Worker processes bind their listeners with SO_REUSEPORT and leave the offers to the parent
+        self.broadcast = True
+        # where the offers go and the answers to solicits, see discovery.py
+        self.announcer = announcer or OfferAnnouncer(MAGIC_COOKIE, UDP_BROADCAST_PORT)
+        self.reuse_port = False
+        self.stats = ServerStats()
+        # client address -> feedback queue of its running reliable UDP transfer
+        self.feedback_queues = {}
+        # client address -> receiver of its running UDP upload, fed by the listener
+        self.upload_receivers = {}
+        # active transfers of all workers, reported to the parent that sends the offers in multi-process mode
+        self.worker_load = None
+        self.worker_totals = None  # every counter of all workers, what the parent's metrics endpoint serves
+        self.metrics_port = metrics_port  # None: no /metrics endpoint
+        self.metrics_address = metrics_address
+        self.stats_interval = stats_interval  # None: no periodic stats log in single-process mode
+        # --profile: stage timings of the send loops and sampled stacks or cProfile stats, None when off
+        self.profiler = profiler
+        # Bounds the requests the server holds and the transfers it runs, the pool is created by run() so every
+        # worker process has its own threads
+        self.admission = admission or AdmissionController()
+        self.pool = None
+
         # Condition to make sure listening starts after broadcast
         self.condition = threading.Condition()
 
-    def start_udp_broadcast(self):
-        """Opening the socket and start broadcasts UDP offer messages every second."""
+        if send_mode == SEND_MODE_SENDFILE and not hasattr(os, "sendfile"):
+            print("os.sendfile is not available on this platform, falling back to sendall")
+            send_mode = SEND_MODE_SENDALL
+        self.send_mode = send_mode
 
-        
+        # Read-only patterns shared by every connection, so memory does not grow with the requested size: the
+        # server's own for requests that don't name a payload and the ones requests asked for, see payloads.py
+        self.payload_file = payload_file
+        self.pattern_lock = threading.Lock()
+        self.pattern = self.pattern_of((payload, payload_seed))
+
+        # UDP defaults for requests that don't carry their own pacing options
+        self.udp_rate = udp_rate
+        self.udp_payload_size = min(udp_payload_size, MAX_UDP_PAYLOAD_SIZE)
+        self.udp_io = udp_io
+        # TCP tuning profile of the connections whose request doesn't name one, see tcp_tuning.py
+        self.tcp_profile = tcp_profile
+
+    def start_udp_broadcast(self):
+        """Opening the socket and start sending UDP offer messages every offer interval, answering solicits in
+        between."""
         with self.condition:
-            self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-            self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            print(f"Server started, listening on IP address {socket.gethostbyname(socket.gethostname())}")
+            self.broadcast_socket = self.announcer.open()
+            print(f"Server started, {self.announcer.describe()}")
             self.condition.notify_all()  # Notify that the broadcast socket is ready
 
-        while True:
-            message = struct.pack('!IBHH', MAGIC_COOKIE, OFFER_MESSAGE_TYPE, UDP_LISTENER_PORT, TCP_PORT)
-            self.broadcast_socket.sendto(message, ('192.168.82.255', UDP_BROADCAST_PORT))
-            time.sleep(1)
+        self.announcer.serve(self.offer_message)
+
+    def load(self):
+        """Transfers running now, of every worker in multi-process mode"""
+        return self.worker_load if self.worker_load is not None else self.stats.snapshot()["active_transfers"]
 
-    def handle_tcp_connection(self, client_socket):
+    def offer_message(self):
+        """Offer with the ports and the current load, clients that only read the ports ignore the load"""
+        return (struct.pack(OFFER_FORMAT, MAGIC_COOKIE, OFFER_MESSAGE_TYPE, UDP_LISTENER_PORT, TCP_PORT)
+                + struct.pack(OFFER_LOAD_FORMAT, min(self.load(), 0xFFFF)))
+
+    def handle_tcp_connection(self, client_socket, session=None, resumed=False):
         """Handles a single TCP client connection. after accepting the connection and decoding the file size start
-        sending the data through the TCP connection"""
+        sending the data through the TCP connection, once the admission controller gave it a transfer slot. A
+        keepalive request leaves the connection open for the next request, a SESSION line makes it the control
+        connection of a session. Between requests both wait in the idle selector, which hands them back with
+        their session and resumed set."""
+        duration = None
+        keep = False
         try:
-            data = client_socket.recv(1024).decode() # decoding from binary representation to string
-            file_size = int(data.strip()) # clean the message of the \n so we can turn it to a integer
-            payload = b'a' * file_size  # generate file of requested size
-            client_socket.sendall(payload) # 
+            client = client_socket.getpeername()[0]
+            client_socket.settimeout(REQUEST_READ_TIMEOUT)
+            data = client_socket.recv(1024)
+            if session is not None or data.startswith(SESSION_COMMAND.encode()):
+                session = self.serve_session(client_socket, session, data)
+                keep = session is not None
+                return
+            if not data:
+                return  # a kept alive connection the client closed
+            if resumed:
+                self.stats.add("reused_connections")
+            client_socket.settimeout(None)
+            # an upload's payload follows the request line and may have come with it
+            line, _, payload = data.partition(b"\n")
+            try:
+                request = parse_tcp_request(line.decode()) # decoding from binary representation to string
+            except (ValueError, IndexError, UnicodeDecodeError):
+                self.stats.add("malformed_packets")
+                raise
+            file_size, duration = request["size"], request["time"]
+            profile = self.tcp_profile_of(request)
+            pattern = self.pattern_of(request["payload"])
+            self.admission.check(file_size, duration)
+            with self.transfer_slot(client, "tcp"):
+                self.stats.add("tcp_connections")
+                settings = self.apply_tcp_profile(client_socket, profile)
+                if request["direction"] == DIRECTION_UPLOAD:
+                    figures = self.receive_upload(client_socket, file_size, duration, len(payload))
+                    client_socket.sendall(self.upload_result_line(figures))
+                else:
+                    if request["status"]:
+                        client_socket.sendall(TCP_STATUS_OK)
+                    self.send_pattern(client_socket, file_size, duration, zerocopy=settings["zerocopy"],
+                                      offset=request["offset"], pattern=pattern)
+            keep = request["keepalive"] and duration is None
+        except TransferRejected as e:
+            self.reject_tcp(client_socket, e)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # closing the connection is how a client ends a time=inf transfer
+            if duration is None:
+                self.stats.add("send_errors")
+                print(f"Error handling TCP connection: {e}")
         except Exception as e:
+            if isinstance(e, OSError):
+                self.stats.add("send_errors")
             print(f"Error handling TCP connection: {e}")
         finally:
+            if keep:
+                self.idle_connections.park(client_socket, session)
+            else:
+                client_socket.close()
+
+    def resume_connection(self, client_socket, session):
+        """Hands a parked connection the client sent something on back to the worker pool"""
+        if not self.dispatch(self.handle_tcp_connection, client_socket, session, True):
+            self.reject_tcp(client_socket, "server busy")
             client_socket.close()
 
-    def handle_udp_connection(self, client_address, request_data):
-        """Handles a single UDP client request."""
+    def serve_session(self, client_socket, session, data):
+        """Answers the command lines of a session's control connection that came with data, a SESSION line opens
+        the session. Returns the session while it stays open, None once the client said goodbye or closed the
+        connection."""
+        while data and not data.endswith(b"\n"):
+            if len(data) > MAX_COMMAND_SIZE:
+                raise ValueError(f"session command longer than {MAX_COMMAND_SIZE} bytes")
+            more = client_socket.recv(1024)
+            if not more:
+                return None
+            data += more
+        lines = data.splitlines()
+        if not lines:
+            return None
+        if session is None:
+            session = self.open_session()
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_socket.sendall(session.opened())
+            lines = lines[1:]
+        for line in lines:
+            client_socket.sendall(session.handle(line.decode(errors="replace")))
+            if session.closed:
+                return None
+        return session
+
+    def open_session(self):
+        return ServerSession(self.admission.check, self.load, self.stats, {
+            "udp_port": UDP_LISTENER_PORT,
+            "tcp_port": TCP_PORT,
+            "max_file_size": self.admission.max_file_size,
+            "max_duration": self.admission.max_duration,
+        })
+
+    def receive_upload(self, client_socket, file_size, duration, received=0):
+        """Receives a TCP upload into one preallocated buffer until file_size bytes are in or the client shuts
+        its side down, and returns the server's figures. received is the payload that came with the request.
+        A time-bounded upload is ended by the client, the server gives up REQUEST_READ_TIMEOUT past the deadline."""
+        limit, deadline = transfer_limits(file_size, duration)
+        give_up = deadline + REQUEST_READ_TIMEOUT if deadline is not None else None
+        self.stats.add("tcp_uploads")
+        buffer = memoryview(bytearray(UPLOAD_BUFFER_SIZE))
+        timer = TransferTimer(time.perf_counter_ns())
+        if received:
+            timer.record(timer.request_ns)
+        stats = self.stats.shard()
+        stats["tcp_bytes_received"] += received
+        client_socket.settimeout(REQUEST_READ_TIMEOUT)  # a client that went quiet doesn't hold its slot forever
+        while received < limit:
+            count = client_socket.recv_into(buffer, min(UPLOAD_BUFFER_SIZE, limit - received))
+            if not count:
+                break
+            arrival_ns = time.perf_counter_ns()
+            timer.record(arrival_ns)
+            received += count
+            stats["tcp_bytes_received"] += count
+            if give_up is not None and arrival_ns / 1e9 >= give_up:
+                break
+        return throughput_figures(received, timer.summary())
+
+    @staticmethod
+    def upload_result_line(figures):
+        return f"{TCP_RESULT_PREFIX}{json.dumps(figures)}\n".encode()
+
+    def pattern_of(self, payload):
+        """The pattern of a requested (kind, seed), None for the server's own. Raises TransferRejected for a
+        kind the server doesn't know or can't serve."""
+        if payload is None:
+            return self.pattern
+        kind, seed = payload
+        if kind not in PAYLOAD_KINDS:
+            raise TransferRejected(f"unknown payload {kind!r}, expected one of {', '.join(PAYLOAD_KINDS)}")
+        if kind == PAYLOAD_FILE and self.payload_file is None:
+            raise TransferRejected("this server has no payload file")
+        # only the random payload has a seed, the others share one cached pattern whatever the request says
+        pattern = load_pattern(kind, seed if kind == PAYLOAD_RANDOM else DEFAULT_SEED,
+                               self.payload_file if kind == PAYLOAD_FILE else None)
+        if self.send_mode == SEND_MODE_SENDFILE and pattern.file is None:
+            with self.pattern_lock:
+                if pattern.file is None:
+                    pattern.file = create_pattern_file(pattern.data)
+        return pattern
+
+    def tcp_profile_of(self, request):
+        """The tuning profile a TCP request asked for, raises TransferRejected for a profile this server lacks"""
+        profile = request["profile"] or self.tcp_profile
+        if profile not in PROFILES:
+            raise TransferRejected(f"unknown TCP profile {profile!r}, expected one of {', '.join(PROFILES)}")
+        return profile
+
+    @staticmethod
+    def apply_tcp_profile(sock, profile):
+        """Applies a tuning profile to a connection, settings the kernel refuses are reported and skipped"""
+        settings = apply_profile(sock, profile)
+        if settings["errors"]:
+            print(f"TCP profile {profile} partly applied: {'; '.join(settings['errors'])}")
+        return settings
+
+    @contextmanager
+    def transfer_slot(self, client, protocol):
+        """Holds one of the admission controller's transfer slots for client while the transfer runs, waiting
+        for it up to the queue timeout, and records how long the transfer took"""
+        self.admission.acquire(client)
+        self.stats.add("active_transfers")
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats.observe(f"{protocol}_transfer_seconds", time.perf_counter() - start_time)
+            self.stats.add("active_transfers", -1)
+            self.admission.release(client)
+
+    def dispatch(self, handler, *args):
+        """Runs a request handler on the worker pool, False when the pool and its queue are full"""
+        if not self.admission.enter():
+            return False
+        if self.profiler:
+            handler = self.profiler.wrap(handler)
+
+        def run():
+            try:
+                handler(*args)
+            finally:
+                self.admission.leave()
+
+        self.pool.submit(run)
+        return True
+
+    def reject_tcp(self, client_socket, reason):
+        """Tells a TCP client why its request was turned down, the caller closes the connection"""
+        self.stats.add("rejected")
         try:
-            file_size = struct.unpack('!Q', request_data[5:13])[0]
+            client_socket.sendall(TCP_REJECTION_PREFIX + f"{reason}\n".encode())
+        except OSError:
+            pass
 
-            # Calculate the total number of segments needed to send the file.
-            # Each segment contains 1024 bytes of payload. Adding 1023 ensures
-            # any remainder results in an additional segment (rounding up)
-            total_segments = (file_size + 1023) // 1024  # Assuming 1024-byte packets
+    @staticmethod
+    def reject_message(reason):
+        return struct.pack('!IB', MAGIC_COOKIE, REJECT_MESSAGE_TYPE) + str(reason).encode()
 
-            for segment in range(total_segments):
-                payload = struct.pack(
-                    '!IBQQ', MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, total_segments, segment
-                ) + b'a' * 1024 # making the payload
-                self.udp_listener_socket.sendto(payload, client_address)
-                # print(f"Sending segment {segment + 1}/{total_segments} to {client_address}")
-                # time.sleep(0.000000000000000000000001)  # Add delay, helps so we wont drop packets
+    def reject_udp(self, client_address, reason):
+        """Tells a UDP client why its request was turned down"""
+        self.stats.add("rejected")
+        self.send_udp_message(self.reject_message(reason), client_address)
 
+    def send_udp_message(self, message, client_address, repeats=1):
+        """Sends a control datagram from the UDP listener, a client that went away is not an error"""
+        try:
+            for _ in range(repeats):
+                self.udp_listener_socket.sendto(message, client_address)
+        except OSError:
+            pass
+
+    def send_pattern(self, client_socket, file_size, duration=None, zerocopy=False, offset=0, pattern=None):
+        """Streams file_size bytes of a shared pattern (the server's by default), or streams it for duration
+        seconds, using the configured send mode. A socket with SO_ZEROCOPY sends with MSG_ZEROCOPY instead of
+        sendall, sendfile doesn't copy the pattern anyway. The stream starts offset bytes into the transfer, the
+        pattern repeats every PATTERN_BUFFER_SIZE bytes so a stripe starts at offset modulo its size."""
+        pattern = pattern or self.pattern
+        offset %= PATTERN_BUFFER_SIZE
+        if duration is not None:
+            self.stream_pattern(client_socket, file_size, duration, offset, pattern)
+        elif self.send_mode == SEND_MODE_SENDFILE:
+            self.sendfile_pattern(client_socket, file_size, offset, pattern)
+        elif zerocopy:
+            self.zerocopy_pattern(client_socket, file_size, offset, pattern)
+        else:
+            self.sendall_pattern(client_socket, file_size, offset, pattern)
+
+    def sendall_pattern(self, client_socket, file_size, offset, pattern):
+        """Sends the pattern in memoryview slices up to its end, slicing a memoryview does not copy the data"""
+        remaining = file_size
+        while remaining > 0:
+            chunk = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            client_socket.sendall(pattern.view[offset:offset + chunk])
+            self.record_tcp_send(chunk)
+            remaining -= chunk
+            offset = (offset + chunk) % PATTERN_BUFFER_SIZE
+
+    def zerocopy_pattern(self, client_socket, file_size, offset, pattern):
+        """Sends the pattern with MSG_ZEROCOPY, the kernel pins the pages of the shared pattern instead of copying
+        them (on loopback it copies anyway). The pattern is never written, so sends don't wait for completions."""
+        remaining = file_size
+        undrained = 0
+        while remaining > 0:
+            count = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            sent = send_zerocopy(client_socket, pattern.view[offset:offset + count])
+            if sent == 0:
+                raise ConnectionError("send made no progress, connection closed by peer")
+            self.record_tcp_send(sent)
+            remaining -= sent
+            offset = (offset + sent) % PATTERN_BUFFER_SIZE
+            undrained += sent
+            if undrained >= ZEROCOPY_DRAIN_BYTES:
+                drain_zerocopy_completions(client_socket)
+                undrained = 0
+
+    def sendfile_pattern(self, client_socket, file_size, offset, pattern):
+        """Sends the pattern straight from the page cache with os.sendfile, wrapping around the pattern file"""
+        in_fd = pattern.file.fileno()
+        out_fd = client_socket.fileno()
+        remaining = file_size
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, min(remaining, PATTERN_BUFFER_SIZE - offset))
+            if sent == 0:
+                raise ConnectionError("sendfile made no progress, connection closed by peer")
+            self.record_tcp_send(sent)
+            remaining -= sent
+            offset = (offset + sent) % PATTERN_BUFFER_SIZE
+
+    def record_tcp_send(self, sent):
+        stats = self.stats.shard()
+        stats["tcp_sends"] += 1
+        stats["tcp_bytes_sent"] += sent
+
+    def stream_pattern(self, client_socket, file_size, duration, offset, pattern):
+        """Streams the pattern until the deadline (or file_size bytes, when given) with non-blocking sends, a
+        blocking sendall of a whole slice could hold a slow link well past the deadline"""
+        remaining, deadline = transfer_limits(file_size, duration)
+        use_sendfile = self.send_mode == SEND_MODE_SENDFILE
+        in_fd = pattern.file.fileno() if use_sendfile else None
+        out_fd = client_socket.fileno()
+        client_socket.setblocking(False)
+        while remaining > 0:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            count = min(remaining, PATTERN_BUFFER_SIZE - offset)
+            try:
+                if use_sendfile:
+                    sent = os.sendfile(out_fd, in_fd, offset, count)
+                else:
+                    sent = client_socket.send(pattern.view[offset:offset + count])
+            except BlockingIOError:
+                self.stats.add("send_eagain")
+                wait_socket(client_socket, select.POLLOUT, min(DEADLINE_CHECK_INTERVAL, deadline - now))
+                continue
+            if sent == 0:
+                raise ConnectionError("sendfile made no progress, connection closed by peer")
+            self.record_tcp_send(sent)
+            remaining -= sent
+            offset = (offset + sent) % PATTERN_BUFFER_SIZE
+
+    def handle_udp_connection(self, client_address, request_data):
+        """Handles a single UDP client request, once the admission controller gave it a transfer slot."""
+        try:
+            request = self.admit_udp_request(request_data)
+            with self.transfer_slot(client_address[0], "udp"):
+                # built only once the slot is taken, queued requests hold no send buffers
+                transfer = self.create_udp_transfer(client_address, request)
+                self.stats.add("udp_transfers")
+                # this thread's counters, updated after every batch without a lock
+                stats = self.stats.shard()
+                payload_size = transfer.payload_size
+                stages = self.profiler.stages if self.profiler else None
+
+                batches = self.reliable_batches(transfer, client_address) if transfer.reliable else transfer.batches()
+                for first_segment, count in batches:
+                    if transfer.pacer:
+                        # paces the loop instead of sleeping a fixed delay, before building so timestamps are exact
+                        transfer.pacer.consume(count * transfer.builder.datagram_size)
+                    if stages:
+                        self.send_timed(transfer, first_segment, count, stages)
+                    else:
+                        transfer.sender.send(transfer.builder.build(first_segment, count))
+                    stats["udp_packets"] += count
+                    stats["udp_bytes_sent"] += count * payload_size
+                    # print(f"Sending segments {first_segment + 1}-{first_segment + count}/{transfer.total_segments} to {client_address}")
+                if transfer.reliable:
+                    self.stats.add("udp_retransmits", transfer.reliable.retransmitted)
+
+        except TransferRejected as e:
+            self.reject_udp(client_address, e)
         except Exception as e:
+            if isinstance(e, OSError):
+                self.stats.add("send_errors")
             print(f"Error handling UDP connection: {e}")
 
+    def handle_udp_upload(self, client_address, request_data):
+        """Handles a UDP upload request: once the admission controller gave it a transfer slot, the client is
+        told to start and the listener counts its segments until every one is in or the client goes quiet."""
+        try:
+            request = self.admit_udp_request(request_data)
+            with self.transfer_slot(client_address[0], "udp"):
+                receiver = self.start_udp_upload(client_address, request)
+                try:
+                    receiver.wait()
+                finally:
+                    self.finish_udp_upload(client_address, receiver)
+        except TransferRejected as e:
+            self.reject_udp(client_address, e)
+        except Exception as e:
+            print(f"Error handling UDP upload: {e}")
+
+    def start_udp_upload(self, client_address, request):
+        """Registers the receiver of an admitted upload with the listener and tells the client the rate and
+        payload size to send with. Raises TransferRejected for an upload with more segments than a receiver
+        tracks."""
+        file_size, duration, rate, payload_size, _, _ = request
+        total_segments = upload_segments(file_size, duration, payload_size)
+        if total_segments is not None and total_segments > MAX_UPLOAD_SEGMENTS:
+            raise TransferRejected(f"upload of {file_size} bytes exceeds {MAX_UPLOAD_SEGMENTS} segments")
+        receiver = UploadReceiver(total_segments)
+        previous = self.upload_receivers.get(client_address)
+        if previous is not None:
+            previous.done.set()  # a pooled socket's next upload replaces one that is still waiting for segments
+        self.upload_receivers[client_address] = receiver
+        self.stats.add("udp_uploads")
+        ready = UPLOAD_READY.pack(MAGIC_COOKIE, UPLOAD_READY_MESSAGE_TYPE, rate, payload_size)
+        self.send_udp_message(ready, client_address, RESULT_REPEATS)
+        return receiver
+
+    def finish_udp_upload(self, client_address, receiver):
+        """Unregisters an upload, counts what it received and sends the client the server's figures. An upload a
+        newer one from the same address replaced sends nothing, the client waits for the newer one's result."""
+        current = self.upload_receivers.get(client_address) is receiver
+        if current:
+            del self.upload_receivers[client_address]
+        figures = receiver.summary()
+        stats = self.stats.shard()
+        stats["udp_bytes_received"] += figures["bytes"]
+        stats["udp_packets_received"] += figures["received"]
+        if current:
+            self.send_udp_message(pack_result(MAGIC_COOKIE, figures), client_address, RESULT_REPEATS)
+
+    @staticmethod
+    def send_timed(transfer, first_segment, count, stages):
+        """Builds and sends a batch like the send loop does, timing the pack and send stages"""
+        start_ns = time.perf_counter_ns()
+        datagrams = transfer.builder.build(first_segment, count)
+        built_ns = time.perf_counter_ns()
+        transfer.sender.send(datagrams)
+        stages.add("pack", built_ns - start_ns, count)
+        stages.add("send", time.perf_counter_ns() - built_ns, count)
+
+    def reliable_batches(self, transfer, client_address):
+        """Yields the batches of a reliable transfer, applying the client's feedback between batches and
+        waiting for it while the window is full"""
+        feedback = queue.Queue()
+        self.feedback_queues[client_address] = feedback
+        reliable = transfer.reliable
+        try:
+            # a newer reliable transfer to the same address (a pooled socket's next round) takes its feedback over
+            while not reliable.finished and self.feedback_queues.get(client_address) is feedback:
+                while not feedback.empty():
+                    reliable.on_feedback(feedback.get_nowait())
+                batch = reliable.next_batch(transfer.batch_size)
+                if batch is None:
+                    try:
+                        reliable.on_feedback(feedback.get(timeout=FEEDBACK_INTERVAL))
+                    except queue.Empty:
+                        pass
+                    continue
+                yield batch
+        finally:
+            if self.feedback_queues.get(client_address) is feedback:
+                del self.feedback_queues[client_address]
+
+    def admit_udp_request(self, request_data):
+        """Parses a UDP request and applies the admission policy: raises TransferRejected beyond the size and
+        duration limits and for a payload the server can't serve, holds the rate to the server's maximum. The
+        payload is returned as its pattern."""
+        file_size, duration, rate, payload_size, flags, payload = parse_udp_request(
+            request_data, self.udp_rate, self.udp_payload_size)
+        self.admission.check(file_size, duration)
+        return (file_size, duration, self.admission.limit_rate(rate), payload_size, flags,
+                self.pattern_of(payload))
+
+    def create_udp_transfer(self, client_address, request, burst_packets=PACING_BURST_PACKETS):
+        """Builds the transfer of an admitted request, GSO is only tried in the batch I/O mode"""
+        file_size, duration, rate, payload_size, flags, pattern = request
+        return UdpTransfer(self.udp_listener_socket, client_address, file_size, rate, payload_size, flags,
+                           use_gso=self.udp_io == UDP_IO_BATCH, burst_packets=burst_packets, duration=duration,
+                           pattern=pattern)
 
     def start_tcp_listener(self):
-        """Listens for TCP connections and spawns threads to handle them."""
+        """Listens for TCP connections and hands them to the worker pool, rejecting them when it is full."""
         self.server_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # self.server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)  # Allow immediate reuse
+        # Allow an immediate restart while connections of the previous run are still in TIME_WAIT
+        self.server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_tcp_socket.bind(("", TCP_PORT))
         self.server_tcp_socket.listen(socket.SOMAXCONN)
         # print("TCP server listening...") #decoding peropuse
 
         while True:
             client_socket, _ = self.server_tcp_socket.accept()
-            threading.Thread(target=self.handle_tcp_connection, args=(client_socket,)).start()
+            if not self.dispatch(self.handle_tcp_connection, client_socket):
+                self.reject_tcp(client_socket, "server busy")
+                client_socket.close()
 
     def start_udp_listener(self):
-        """Listens for UDP requests and spawns threads to handle them."""
+        """Listens for UDP requests and hands them to the worker pool, rejecting them when it is full."""
         with self.condition:
-            while self.broadcast_socket is None:
+            while self.broadcast and self.broadcast_socket is None:
                 self.condition.wait()  # Wait until the broadcast socket is initialized
 
         # Opening socket for listening on a specific port (mainly had an issue with using the same computer to test)
         self.udp_listener_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.udp_listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.udp_listener_socket.bind(("", UDP_LISTENER_PORT))
 
+        # every datagram is received into the same buffer, sized for the largest upload segments
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
         while True:
             try:
-                data, addr = self.udp_listener_socket.recvfrom(4096)
-                # print(f"Received UDP packet from {addr}, data length: {len(data)}") # debugging log
-
-                cookie, message_type = struct.unpack('!IB', data[:5]) 
-                if cookie == MAGIC_COOKIE and message_type == REQUEST_MESSAGE_TYPE:
-                    # print(f"Dispatching UDP handler for {addr}") # debugging log
-                    # For each request message open a new thread to start sending the segments to the client
-                    threading.Thread(target=self.handle_udp_connection, args=(addr, data)).start()
+                nbytes, addr = self.udp_listener_socket.recvfrom_into(buffer)
+            except ConnectionRefusedError:
+                # the ICMP port unreachable of a client that went away mid-transfer, nothing to act on
+                self.stats.add("receive_errors")
+                continue
+            except OSError as e:
+                self.stats.add("receive_errors")
+                print(f"Error receiving UDP data: {e}")
+                continue
+            # print(f"Received UDP packet from {addr}, data length: {nbytes}") # debugging log
+            try:
+                self.handle_datagram(view[:nbytes], addr)
             except Exception as e:
-                pass
-            #     print(f"Error receiving UDP data: {e}")
+                # one datagram that can't be handled must not end the listener every UDP transfer depends on
+                self.stats.add("malformed_packets")
+                print(f"Error handling UDP datagram from {addr}: {e}")
+
+    def handle_datagram(self, data, addr):
+        """Dispatches a datagram of the UDP listener, anything that isn't a request, feedback or upload segment
+        of this protocol is counted as malformed and dropped. data may be a view of the listener's buffer, what
+        outlives the call is copied."""
+        message_type = message_kind(data)
+        if message_type in PAYLOAD_MESSAGE_TYPES:
+            receiver = self.upload_receivers.get(addr)
+            if receiver:  # late segments of an upload that already ended are dropped
+                receiver.record(data, message_type == TIMESTAMPED_PAYLOAD_MESSAGE_TYPE, time.perf_counter_ns())
+        elif message_type == REQUEST_MESSAGE_TYPE:
+            # print(f"Dispatching UDP handler for {addr}") # debugging log
+            # Every request message is sent by a pool thread, unless the pool and its queue are full
+            if not self.dispatch(self.handle_udp_connection, addr, bytes(data)):
+                self.reject_udp(addr, "server busy")
+        elif message_type == UPLOAD_REQUEST_MESSAGE_TYPE:
+            if not self.dispatch(self.handle_udp_upload, addr, bytes(data)):
+                self.reject_udp(addr, "server busy")
+        elif message_type == NACK_MESSAGE_TYPE:
+            feedback = self.feedback_queues.get(addr)
+            if feedback:
+                feedback.put(bytes(data))
+        else:
+            self.stats.add("malformed_packets")
+
+    def start(self, workers=1):
+        """Starts the server, either in this process or spread over worker processes."""
+        if workers > 1:
+            self.start_workers(workers)
+        else:
+            self.start_metrics()
+            if self.stats_interval:
+                threading.Thread(target=self.log_stats, daemon=True).start()
+            self.run()
 
-    def start(self):
+    def runtime_gauges(self):
+        """Gauges sampled when a snapshot is taken rather than recorded by the transfers. cpu_seconds is the
+        process's time.process_time(), finer than the clock ticks other processes can read from /proc."""
+        return {"threads": threading.active_count(), "pending_requests": self.admission.pending,
+                "cpu_seconds": time.process_time()}
+
+    def metrics_snapshot(self):
+        """The counters of this process with its runtime gauges, or the totals of all workers in the parent"""
+        if self.worker_totals is not None:
+            return self.worker_totals
+        snapshot = self.stats.snapshot()
+        snapshot.update(self.runtime_gauges())
+        return snapshot
+
+    def start_metrics(self):
+        """Serves /metrics and /stats when a metrics port is configured"""
+        if self.metrics_port is None:
+            return
+        serve_metrics(self.metrics_address, self.metrics_port, self.metrics_snapshot, ServerStats.render)
+        print(f"Metrics on http://{self.metrics_address}:{self.metrics_port}/metrics")
+
+    def log_stats(self):
+        """Prints the counters every stats interval in single-process mode"""
+        previous = self.metrics_snapshot()
+        while True:
+            time.sleep(self.stats_interval)
+            totals = self.metrics_snapshot()
+            print(format_stats(totals, previous, self.stats_interval))
+            previous = totals
+
+    def run(self):
         """Starts the server threads for broadcasting and handling requests."""
-        udp_broadcast_thread = threading.Thread(target=self.start_udp_broadcast, daemon=True)
-        udp_broadcast_thread.start()
+        # sized to every request the admission controller lets in, so a submitted handler never waits for a thread
+        self.pool = ThreadPoolExecutor(max_workers=self.admission.capacity, thread_name_prefix="transfer")
+        self.idle_connections = IdleConnections(self.resume_connection)
+        threading.Thread(target=self.idle_connections.run, daemon=True).start()
+        if self.broadcast:
+            udp_broadcast_thread = threading.Thread(target=self.start_udp_broadcast, daemon=True)
+            udp_broadcast_thread.start()
 
         udp_listener_thread = threading.Thread(target=self.start_udp_listener, daemon=True)
         udp_listener_thread.start()
 
-        self.start_tcp_listener()
+        if self.profiler:
+            self.profiler.start(FLUSH_INTERVAL)
+        try:
+            self.start_tcp_listener()
+        finally:
+            self.stop_profiler()
+
+    def stop_profiler(self):
+        """Writes the profile one last time when the server is interrupted"""
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.report()
+
+    def start_workers(self, workers):
+        """Forks worker processes that share the ports with SO_REUSEPORT, this process only sends the offers
+        and prints the aggregated counters of all workers"""
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("worker processes need SO_REUSEPORT, which this platform does not support")
+
+        # fork before any thread is started so the workers begin from a clean copy of the server
+        context = multiprocessing.get_context("fork")
+        stats_queue = context.Queue()
+        self.reuse_port = True
+        processes = []
+        for worker_id in range(workers):
+            process = context.Process(target=self.run_worker, args=(worker_id, stats_queue), daemon=True)
+            process.start()
+            processes.append(process)
+
+        udp_broadcast_thread = threading.Thread(target=self.start_udp_broadcast, daemon=True)
+        udp_broadcast_thread.start()
+        self.start_metrics()
+
+        self.report_worker_stats(stats_queue, processes)
+
+    def run_worker(self, worker_id, stats_queue):
+        """Entry point of a worker process, serves transfers and reports its counters to the parent."""
+        self.broadcast = False
+        parent_pid = os.getppid()
+        if self.profiler:
+            self.profiler.output = f"{self.profiler.output}.worker{worker_id}"
+
+        def report_stats():
+            while True:
+                time.sleep(STATS_INTERVAL)
+                if os.getppid() != parent_pid:
+                    os._exit(0)  # the parent is gone, don't keep holding the ports
+                stats_queue.put((worker_id, self.metrics_snapshot()))
+
+        threading.Thread(target=report_stats, daemon=True).start()
+        self.run()
+
+    def report_worker_stats(self, stats_queue, processes):
+        """Sums the latest counters of every worker and prints the aggregate throughput once per interval. The
+        parent doesn't outlive its workers: once every one of them has exited (e.g. a bind that failed with
+        EADDRINUSE) it exits with an error instead of offering a server that serves nothing."""
+        workers = len(processes)
+        latest = {}
+        previous = ServerStats.merge([])
+        running = set(range(workers))
+        while True:
+            time.sleep(STATS_INTERVAL)
+            try:
+                while True:
+                    worker_id, snapshot = stats_queue.get_nowait()
+                    latest[worker_id] = snapshot
+            except queue.Empty:
+                pass
+
+            for worker_id in sorted(running):
+                if processes[worker_id].is_alive():
+                    continue
+                # not forked again: the parent runs threads by now, and a worker that died binding would again
+                running.discard(worker_id)
+                latest.pop(worker_id, None)
+                print(f"Worker {worker_id} exited with code {processes[worker_id].exitcode}, "
+                      f"{len(running)}/{workers} workers running")
+            if not running:
+                raise SystemExit("every worker process exited, stopping the server")
+
+            totals = ServerStats.merge(latest.values())
+            totals["threads"] += threading.active_count()  # the parent's own threads
+            self.worker_totals = totals
+            self.worker_load = totals["active_transfers"]
+            print(f"{len(latest)}/{workers} workers reporting, " + format_stats(totals, previous, STATS_INTERVAL))
+            previous = totals
 
 if __name__ == "__main__":
-    server = SpeedTestServer()
-    server.start()
+    parser = argparse.ArgumentParser(description="Speed test server")
+    parser.add_argument("--send-mode", choices=SEND_MODES, default=SEND_MODE_SENDALL,
+                        help="how TCP payloads are sent, used to compare sendall slicing against sendfile")
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND_THREADED,
+                        help="thread per transfer, or a single event loop for all transfers")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the ports with SO_REUSEPORT")
+    parser.add_argument("--udp-rate", type=int, default=0,
+                        help="default UDP target bits/second for requests that don't set one, 0 sends unpaced")
+    parser.add_argument("--udp-payload-size", type=int, default=DEFAULT_UDP_PAYLOAD_SIZE,
+                        help=f"default UDP payload bytes per datagram, up to {MAX_UDP_PAYLOAD_SIZE}")
+    parser.add_argument("--udp-io", choices=UDP_IO_MODES, default=UDP_IO_BATCH,
+                        help="send many UDP datagrams per syscall (falls back when unsupported) or one per sendto")
+    parser.add_argument("--tcp-profile", choices=PROFILES, default=PROFILE_DEFAULT,
+                        help="TCP tuning profile of the connections whose request doesn't name one")
+    parser.add_argument("--payload", choices=PAYLOAD_KINDS, default=PAYLOAD_CONSTANT,
+                        help="payload of the requests that don't name one: a constant byte, seeded PRNG bytes that "
+                             "compressing middleboxes can't shrink, or --payload-file replayed")
+    parser.add_argument("--payload-seed", type=int, default=DEFAULT_SEED, help="seed of the random payload")
+    parser.add_argument("--payload-file", default=None,
+                        help="file whose first MiB the file payload replays, also what requests for it get")
+    parser.add_argument("--broadcast-address", action="append", default=None,
+                        help="broadcast address the offers are sent to, repeatable (default: the broadcast address "
+                             "of every local subnet)")
+    parser.add_argument("--broadcast-offers", action=argparse.BooleanOptionalAction, default=True,
+                        help="broadcast the offers, --no-broadcast-offers leaves multicast, unicast and solicits")
+    parser.add_argument("--multicast-group", default=None,
+                        help="multicast group the offers are sent to and solicits are received on, e.g. 239.255.13.117")
+    parser.add_argument("--multicast-ttl", type=int, default=DEFAULT_MULTICAST_TTL,
+                        help="routers a multicast offer may cross")
+    parser.add_argument("--unicast", action="append", default=[],
+                        help="client host the offers are sent to directly, repeatable, e.g. across routers or where "
+                             "broadcasts are filtered")
+    parser.add_argument("--offer-interval", type=float, default=DEFAULT_OFFER_INTERVAL,
+                        help="seconds between periodic offers, clients that solicit don't wait for them")
+    parser.add_argument("--max-transfers", type=int, default=DEFAULT_MAX_TRANSFERS,
+                        help="transfers running at once (per worker process), later requests wait in the queue")
+    parser.add_argument("--max-per-client", type=int, default=DEFAULT_MAX_PER_CLIENT,
+                        help="transfers one client IP may run at once")
+    parser.add_argument("--max-queued", type=int, default=DEFAULT_MAX_QUEUED,
+                        help="requests waiting for a transfer slot, requests past this are rejected at once")
+    parser.add_argument("--queue-timeout", type=float, default=DEFAULT_QUEUE_TIMEOUT,
+                        help="seconds a queued request waits for a transfer slot before it is rejected")
+    parser.add_argument("--max-file-size", type=int, default=None,
+                        help="largest size in bytes a request may ask for, larger requests are rejected")
+    parser.add_argument("--max-duration", type=float, default=None,
+                        help="longest time in seconds a request may ask for, client-stopped (time=inf) included")
+    parser.add_argument("--max-rate", type=int, default=None,
+                        help="bits/second every UDP transfer is held to, unpaced requests included")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on /metrics (and JSON on /stats) on this port")
+    parser.add_argument("--metrics-address", default=DEFAULT_METRICS_ADDRESS,
+                        help="address the metrics endpoint binds, 0.0.0.0 to let a remote Prometheus scrape it")
+    parser.add_argument("--stats-interval", type=float, default=None,
+                        help="print the counters every this many seconds (worker mode always prints them)")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="time the stages of the UDP send loop and sample the stacks of every thread, or run "
+                             "the transfers under cProfile")
+    parser.add_argument("--profile-output", default=DEFAULT_PROFILE_OUTPUT,
+                        help="collapsed stacks for flame graph tools, with .pstats and .stages.json next to it "
+                             "(.worker<N> per worker process), rewritten every few seconds")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                        help="seconds between stack samples")
+    args = parser.parse_args()
+    if args.payload == PAYLOAD_FILE and args.payload_file is None:
+        parser.error("--payload file needs a --payload-file")
+    if args.offer_interval <= 0:
+        parser.error("--offer-interval must be positive")
+    if not 0 < args.udp_payload_size <= MAX_UDP_PAYLOAD_SIZE:
+        parser.error(f"--udp-payload-size must be between 1 and {MAX_UDP_PAYLOAD_SIZE}")
+
+    admission = AdmissionController(
+        max_transfers=args.max_transfers, max_per_client=args.max_per_client, max_queued=args.max_queued,
+        queue_timeout=args.queue_timeout, max_file_size=args.max_file_size, max_duration=args.max_duration,
+        max_rate=args.max_rate,
+    )
+    announcer = OfferAnnouncer(
+        MAGIC_COOKIE, UDP_BROADCAST_PORT, broadcast=args.broadcast_offers, broadcast_addresses=args.broadcast_address,
+        multicast_group=args.multicast_group, multicast_ttl=args.multicast_ttl, unicast=args.unicast,
+        interval=args.offer_interval,
+    )
+    server_options = dict(send_mode=args.send_mode, udp_rate=args.udp_rate, udp_payload_size=args.udp_payload_size,
+                          udp_io=args.udp_io, announcer=announcer, admission=admission,
+                          tcp_profile=args.tcp_profile, payload=args.payload, payload_seed=args.payload_seed,
+                          payload_file=args.payload_file,
+                          metrics_port=args.metrics_port, metrics_address=args.metrics_address,
+                          stats_interval=args.stats_interval,
+                          profiler=Profiler(args.profile, args.profile_output, args.profile_interval)
+                          if args.profile else None)
+
+    if args.backend == BACKEND_ASYNC:
+        from async_server import AsyncSpeedTestServer
+        server = AsyncSpeedTestServer(**server_options)
+    else:
+        server = SpeedTestServer(**server_options)
+    server.start(workers=args.workers)
@@ -0,0 +1,297 @@
+import itertools
+import json
+import select
+import selectors
+import socket
+import threading
+import time
+
+from admission import TransferRejected
+from packets import TCP_REJECTION_PREFIX
+from tcp_tuning import wait_socket
+
+# A persistent session: the client opens one control connection to the server's TCP port and sends
+# "SESSION\n" instead of a transfer request. Every later line is a command, "<COMMAND>[ <json>]\n", answered
+# with one "OK <json>\n" or "ERROR <reason>\n" line:
+#   ROUND {"size", "time", "tcp", "udp", "direction"}  negotiates a round, the server checks its limits once
+#   DONE {"transfers", "failed"}                       ends it, the server answers with its own round time
+#   BYE                                                closes the session
+SESSION_COMMAND = "SESSION"
+ROUND_COMMAND = "ROUND"
+DONE_COMMAND = "DONE"
+CLOSE_COMMAND = "BYE"
+OK_PREFIX = "OK "
+ERROR_PREFIX = TCP_REJECTION_PREFIX.decode()  # the same prefix as a turned down TCP request
+SESSION_IDLE_TIMEOUT = 300  # seconds the server keeps an idle control or pooled data connection open
+IDLE_SWEEP_INTERVAL = 1  # seconds between the threaded backend's checks for connections idle too long
+MAX_COMMAND_SIZE = 64 * 1024  # longest command line, like the asyncio stream's readline limit
+CONNECT_TIMEOUT = 5
+REPLY_TIMEOUT = 10  # seconds the client waits for the reply to a command, the server answers without waiting
+
+# How a session's data connections are handled between rounds
+# warm: kept open and reused by the transfer with the same key, TCP skips the handshake and slow start
+POOL_WARM = "warm"
+POOL_COLD = "cold"  # opened fresh for every transfer, only the control connection and discovery are saved
+POOL_MODES = (POOL_WARM, POOL_COLD)
+
+
+def tcp_usable(sock):
+    """True when an idle pooled TCP connection can carry another request: nothing to read, as a connection the
+    server closed (e.g. after its idle timeout) reads EOF"""
+    return not wait_socket(sock, select.POLLIN, 0)
+
+
+def drain_datagrams(sock):
+    """Drops the datagrams a pooled UDP socket got after its last transfer (late duplicates, repeated result
+    messages), so the next transfer starts from an empty queue. Always True, a UDP socket stays usable."""
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        pass
+    except OSError:
+        pass  # e.g. an ICMP error of an earlier send, consumed by this recv
+    finally:
+        sock.setblocking(True)
+    return True
+
+
+def format_reply(fields=None, error=None):
+    """One reply line of the control connection"""
+    if error is not None:
+        return f"{ERROR_PREFIX}{error}\n".encode()
+    return f"{OK_PREFIX}{json.dumps(fields or {})}\n".encode()
+
+
+class ServerSession:
+    """Server side of one control connection. The backends read the lines and write the replies, this only
+    keeps the session's rounds: check is the admission controller's size and duration check, load() the
+    transfers running now."""
+
+    numbers = itertools.count(1)
+
+    def __init__(self, check, load, stats, info):
+        self.number = next(self.numbers)
+        self.check = check
+        self.load = load
+        self.stats = stats
+        self.info = info  # ports and limits the client is told when the session opens
+        self.round = 0
+        self.round_start = None
+        self.closed = False
+
+    def opened(self):
+        self.stats.add("sessions")
+        return format_reply(dict(self.info, session=self.number, idle_timeout=SESSION_IDLE_TIMEOUT))
+
+    def handle(self, line):
+        """The reply to a command line, sets closed once the client said goodbye"""
+        command, _, body = line.strip().partition(" ")
+        try:
+            fields = json.loads(body) if body else {}
+            if command == ROUND_COMMAND:
+                self.check(int(fields.get("size") or 0), fields.get("time"))
+                self.round += 1
+                self.round_start = time.perf_counter()
+                return format_reply({"round": self.round, "load": self.load()})
+            if command == DONE_COMMAND:
+                seconds = time.perf_counter() - self.round_start if self.round_start is not None else None
+                self.round_start = None
+                self.stats.add("session_rounds")
+                return format_reply({"round": self.round, "seconds": seconds})
+            if command == CLOSE_COMMAND:
+                self.closed = True
+                return format_reply()
+            return format_reply(error=f"unknown command {command!r}")
+        except TransferRejected as e:
+            self.stats.add("rejected")
+            return format_reply(error=e)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.stats.add("malformed_packets")
+            return format_reply(error=f"malformed command: {e}")
+
+
+class IdleConnections:
+    """The connections of the threaded backend that are idle between requests, kept alive data connections and
+    session control connections, parked in one selector so they hold neither a pool thread nor a pending slot
+    of the admission controller. resume(sock, state) is called on the selector's thread once the client sent
+    something (or closed the connection), one that stays idle for idle_timeout seconds is closed."""
+
+    def __init__(self, resume, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.resume = resume
+        self.idle_timeout = idle_timeout
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()  # park() wakes the selector's thread to register a socket
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.parked = []  # (socket, state) handed over by park(), not registered yet
+        self.deadlines = {}  # socket -> time.monotonic() it is closed at
+
+    def park(self, sock, state=None):
+        with self.lock:
+            self.parked.append((sock, state))
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            pass  # the selector's thread has wakeups to read already
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select(IDLE_SWEEP_INTERVAL):
+                if key.fileobj is self.wakeup:
+                    self.register_parked()
+                    continue
+                self.selector.unregister(key.fileobj)
+                del self.deadlines[key.fileobj]
+                self.resume(key.fileobj, key.data)
+            self.close_expired()
+
+    def register_parked(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            parked, self.parked = self.parked, []
+        deadline = time.monotonic() + self.idle_timeout
+        for sock, state in parked:
+            try:
+                self.selector.register(sock, selectors.EVENT_READ, state)
+            except (ValueError, OSError):
+                sock.close()  # closed while it was handed over
+                continue
+            self.deadlines[sock] = deadline
+
+    def close_expired(self):
+        now = time.monotonic()
+        for sock, deadline in list(self.deadlines.items()):
+            if deadline <= now:
+                self.selector.unregister(sock)
+                del self.deadlines[sock]
+                sock.close()
+
+
+class ConnectionPool:
+    """Data sockets of a session between rounds, keyed by the transfer that used them (protocol, direction and
+    connection number), so every connection of a round gets back the socket it had in the round before. Cold
+    pools keep nothing. Every entry is (socket, extra), extra is what the transfer set up along with it."""
+
+    def __init__(self, mode=POOL_WARM):
+        self.mode = mode
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    @property
+    def warm(self):
+        return self.mode == POOL_WARM
+
+    def take(self, key, usable=None):
+        """The idle entry of key, None when the transfer has to open a socket of its own. usable(sock) checks
+        an idle socket before it is handed out, one that fails it is closed."""
+        with self.lock:
+            entry = self.idle.pop(key, None)
+        if entry is not None and usable is not None and not usable(entry[0]):
+            entry[0].close()
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.opened += 1
+            else:
+                self.reused += 1
+        return entry
+
+    def put(self, key, entry):
+        """Keeps an entry for the next round, or closes its socket in a cold pool"""
+        if not self.warm:
+            entry[0].close()
+            return
+        with self.lock:
+            previous = self.idle.get(key)
+            self.idle[key] = entry
+        if previous is not None:
+            previous[0].close()
+
+    def close(self):
+        with self.lock:
+            entries, self.idle = list(self.idle.values()), {}
+        for entry in entries:
+            entry[0].close()
+
+    def summary(self):
+        return {"pool": self.mode, "opened": self.opened, "reused": self.reused}
+
+
+class ClientSession:
+    """Client side of a persistent session with one server: the control connection every round is negotiated
+    on and the pool of the data connections. Raises ConnectionRefusedError for a round the server turns down
+    and ConnectionError when the control connection is gone."""
+
+    def __init__(self, server_address, mode=POOL_WARM):
+        self.server_address = server_address
+        self.pool = ConnectionPool(mode)
+        self.sock = None
+        self.reader = None
+        self.info = None
+        self.lock = threading.Lock()  # one command at a time, the rounds of fanned out servers run in parallel
+
+    def open(self):
+        """Opens the control connection and returns what the server told about itself"""
+        self.sock = socket.create_connection((self.server_address[0], self.server_address[2]), CONNECT_TIMEOUT)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.settimeout(REPLY_TIMEOUT)  # a stalled server must not hold the lock of the session forever
+            self.reader = self.sock.makefile("rb")
+            self.info = self.exchange(f"{SESSION_COMMAND}\n")
+        except BaseException:
+            if self.sock is not None:  # exchange() closed it already when the server didn't answer
+                self.sock.close()
+                self.sock = None
+            raise
+        return self.info
+
+    def exchange(self, line):
+        with self.lock:
+            try:
+                self.sock.sendall(line.encode())
+                reply = self.reader.readline().decode(errors="replace").strip()
+            except socket.timeout:
+                # a late reply would be taken for the next command's, the connection can't be used any more
+                self.reader.close()
+                self.sock.close()
+                self.sock = None
+                raise ConnectionError(f"session with {self.server_address[0]} timed out after {REPLY_TIMEOUT} "
+                                      f"seconds") from None
+        if reply.startswith(OK_PREFIX):
+            return json.loads(reply[len(OK_PREFIX):])
+        if reply.startswith(ERROR_PREFIX):
+            raise ConnectionRefusedError(f"rejected by the server: {reply[len(ERROR_PREFIX):]}")
+        raise ConnectionError(f"session with {self.server_address[0]} closed: {reply!r}")
+
+    def command(self, command, fields=None):
+        return self.exchange(f"{command} {json.dumps(fields or {})}\n")
+
+    def begin_round(self, size, tcp, udp, duration, direction):
+        return self.command(ROUND_COMMAND, {"size": size, "time": duration, "tcp": tcp, "udp": udp,
+                                            "direction": direction})
+
+    def end_round(self, transfers, failed):
+        return self.command(DONE_COMMAND, {"transfers": transfers, "failed": failed})
+
+    def close(self):
+        """Says goodbye and closes the control connection and every pooled data connection"""
+        self.pool.close()
+        if self.sock is None:
+            return
+        try:
+            self.exchange(f"{CLOSE_COMMAND}\n")
+        except (OSError, ValueError):
+            pass  # the server is gone already
+        self.reader.close()
+        self.sock.close()
+        self.sock = None
@@ -0,0 +1,113 @@
+import errno
+import select
+import socket
+
+# Linux socket options, not every Python build exports the names
+TCP_CONGESTION = getattr(socket, "TCP_CONGESTION", 13)
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT", 25)  # Linux 3.12+
+SO_ZEROCOPY = getattr(socket, "SO_ZEROCOPY", 60)  # Linux 4.14+
+MSG_ZEROCOPY = getattr(socket, "MSG_ZEROCOPY", 0x4000000)
+MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+CONGESTION_NAME_SIZE = 16  # TCP_CA_NAME_MAX
+
+PROFILE_DEFAULT = "default"
+# Named socket settings the client asks for with "profile=<name>" and both ends apply to the connection,
+# so kernel settings can be A/B tested per run. Fixed SO_SNDBUF / SO_RCVBUF values turn off the kernel's buffer
+# autotuning for the socket, which is part of what the buffer profiles compare.
+PROFILES = {
+    PROFILE_DEFAULT: {},  # whatever the kernel and its sysctls choose
+    "low-latency": {"nodelay": True, "notsent_lowat": 16 * 1024},
+    "throughput": {"sndbuf": 4 * 1024 ** 2, "rcvbuf": 4 * 1024 ** 2, "congestion": "cubic"},
+    "bbr": {"sndbuf": 4 * 1024 ** 2, "rcvbuf": 4 * 1024 ** 2, "congestion": "bbr", "notsent_lowat": 128 * 1024},
+    # MSG_ZEROCOPY sends of the shared pattern, the kernel pins its pages instead of copying them
+    "zerocopy": {"sndbuf": 4 * 1024 ** 2, "rcvbuf": 4 * 1024 ** 2, "zerocopy": True},
+}
+ZEROCOPY_DRAIN_BYTES = 16 * 1024 ** 2  # sent bytes between reads of the completion notifications
+
+
+def apply_profile(sock, name):
+    """Applies the settings of a profile to a TCP socket and returns what the socket ended up with, settings the
+    platform refuses (e.g. a congestion control module that isn't loaded) are listed under "errors"."""
+    profile = PROFILES[name]
+    errors = []
+
+    def set_option(level, option, value, setting):
+        try:
+            sock.setsockopt(level, option, value)
+            return True
+        except OSError as e:
+            errors.append(f"{setting}: {e.strerror or e}")
+            return False
+
+    if "nodelay" in profile:
+        set_option(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(profile["nodelay"]), "nodelay")
+    if "sndbuf" in profile:
+        set_option(socket.SOL_SOCKET, socket.SO_SNDBUF, profile["sndbuf"], "sndbuf")
+    if "rcvbuf" in profile:
+        set_option(socket.SOL_SOCKET, socket.SO_RCVBUF, profile["rcvbuf"], "rcvbuf")
+    if "congestion" in profile:
+        set_option(socket.IPPROTO_TCP, TCP_CONGESTION, profile["congestion"].encode(), "congestion")
+    if "notsent_lowat" in profile:
+        set_option(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, profile["notsent_lowat"], "notsent_lowat")
+    zerocopy = bool(profile.get("zerocopy")) and set_option(socket.SOL_SOCKET, SO_ZEROCOPY, 1, "zerocopy")
+
+    settings = {"profile": name, "zerocopy": zerocopy}
+    settings.update(socket_settings(sock))
+    settings["errors"] = errors
+    return settings
+
+
+def socket_settings(sock):
+    """The TCP settings of a socket as the kernel reports them, the kernel doubles the buffer sizes it is given"""
+    settings = {
+        "nodelay": bool(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)),
+        "sndbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        "rcvbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        "congestion": None,
+        "notsent_lowat": None,
+    }
+    try:
+        settings["congestion"] = (sock.getsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, CONGESTION_NAME_SIZE)
+                                  .split(b"\0", 1)[0].decode())
+        settings["notsent_lowat"] = sock.getsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT)
+    except OSError:
+        pass  # not Linux
+    return settings
+
+
+def wait_socket(sock, events, timeout):
+    """poll() of one socket: the events of the mask that are ready within timeout seconds (POLLERR and POLLHUP
+    are always reported). select() fails with ValueError for descriptor numbers past FD_SETSIZE (1024), which a
+    server holding many parked connections reaches."""
+    poller = select.poll()
+    poller.register(sock, events)
+    ready = poller.poll(max(timeout, 0) * 1000)
+    return ready[0][1] if ready else 0
+
+
+def drain_zerocopy_completions(sock):
+    """Reads the pending MSG_ZEROCOPY completion notifications off the socket's error queue. They only tell
+    which sends the kernel is done with, the pattern is never modified so nothing waits on them, but an unread
+    queue fills the socket's option memory and makes later zerocopy sends fail with ENOBUFS."""
+    while True:
+        try:
+            sock.recvmsg(0, 128, MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+
+
+def send_zerocopy(sock, view, flags=MSG_ZEROCOPY):
+    """send() of one slice with MSG_ZEROCOPY, when the kernel runs out of option memory for the notifications
+    the queue is drained and the slice is sent again. Returns the bytes sent."""
+    while True:
+        try:
+            return sock.send(view, flags)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            drain_zerocopy_completions(sock)
+            wait_socket(sock, select.POLLIN, 0.001)  # completions arrive as POLLERR, give the kernel a moment
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from admission import AdmissionController, TransferRejected
+
+
+def test_pending_requests_are_capped_at_the_pool_capacity():
+    admission = AdmissionController(max_transfers=2, max_queued=1)
+    assert admission.capacity == 3
+    assert [admission.enter() for _ in range(4)] == [True, True, True, False]
+    admission.leave()
+    assert admission.enter()
+
+
+def test_size_and_duration_limits():
+    admission = AdmissionController(max_file_size=1000, max_duration=10)
+    admission.check(1000, 10)
+    admission.check(1000)  # size-bounded requests have no duration
+    with pytest.raises(TransferRejected, match="file size"):
+        admission.check(1001)
+    with pytest.raises(TransferRejected, match="transfer time"):
+        admission.check(0, 10.5)
+
+
+def test_no_limits_by_default():
+    admission = AdmissionController()
+    admission.check(1 << 50, 1e6)
+    assert admission.limit_rate(0) == 0
+    assert admission.limit_rate(5_000_000) == 5_000_000
+
+
+def test_rate_limit_applies_to_unpaced_requests():
+    admission = AdmissionController(max_rate=1_000_000)
+    assert admission.limit_rate(0) == 1_000_000
+    assert admission.limit_rate(500_000) == 500_000
+    assert admission.limit_rate(2_000_000) == 1_000_000
+
+
+def test_per_client_limit():
+    admission = AdmissionController(max_transfers=10, max_per_client=2)
+    assert admission.try_acquire("10.0.0.1")
+    assert admission.try_acquire("10.0.0.1")
+    assert not admission.try_acquire("10.0.0.1")
+    assert admission.try_acquire("10.0.0.2")
+    admission.release("10.0.0.1")
+    assert admission.try_acquire("10.0.0.1")
+
+
+def test_global_limit():
+    admission = AdmissionController(max_transfers=2, max_per_client=2)
+    assert admission.try_acquire("10.0.0.1")
+    assert admission.try_acquire("10.0.0.2")
+    assert not admission.try_acquire("10.0.0.3")
+    admission.release("10.0.0.2")
+    assert admission.try_acquire("10.0.0.3")
+
+
+def test_release_forgets_idle_clients():
+    admission = AdmissionController()
+    admission.try_acquire("10.0.0.1")
+    admission.release("10.0.0.1")
+    assert admission.active == 0
+    assert "10.0.0.1" not in admission.active_per_client
+
+
+def test_acquire_times_out_without_a_free_slot():
+    admission = AdmissionController(max_transfers=1, queue_timeout=0.05)
+    admission.acquire("10.0.0.1")
+    with pytest.raises(TransferRejected, match="no transfer slot"):
+        admission.acquire("10.0.0.2")
+    assert admission.active == 1
+
+
+def test_acquire_waits_for_a_released_slot():
+    admission = AdmissionController(max_transfers=1, queue_timeout=5)
+    admission.acquire("10.0.0.1")
+    timer = threading.Timer(0.05, admission.release, ("10.0.0.1",))
+    timer.start()
+    admission.acquire("10.0.0.2")
+    timer.join()
+    assert dict(admission.active_per_client) == {"10.0.0.2": 1}
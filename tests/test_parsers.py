@@ -0,0 +1,97 @@
+import struct
+
+import pytest
+
+from client import SpeedTestClient
+from packets import FLAG_TIMESTAMPS, MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, REQUEST_MESSAGE_TYPE
+from payloads import DEFAULT_SEED, PAYLOAD_RANDOM
+from plan import PlanError, parse_plan
+from reliable import FEEDBACK_HEADER, NACK_MESSAGE_TYPE
+from server import MAX_UDP_PAYLOAD_SIZE, message_kind, parse_tcp_request, parse_udp_request
+from upload import DIRECTION_DOWNLOAD, DIRECTION_UPLOAD
+
+DEFAULT_RATE = 0
+DEFAULT_PAYLOAD_SIZE = 1024
+
+
+def test_plain_tcp_request():
+    assert parse_tcp_request("1000") == {
+        "size": 1000, "time": None, "profile": None, "direction": DIRECTION_DOWNLOAD, "offset": 0,
+        "payload": None, "keepalive": False, "status": False,
+    }
+
+
+def test_tcp_request_with_every_option():
+    request = parse_tcp_request("0 time=2.5 profile=bbr offset=4096 payload=random:7 keepalive=1 status=1")
+    assert request["size"] == 0
+    assert request["time"] == 2.5
+    assert request["profile"] == "bbr"
+    assert request["offset"] == 4096
+    assert request["payload"] == ("random", 7)
+    assert request["keepalive"] and request["status"]
+
+
+def test_tcp_request_defaults_and_unknown_keys():
+    request = parse_tcp_request(f"10 time=inf payload=constant direction={DIRECTION_UPLOAD} newer=option")
+    assert request["time"] == float("inf")
+    assert request["payload"] == ("constant", DEFAULT_SEED)
+    assert request["direction"] == DIRECTION_UPLOAD
+
+
+@pytest.mark.parametrize("line", ["10 time=0", "10 time=-1", "10 direction=sideways", "10 offset=-5", "x"])
+def test_invalid_tcp_requests(line):
+    with pytest.raises(ValueError):
+        parse_tcp_request(line)
+
+
+def test_plain_udp_request_gets_the_server_defaults():
+    request = struct.pack('!IBQ', MAGIC_COOKIE, REQUEST_MESSAGE_TYPE, 5000)
+    assert parse_udp_request(request, DEFAULT_RATE, DEFAULT_PAYLOAD_SIZE) == (
+        5000, None, DEFAULT_RATE, DEFAULT_PAYLOAD_SIZE, 0, None)
+
+
+def test_udp_request_round_trip():
+    """What the client packs is what the server reads"""
+    client = SpeedTestClient(udp_rate=10_000_000, udp_payload_size=1400, payload=PAYLOAD_RANDOM, payload_seed=9)
+    request = client.udp_request_packet(REQUEST_MESSAGE_TYPE, 0, 1.5, FLAG_TIMESTAMPS)
+    assert message_kind(request) == REQUEST_MESSAGE_TYPE
+    assert parse_udp_request(request, DEFAULT_RATE, DEFAULT_PAYLOAD_SIZE) == (
+        0, 1.5, 10_000_000, 1400, FLAG_TIMESTAMPS, (PAYLOAD_RANDOM, 9))
+
+
+def test_udp_request_options_without_a_duration():
+    client = SpeedTestClient(udp_payload_size=512)
+    request = client.udp_request_packet(REQUEST_MESSAGE_TYPE, 100, None, 0)
+    assert parse_udp_request(request, 1_000_000, DEFAULT_PAYLOAD_SIZE) == (100, None, 1_000_000, 512, 0, None)
+
+
+def test_udp_payload_size_is_capped():
+    client = SpeedTestClient(udp_payload_size=0xFFFF)
+    request = client.udp_request_packet(REQUEST_MESSAGE_TYPE, 100, None, 0)
+    assert parse_udp_request(request, DEFAULT_RATE, DEFAULT_PAYLOAD_SIZE)[3] == MAX_UDP_PAYLOAD_SIZE
+
+
+def test_message_kind():
+    assert message_kind(b"") is None
+    assert message_kind(struct.pack('!IBQ', 0x12345678, REQUEST_MESSAGE_TYPE, 1)) is None
+    assert message_kind(struct.pack('!IB', MAGIC_COOKIE, REQUEST_MESSAGE_TYPE)) is None
+    assert message_kind(struct.pack('!IBQ', MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, 1)) is None
+    assert message_kind(struct.pack('!IBQQ', MAGIC_COOKIE, PAYLOAD_MESSAGE_TYPE, 1, 0)) == PAYLOAD_MESSAGE_TYPE
+    assert message_kind(struct.pack('!IB', MAGIC_COOKIE, NACK_MESSAGE_TYPE)) is None
+    nack = FEEDBACK_HEADER.pack(MAGIC_COOKIE, NACK_MESSAGE_TYPE, 0, 0)
+    assert message_kind(nack) == NACK_MESSAGE_TYPE
+
+
+def test_plan():
+    rounds = parse_plan({"rounds": [{"size": 1000, "tcp": 2}, {"time": 3, "udp": 1, "tcp": 0}]})
+    assert rounds[0] == {"size": 1000, "tcp": 2, "udp": 1, "repeat": 1, "duration": None, "time": None}
+    assert rounds[1]["time"] == 3.0 and rounds[1]["size"] == 0
+
+
+@pytest.mark.parametrize("plan", [
+    [], {"rounds": None}, [{"tcp": 1}], [{"size": 1, "speed": 2}], [{"size": 1, "tcp": 0, "udp": 0}],
+    [{"time": 0}], [{"size": -1}], [{"size": 1, "repeat": 0}],
+])
+def test_invalid_plans(plan):
+    with pytest.raises(PlanError):
+        parse_plan(plan)
@@ -0,0 +1,184 @@
+import pytest
+
+import reliable
+from packets import MAGIC_COOKIE
+from reliable import (
+    MAX_NACK_RANGES,
+    RETRANSMIT_HOLDOFF,
+    TAIL_TIMEOUT,
+    ReliableReceiver,
+    ReliableSender,
+    pack_feedback,
+    parse_feedback,
+)
+from tracker import ReceiveTracker
+
+
+class Clock:
+    """perf_counter stand-in the tests move forward by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(reliable.time, "perf_counter", clock)
+    return clock
+
+
+def feedback(received_through, ranges=()):
+    return pack_feedback(MAGIC_COOKIE, received_through, list(ranges))
+
+
+def test_feedback_round_trip():
+    assert parse_feedback(feedback(42, [(3, 2), (10, 7)])) == (42, [(3, 2), (10, 7)])
+
+
+def test_feedback_is_capped_to_one_datagram():
+    data = feedback(10_000, [(i * 2, 1) for i in range(1000)])
+    assert len(data) <= 1472
+    assert len(parse_feedback(data)[1]) == MAX_NACK_RANGES
+
+
+def test_parse_feedback_ignores_ranges_past_the_datagram():
+    data = feedback(20, [(1, 1), (5, 2)])
+    assert parse_feedback(data[:-1]) == (20, [(1, 1)])
+
+
+def test_sender_stops_at_the_window(clock):
+    sender = ReliableSender(1000, window=128)
+    assert sender.next_batch(64) == (0, 64)
+    assert sender.next_batch(100) == (64, 64)
+    assert sender.next_batch(64) is None
+    sender.on_feedback(feedback(32))
+    assert sender.next_batch(64) == (128, 32)
+
+
+def test_sender_sends_nacked_segments_first(clock):
+    sender = ReliableSender(1000, window=128)
+    sender.next_batch(100)
+    sender.on_feedback(feedback(100, [(10, 5), (40, 1)]))
+    assert sender.next_batch(3) == (10, 3)
+    assert sender.next_batch(64) == (13, 2)
+    assert sender.next_batch(64) == (40, 1)
+    assert sender.next_batch(64) == (100, 64)
+    assert sender.retransmitted == 6
+
+
+def test_sender_ignores_nacks_of_segments_it_never_sent(clock):
+    sender = ReliableSender(1000, window=128)
+    sender.next_batch(20)
+    sender.on_feedback(feedback(20, [(15, 50)]))
+    assert sender.next_batch(64) == (15, 5)
+
+
+def test_repeated_nack_waits_for_the_holdoff(clock):
+    sender = ReliableSender(1000, window=128)
+    sender.next_batch(50)
+    sender.on_feedback(feedback(50, [(10, 2)]))
+    assert sender.next_batch(64) == (10, 2)
+    clock.now += RETRANSMIT_HOLDOFF / 2
+    sender.on_feedback(feedback(50, [(10, 2)]))
+    assert sender.next_batch(64) == (50, 64)
+    clock.now += RETRANSMIT_HOLDOFF
+    sender.on_feedback(feedback(50, [(10, 2)]))
+    assert sender.next_batch(64) == (10, 2)
+
+
+def test_holdoffs_below_the_first_missing_segment_are_dropped(clock):
+    sender = ReliableSender(1000, window=128)
+    sender.next_batch(100)
+    sender.on_feedback(feedback(100, [(10, 5), (40, 5)]))
+    assert set(sender.retransmit_times) == set(range(10, 15)) | set(range(40, 45))
+    sender.on_feedback(feedback(100, [(40, 5)]))
+    assert sender.acknowledged == 40
+    assert set(sender.retransmit_times) == set(range(40, 45))
+    sender.on_feedback(feedback(100))
+    assert sender.acknowledged == 100
+    assert sender.retransmit_times == {}
+
+
+def test_lost_tail_is_sent_again_after_the_tail_timeout(clock):
+    sender = ReliableSender(100, window=128)
+    assert sender.next_batch(100) == (0, 100)
+    sender.on_feedback(feedback(90))
+    assert sender.next_batch(64) is None
+    clock.now += TAIL_TIMEOUT * 2
+    assert sender.next_batch(64) is None  # queues the tail
+    assert sender.next_batch(64) == (90, 10)
+
+
+def test_sender_completes_on_the_final_feedback(clock):
+    sender = ReliableSender(10)
+    sender.next_batch(64)
+    sender.on_feedback(feedback(10))
+    assert sender.complete and sender.finished
+
+
+def test_sender_gives_up_without_feedback(clock):
+    sender = ReliableSender(10)
+    assert not sender.finished
+    clock.now += reliable.IDLE_TIMEOUT + 1
+    assert sender.finished and not sender.complete
+
+
+def test_receiver_nacks_the_gaps_below_its_highest_segment():
+    receiver = ReliableReceiver(MAGIC_COOKIE, ReceiveTracker(100))
+    for segment in [0, 1, 2, 5, 6, 9]:
+        receiver.record(segment)
+    assert parse_feedback(receiver.feedback()) == (10, [(3, 2), (7, 2)])
+    assert receiver.nacked_segments == 4
+    receiver.record(3)
+    receiver.record(4)
+    assert parse_feedback(receiver.feedback()) == (10, [(7, 2)])
+    assert receiver.nacked_segments == 4
+    assert receiver.recovered == 2
+
+
+def test_receiver_duplicates_are_not_recoveries():
+    receiver = ReliableReceiver(MAGIC_COOKIE, ReceiveTracker(10))
+    receiver.record(2)
+    receiver.feedback()
+    receiver.record(0)
+    receiver.record(0)
+    assert receiver.recovered == 1
+    assert receiver.tracker.duplicates == 1
+
+
+def test_receiver_completion_feedback():
+    receiver = ReliableReceiver(MAGIC_COOKIE, ReceiveTracker(20))
+    for segment in range(20):
+        receiver.record(segment)
+    assert receiver.complete
+    assert parse_feedback(receiver.feedback()) == (20, [])
+
+
+def test_lossy_transfer_completes(clock):
+    """Sender and receiver exchange batches and feedback over a link that drops every first send of some
+    segments, until the receiver has all of them"""
+    total = 2000
+    sender = ReliableSender(total, window=128)
+    receiver = ReliableReceiver(MAGIC_COOKIE, ReceiveTracker(total))
+    dropped = set(range(0, total, 7)) | set(range(500, 540)) | {total - 1}
+    for _ in range(10_000):
+        if sender.complete:
+            break
+        batch = sender.next_batch(32)
+        if batch is not None:
+            first, count = batch
+            for segment in range(first, first + count):
+                if segment in dropped:
+                    dropped.discard(segment)
+                else:
+                    receiver.record(segment)
+        sender.on_feedback(receiver.feedback())
+        clock.now += 0.01
+    assert sender.complete
+    assert receiver.complete
+    assert receiver.recovered == receiver.nacked_segments > 0
+    assert receiver.tracker.unique == total
@@ -0,0 +1,79 @@
+from tracker import ReceiveTracker, SteadyStateWindow
+
+
+def tracker_with(total_segments, received):
+    tracker = ReceiveTracker(total_segments)
+    for segment in received:
+        tracker.record(segment)
+    return tracker
+
+
+def test_missing_ranges_of_complete_transfer():
+    tracker = tracker_with(20, range(20))
+    assert list(tracker.missing_ranges()) == []
+    assert tracker.first_missing() == 20
+
+
+def test_missing_ranges_across_bytes():
+    received = [segment for segment in range(40) if not 5 <= segment < 19 and segment not in (23, 39)]
+    tracker = tracker_with(40, received)
+    assert list(tracker.missing_ranges()) == [(5, 14), (23, 1), (39, 1)]
+    assert list(tracker.missing_ranges(8, 30)) == [(8, 11), (23, 1)]
+    assert list(tracker.missing_ranges(0, 6)) == [(5, 1)]
+
+
+def test_missing_ranges_with_nothing_received():
+    tracker = ReceiveTracker(13)
+    assert list(tracker.missing_ranges()) == [(0, 13)]
+
+
+def test_first_missing_moves_with_the_low_water_mark():
+    tracker = tracker_with(30, [0, 1, 2, 4])
+    assert tracker.first_missing() == 3
+    tracker.record(3)
+    assert tracker.first_missing() == 5
+    for segment in range(5, 17):
+        tracker.record(segment)
+    assert tracker.first_missing() == 17
+    for segment in range(17, 30):
+        tracker.record(segment)
+    assert tracker.first_missing() == 30
+
+
+def test_reordering_and_duplicates():
+    tracker = tracker_with(10, [0, 3, 1, 2, 3, 9])
+    summary = tracker.summary()
+    assert summary["unique"] == 5
+    assert summary["received"] == 6
+    assert summary["duplicates"] == 1
+    assert summary["out_of_order"] == 2
+    assert summary["max_reorder_distance"] == 2
+    assert tracker.loss_bursts() == {5: 1}
+    assert summary["longest_loss_burst"] == 5
+
+
+def test_bounded_tracker_rejects_segments_past_the_end():
+    tracker = ReceiveTracker(8)
+    assert not tracker.record(8)
+    assert tracker.invalid == 1
+    assert tracker.received == 0
+
+
+def test_unbounded_tracker_grows_up_to_its_limit():
+    tracker = ReceiveTracker(None, limit=100)
+    assert tracker.record(50)
+    assert tracker.total_segments == 51
+    assert len(tracker.bitmap) >= 7
+    assert not tracker.record(100)
+    assert tracker.invalid == 1
+    assert list(tracker.missing_ranges()) == [(0, 50)]
+
+
+def test_steady_state_window_leaves_out_the_warm_up():
+    window = SteadyStateWindow(omit=1.0)
+    window.record(0, 1000)  # opens the window at 1 s
+    window.record(500_000_000, 1000)  # warm-up
+    assert window.bits_per_second() is None
+    window.record(1_500_000_000, 1000)
+    window.record(2_000_000_000, 1000)
+    assert window.bits_per_second() == 2000 * 8 / 1.0
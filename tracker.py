@@ -0,0 +1,179 @@
+import re
+from collections import Counter
+
+INCOMPLETE_BYTE = re.compile(rb'[^\xff]')  # a bitmap byte with at least one missing segment
+NONEMPTY_BYTE = re.compile(rb'[^\x00]')  # a bitmap byte with at least one received segment
+
+
+class ReceiveTracker:
+    """Tracks the segments of one UDP transfer in a bitmap, one bit per segment, so memory stays at
+    total_segments / 8 bytes however many datagrams arrive. Bit i of byte n is segment n * 8 + i.
+
+    Time-bounded transfers don't know their total, with total_segments None the bitmap grows with the
+    highest segment seen and the transfer counts as ending there (a lost tail can't be told apart). A limit
+    caps that growth, segment numbers from the limit on are counted as invalid."""
+
+    def __init__(self, total_segments, limit=None):
+        self.bounded = total_segments is not None
+        self.total_segments = total_segments if self.bounded else 0
+        self.limit = limit
+        self.bitmap = bytearray((self.total_segments + 7) // 8)
+        self.received = 0  # every valid datagram, duplicates included
+        self.unique = 0
+        self.duplicates = 0
+        self.out_of_order = 0  # segments that arrived after a higher numbered segment
+        self.max_reorder_distance = 0
+        self.highest_segment = -1
+        self.invalid = 0  # segment numbers outside of the transfer
+        self.low_water = 0  # every segment below it is in, see first_missing()
+
+    def record(self, segment):
+        """Records the arrival of one segment, False when its number is outside of the transfer"""
+        if segment >= self.total_segments:
+            if self.bounded or (self.limit is not None and segment >= self.limit):
+                self.invalid += 1
+                return False
+            self.total_segments = segment + 1
+            if segment >> 3 >= len(self.bitmap):
+                # doubling keeps the number of copies logarithmic in the transfer length
+                self.bitmap.extend(bytes(max(len(self.bitmap), (segment >> 3) + 1 - len(self.bitmap))))
+        self.received += 1
+        index, bit = segment >> 3, 1 << (segment & 7)
+        if self.bitmap[index] & bit:
+            self.duplicates += 1
+            return True
+        self.bitmap[index] |= bit
+        self.unique += 1
+        if segment < self.highest_segment:
+            self.out_of_order += 1
+            self.max_reorder_distance = max(self.max_reorder_distance, self.highest_segment - segment)
+        else:
+            self.highest_segment = segment
+        return True
+
+    def first_missing(self):
+        """The lowest segment that hasn't arrived, total_segments once every one has. The low-water mark only moves
+        forward, so repeated calls scan each complete bitmap byte once instead of the whole bitmap every time."""
+        match = INCOMPLETE_BYTE.search(self.bitmap, self.low_water >> 3)
+        if match is None:
+            self.low_water = self.total_segments
+        else:
+            index = match.start()
+            byte = self.bitmap[index]
+            bit = (~byte & (byte + 1)).bit_length() - 1  # lowest clear bit
+            self.low_water = min(index * 8 + bit, self.total_segments)
+        return self.low_water
+
+    def has(self, segment):
+        return bool(self.bitmap[segment >> 3] & (1 << (segment & 7)))
+
+    def missing_ranges(self, start=0, end=None):
+        """Yields (first segment, length) of every run of missing segments in [start, end), jumping over whole
+        bytes that are complete (or, inside a run, empty) with a regex search instead of testing their bits"""
+        end = self.total_segments if end is None else min(end, self.total_segments)
+        bitmap = self.bitmap
+        index, last_index = start >> 3, (end + 7) >> 3
+        run_start = None
+        while index < last_index:
+            match = (INCOMPLETE_BYTE if run_start is None else NONEMPTY_BYTE).search(bitmap, index, last_index)
+            if match is None:
+                break
+            index = match.start()
+            byte = bitmap[index]
+            for bit in range(8):
+                segment = index * 8 + bit
+                if segment < start:
+                    continue
+                if segment >= end:
+                    break
+                if byte & (1 << bit):
+                    if run_start is not None:
+                        yield run_start, segment - run_start
+                        run_start = None
+                elif run_start is None:
+                    run_start = segment
+            index += 1
+        if run_start is not None:
+            yield run_start, end - run_start
+
+    def loss_bursts(self):
+        """Counter of loss burst length -> number of bursts of that length"""
+        return Counter(length for _, length in self.missing_ranges())
+
+    def summary(self):
+        """The loss and reordering figures of the transfer as a dict"""
+        bursts = self.loss_bursts()
+        return {
+            "total_segments": self.total_segments,
+            "received": self.received,
+            "unique": self.unique,
+            "received_percentage": self.unique / self.total_segments * 100 if self.total_segments else 0,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "max_reorder_distance": self.max_reorder_distance,
+            "loss_bursts": sum(bursts.values()),
+            "longest_loss_burst": max(bursts, default=0),
+        }
+
+
+class TransferTimer:
+    """Arrival timing of one transfer from perf_counter_ns readings: time to first byte, the first to last
+    packet window (which leaves out the idle timeout that ends a UDP receive loop) and, for timestamped
+    segments, the RFC 3550 interarrival jitter. The jitter only uses differences of transit times, so the
+    sender's clock doesn't have to be synchronised with ours."""
+
+    def __init__(self, request_ns):
+        self.request_ns = request_ns
+        self.first_ns = None
+        self.last_ns = None
+        self.jitter_ns = 0.0
+        self.previous_transit_ns = None
+
+    def record(self, arrival_ns, send_ns=None):
+        """Records one arrival, send_ns is the sender's timestamp when the segment carries one"""
+        if self.first_ns is None:
+            self.first_ns = arrival_ns
+        self.last_ns = arrival_ns
+        if send_ns is not None:
+            transit_ns = arrival_ns - send_ns
+            if self.previous_transit_ns is not None:
+                # J(i) = J(i-1) + (|D(i-1,i)| - J(i-1)) / 16
+                self.jitter_ns += (abs(transit_ns - self.previous_transit_ns) - self.jitter_ns) / 16
+            self.previous_transit_ns = transit_ns
+
+    def summary(self):
+        """Times of the transfer in seconds, None for the ones that need at least one arrival"""
+        if self.first_ns is None:
+            return {"time_to_first_byte": None, "window": None, "elapsed": None, "jitter": None}
+        return {
+            "time_to_first_byte": (self.first_ns - self.request_ns) / 1e9,
+            "window": (self.last_ns - self.first_ns) / 1e9,
+            "elapsed": (self.last_ns - self.request_ns) / 1e9,
+            "jitter": self.jitter_ns / 1e9 if self.previous_transit_ns is not None else None,
+        }
+
+
+class SteadyStateWindow:
+    """Throughput of a transfer after its warm-up: arrivals within omit seconds of the first one (slow start,
+    buffers filling) are left out, so transfers of different lengths over different links compare fairly."""
+
+    def __init__(self, omit=0.0):
+        self.omit_ns = int(omit * 1e9)
+        self.start_ns = None
+        self.last_ns = None
+        self.bytes = 0
+
+    def record(self, arrival_ns, size):
+        """Records size bytes that arrived at arrival_ns"""
+        if self.start_ns is None:
+            self.start_ns = arrival_ns + self.omit_ns
+        elif arrival_ns > self.start_ns:
+            # bytes that arrive at the start of the window were in flight before it, they are not counted
+            self.bytes += size
+            self.last_ns = arrival_ns
+
+    def bits_per_second(self):
+        """Speed over the window, None when nothing arrived after the warm-up"""
+        if self.last_ns is None or self.last_ns <= self.start_ns:
+            return None
+        return self.bytes * 8 / ((self.last_ns - self.start_ns) / 1e9)
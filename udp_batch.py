@@ -0,0 +1,98 @@
+import errno
+import socket
+import struct
+
+# Linux UDP offload options, not every Python build exports the names
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # GSO, Linux 4.18+
+UDP_GRO = getattr(socket, "UDP_GRO", 104)  # GRO, Linux 5.0+
+
+MAX_GSO_SEGMENTS = 64  # kernel limit of datagrams per GSO send
+MAX_GSO_BYTES = 65507  # all the datagrams of one GSO send have to fit in a single UDP payload
+MAX_DATAGRAM_SIZE = 65535
+RING_SLOTS = 16
+
+# errors meaning the path can't do GSO (no checksum offload, old kernel), anything else is a real send error
+GSO_UNSUPPORTED_ERRORS = (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+
+def gso_supported(sock):
+    """True when the socket accepts the UDP_SEGMENT option and has sendmsg"""
+    if not hasattr(sock, "sendmsg"):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)  # 0 keeps segmentation off until a send asks for it
+        return True
+    except OSError:
+        return False
+
+
+def enable_gro(sock):
+    """Turns on UDP_GRO so the kernel may deliver many datagrams per receive, False when unsupported"""
+    if not hasattr(sock, "recvmsg_into") or not hasattr(socket, "CMSG_SPACE"):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        return True
+    except OSError:
+        return False
+
+
+class BatchSender:
+    """Sends runs of equally sized datagrams to one address. With GSO one sendmsg hands the kernel up to
+    batch_size datagrams, otherwise every datagram is its own sendto."""
+
+    def __init__(self, sock, address, datagram_size, use_gso=True):
+        self.sock = sock
+        self.address = address
+        self.use_gso = use_gso and gso_supported(sock)
+        self.batch_size = max(1, min(MAX_GSO_SEGMENTS, MAX_GSO_BYTES // datagram_size)) if self.use_gso else 1
+        self.gso_control = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', datagram_size))]
+
+    def send(self, datagrams):
+        """Sends the datagrams in order, every one but the last has to be datagram_size bytes long"""
+        if self.use_gso and len(datagrams) > 1:
+            try:
+                # the buffers are gathered back to back and the kernel splits them every datagram_size bytes
+                self.sock.sendmsg(datagrams, self.gso_control, 0, self.address)
+                return
+            except OSError as e:
+                if e.errno not in GSO_UNSUPPORTED_ERRORS:
+                    raise
+                self.use_gso = False
+                self.batch_size = 1
+        for datagram in datagrams:
+            self.sock.sendto(datagram, self.address)
+
+
+class BatchReceiver:
+    """Receives datagrams into a ring of preallocated slots. With GRO one recvmsg_into call can return many
+    coalesced datagrams, otherwise every call fills one slot with one datagram."""
+
+    def __init__(self, sock, use_gro=True, slots=RING_SLOTS):
+        self.sock = sock
+        self.ring = bytearray(MAX_DATAGRAM_SIZE * slots)
+        ring_view = memoryview(self.ring)
+        self.slots = [ring_view[i * MAX_DATAGRAM_SIZE:(i + 1) * MAX_DATAGRAM_SIZE] for i in range(slots)]
+        self.next_slot = 0
+        self.use_gro = use_gro and enable_gro(sock)
+        self.ancillary_size = socket.CMSG_SPACE(struct.calcsize('=i')) if self.use_gro else 0
+
+    def receive(self):
+        """Waits for the next batch and returns its datagrams as memoryviews into the ring, they stay valid
+        until the ring wraps around. Socket timeouts are raised to the caller like recvfrom does."""
+        slot = self.slots[self.next_slot]
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+
+        if not self.use_gro:
+            nbytes, _ = self.sock.recvfrom_into(slot)
+            return [slot[:nbytes]]
+
+        nbytes, ancdata, _, _ = self.sock.recvmsg_into([slot], self.ancillary_size)
+        segment_size = nbytes
+        for level, kind, data in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO:
+                segment_size = struct.unpack('=i', data[:4])[0]
+        if segment_size <= 0 or segment_size >= nbytes:
+            return [slot[:nbytes]]
+        return [slot[offset:min(offset + segment_size, nbytes)] for offset in range(0, nbytes, segment_size)]
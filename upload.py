@@ -0,0 +1,113 @@
+import json
+import struct
+import threading
+import time
+
+from packets import PAYLOAD_HEADER, TIMESTAMPED_PAYLOAD_HEADER
+from tracker import ReceiveTracker, TransferTimer
+
+# Directions of a transfer, a bidirectional round runs a download and an upload of every connection at once
+DIRECTION_DOWNLOAD = "download"
+DIRECTION_UPLOAD = "upload"
+DIRECTION_BIDIRECTIONAL = "bidirectional"
+DIRECTIONS = (DIRECTION_DOWNLOAD, DIRECTION_UPLOAD, DIRECTION_BIDIRECTIONAL)
+
+# UDP uploads: the client sends the segments to the server's UDP listener
+UPLOAD_REQUEST_MESSAGE_TYPE = 0x8  # same layout as a download request, the flags may only ask for timestamps
+# '!IBQH' answer to an admitted upload request: the rate (0 = unpaced) and payload size the client has to send
+# with, the server counts the upload's segments from now on
+UPLOAD_READY = struct.Struct('!IBQH')
+UPLOAD_READY_MESSAGE_TYPE = 0x9
+UPLOAD_RESULT_MESSAGE_TYPE = 0xA  # '!IB' followed by the server's figures of the upload as utf-8 JSON
+UPLOAD_IDLE_TIMEOUT = 1  # seconds without a segment before the server ends an upload, like a download's client
+RESULT_REPEATS = 3  # the ready and result datagrams are sent this many times, any one of them will do
+# Segments one upload's bitmap may track, 16 MiB of server memory: the total of a size-bounded upload is held to
+# it and the bitmap of a time-bounded one doesn't grow past it
+MAX_UPLOAD_SEGMENTS = 1 << 27
+
+# TCP uploads: "<size>[ time=<seconds>] direction=upload" followed by the payload, the server answers
+# "RESULT <json>\n" once the size is in or the client shut its side of the connection down
+TCP_RESULT_PREFIX = "RESULT "
+UPLOAD_BUFFER_SIZE = 256 * 1024  # the preallocated buffer every TCP upload is received into
+
+
+def pack_result(magic_cookie, figures):
+    return struct.pack('!IB', magic_cookie, UPLOAD_RESULT_MESSAGE_TYPE) + json.dumps(figures).encode()
+
+
+def parse_result(data):
+    return json.loads(bytes(data[5:]).decode())
+
+
+def upload_segments(file_size, duration, payload_size):
+    """The segment count of an upload as the client computes it, None for a time-bounded upload of size 0"""
+    if duration is not None and not file_size:
+        return None
+    return (file_size + payload_size - 1) // payload_size
+
+
+def throughput_figures(nbytes, timing):
+    """The server's figures of an upload from its byte count and TransferTimer summary, the speed is measured
+    over the first to last arrival window like the client does for downloads"""
+    window = timing["window"]
+    return {
+        "bytes": nbytes,
+        "elapsed": timing["elapsed"],
+        "window": window,
+        "bits_per_second": nbytes * 8 / window if window else None,
+        "jitter": timing["jitter"],
+    }
+
+
+class UploadReceiver:
+    """Server side of one UDP upload. The listener hands it every payload datagram from the client's address,
+    so it only keeps counters and the segment bitmap, and sets done once every segment of a size-bounded
+    upload is in. The transfer's handler waits on it and sends the summary back.
+
+    The bitmap is sized from the admitted request's total_segments (None: time-bounded), never from the
+    datagrams, which anyone who knows the client's address can send: a segment that announces another total
+    or lies beyond it is dropped as invalid."""
+
+    def __init__(self, total_segments=None):
+        self.tracker = ReceiveTracker(total_segments, limit=MAX_UPLOAD_SEGMENTS)
+        self.expected_total = total_segments or 0  # what the segments' headers announce
+        self.timer = TransferTimer(time.perf_counter_ns())
+        self.bytes = 0
+        self.last_ns = self.timer.request_ns
+        self.done = threading.Event()
+        if total_segments == 0:
+            self.done.set()
+
+    def record(self, data, timestamped, arrival_ns):
+        """Records one payload datagram, a segment too short for its header is ignored"""
+        header = TIMESTAMPED_PAYLOAD_HEADER if timestamped else PAYLOAD_HEADER
+        if len(data) < header.size:
+            return
+        fields = header.unpack_from(data)
+        tracker = self.tracker
+        if fields[2] != self.expected_total:
+            tracker.invalid += 1
+            return
+        if not tracker.record(fields[3]):
+            return
+        self.bytes += len(data) - header.size
+        self.timer.record(arrival_ns, fields[4] if timestamped else None)
+        self.last_ns = arrival_ns
+        if tracker.bounded and tracker.unique >= tracker.total_segments:
+            self.done.set()
+
+    def idle(self, idle_timeout):
+        """True once no segment came for idle_timeout seconds"""
+        return time.perf_counter_ns() - self.last_ns > idle_timeout * 1e9
+
+    def wait(self, idle_timeout=UPLOAD_IDLE_TIMEOUT):
+        """Blocks until every segment is in or the client went quiet"""
+        while not self.done.wait(idle_timeout / 10):
+            if self.idle(idle_timeout):
+                return
+
+    def summary(self):
+        figures = throughput_figures(self.bytes, self.timer.summary())
+        figures.update(self.tracker.summary())
+        figures["invalid"] = self.tracker.invalid
+        return figures